@@ -8,20 +8,44 @@ import os
 import json
 import hashlib
 import hmac
+import atexit
 import base64
+import contextvars
 import logging
-from collections import defaultdict
-from datetime import datetime, timedelta
-
-import requests
-from flask import Flask, request, abort
-import anthropic
-
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, request, abort
+
+from campaigns import ReminderCampaigns
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from coalescer import EventCoalescer
+from event_queue import EventQueue
+from form_matcher import FormDoneMatcher
+import metrics
+from notifications import NotificationDispatcher
+from outbox import Outbox
+from rate_limits import TokenBudget, UserRateLimiter
+from reply_cache import ReplyCache, prompt_version
+from model_routing import DEFAULT_ROUTES, ModelRouter, parse_routes
+from history_window import estimate_messages_tokens, estimate_tokens, summarize_history, window_history
+from http_clients import Upstream
+import log_pipeline
+from traces import TraceRecorder
+import warmup
+from state_store import SqliteKeyValue, create_form_store, create_history_store, create_seen_events
 from system_prompt import (
     SYSTEM_PROMPT_MODE_A,
     SYSTEM_PROMPT_MODE_B,
     SYSTEM_PROMPT_MODE_C,
     ZOHO_FORM_BASE_URL,
+    FORM_LINK_INSTRUCTION,
+    FORM_DONE_PHRASES,
+    FORM_DONE_SHORT_REPLIES,
+    HISTORY_SUMMARY_INTRO,
 )
 
 # ============================================================
@@ -31,6 +55,8 @@ LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN", "")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET", "")
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 ZOHO_WEBHOOK_URL = os.environ.get("ZOHO_WEBHOOK_URL", "")
+# Only changed for local testing / benchmarks (see bench/)
+LINE_API_BASE_URL = os.environ.get("LINE_API_BASE_URL", "https://api.line.me").rstrip("/")
 
 # Team notifications via email
 TEAM_EMAIL_ADDRESSES = os.environ.get("TEAM_EMAIL_ADDRESSES", "")
@@ -38,138 +64,380 @@ SENDER_EMAIL = os.environ.get("SENDER_EMAIL", "")
 SENDER_PASSWORD = os.environ.get("SENDER_PASSWORD", "")
 SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = os.environ.get("SMTP_PORT", "587")
-
-# Optional: Set to "true" to disable Claude replies (forwarding only)
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_AUTH = os.environ.get("SMTP_AUTH", "true").lower() == "true"
+# Handoffs within this many seconds of each other are emailed as one digest
+NOTIFICATION_BATCH_SECONDS = float(os.environ.get("NOTIFICATION_BATCH_SECONDS", "5"))
+# On shutdown, wait this long for pending handoff emails to go out (after
+# the event drain; keep both inside gunicorn's 30 s graceful timeout)
+NOTIFICATION_FLUSH_SECONDS = float(os.environ.get("NOTIFICATION_FLUSH_SECONDS", "8"))
+
+# Optional: Set to "true" to disable Claude replies (forwarding only).
+# /safety/forwarding-only and /safety/full-mode override this for all workers.
 FORWARDING_ONLY = os.environ.get("FORWARDING_ONLY", "false").lower() == "true"
+# Switch to forwarding-only automatically while Claude is failing
+AUTO_FORWARDING_ONLY = os.environ.get("AUTO_FORWARDING_ONLY", "true").lower() == "true"
+
+# Optional: Set to "true" to answer LINE immediately and process events in the background
+ASYNC_EVENT_PROCESSING = os.environ.get("ASYNC_EVENT_PROCESSING", "false").lower() == "true"
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", "4"))
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "1000"))
+# On shutdown (e.g. a deploy), wait this long for queued events to be
+# answered. LINE already got "OK" for them and won't send them again.
+EVENT_DRAIN_SECONDS = float(os.environ.get("EVENT_DRAIN_SECONDS", "20"))
+
+# Optional: wait this long (ms) for more messages from the same user and answer
+# them together in one reply (0 = off). Never waits longer than COALESCE_MAX_WAIT_MS.
+COALESCE_WINDOW_MS = int(os.environ.get("COALESCE_WINDOW_MS", "0"))
+COALESCE_MAX_WAIT_MS = int(os.environ.get("COALESCE_MAX_WAIT_MS", "4000"))
+
+# Optional: answer repeated MODE B questions from a cache for this many seconds (0 = off)
+REPLY_CACHE_TTL_SECONDS = int(os.environ.get("REPLY_CACHE_TTL_SECONDS", "0"))
+REPLY_CACHE_MAX_ENTRIES = int(os.environ.get("REPLY_CACHE_MAX_ENTRIES", "500"))
+
+# Max (estimated) tokens of chat history sent to Claude per reply; older
+# messages are dropped, or summarised if HISTORY_SUMMARY is "true"
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARY = os.environ.get("HISTORY_SUMMARY", "false").lower() == "true"
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("HISTORY_SUMMARY_TOKENS", "200"))
+
+# Which model answers which mode (see model_routing.py)
+CLAUDE_MODEL = os.environ.get("CLAUDE_MODEL", "claude-sonnet-4-20250514")
+CLAUDE_FAST_MODEL = os.environ.get("CLAUDE_FAST_MODEL", "claude-3-5-haiku-20241022")
+MODEL_ROUTES = os.environ.get("MODEL_ROUTES", DEFAULT_ROUTES)
+MODEL_ROUTE_LONG_MESSAGE_CHARS = int(os.environ.get("MODEL_ROUTE_LONG_MESSAGE_CHARS", "200"))
+# Ask the main model again when a fast-model reply looks unsure
+MODEL_ESCALATION = os.environ.get("MODEL_ESCALATION", "true").lower() == "true"
+
+# Optional: Set to "true" to stream Claude replies (stops early on [HANDOFF])
+CLAUDE_STREAMING = os.environ.get("CLAUDE_STREAMING", "false").lower() == "true"
+# Seconds from receiving a webhook until we give up on Claude and send the
+# handoff message instead (must be well inside the LINE reply token lifetime)
+REPLY_DEADLINE_SECONDS = float(os.environ.get("REPLY_DEADLINE_SECONDS", "25"))
+
+# Rate limits (per server process, 0 = off). See rate_limits.py
+USER_MESSAGES_PER_MINUTE = float(os.environ.get("USER_MESSAGES_PER_MINUTE", "10"))
+USER_MESSAGE_BURST = int(os.environ.get("USER_MESSAGE_BURST", "5"))
+CLAUDE_MAX_CONCURRENT = int(os.environ.get("CLAUDE_MAX_CONCURRENT", "20"))
+CLAUDE_TOKENS_PER_MINUTE = int(os.environ.get("CLAUDE_TOKENS_PER_MINUTE", "0"))
+
+# Circuit breakers for Claude, LINE and Zoho (see circuit_breaker.py)
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+BREAKER_WINDOW_SECONDS = float(os.environ.get("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+# Calls slower than this count as failures (Zoho has no limit: a slow
+# forward holds up no reply)
+CLAUDE_SLOW_SECONDS = float(os.environ.get("CLAUDE_SLOW_SECONDS", "20"))
+UPSTREAM_SLOW_SECONDS = float(os.environ.get("UPSTREAM_SLOW_SECONDS", "5"))
+# Zoho forwards and LINE messages that couldn't be sent are retried this
+# often (see outbox.py)
+OUTBOX_RETRY_SECONDS = float(os.environ.get("OUTBOX_RETRY_SECONDS", "30"))
+
+# Push the reply instead when its reply token has (probably) expired.
+# Pushes count against the LINE plan's monthly message quota; replies don't.
+PUSH_FALLBACK = os.environ.get("PUSH_FALLBACK", "true").lower() == "true"
+REPLY_TOKEN_MAX_AGE_SECONDS = float(os.environ.get("REPLY_TOKEN_MAX_AGE_SECONDS", "50"))
+
+# Reminder campaigns (see campaigns.py); the endpoints are off until a token is set
+CAMPAIGN_API_TOKEN = os.environ.get("CAMPAIGN_API_TOKEN", "")
+CAMPAIGN_BATCHES_PER_SECOND = float(os.environ.get("CAMPAIGN_BATCHES_PER_SECOND", "1"))
+REMINDER_MIN_AGE_HOURS = float(os.environ.get("REMINDER_MIN_AGE_HOURS", "24"))
+
+# Conversation traces for offline replay (see traces.py, bench/replay.py).
+# Off unless TRACE_DIR is set; the files contain customer messages.
+TRACE_DIR = os.environ.get("TRACE_DIR", "")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1"))
+TRACE_MAX_FILE_MB = float(os.environ.get("TRACE_MAX_FILE_MB", "20"))
+TRACE_MAX_FILES = int(os.environ.get("TRACE_MAX_FILES", "20"))
+
+# Logging goes through a queue to a background writer (see log_pipeline.py)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # "json" or "text"
+# Fraction of webhooks whose INFO lines are kept (warnings and errors always are)
+LOG_INFO_SAMPLE_RATE = float(os.environ.get("LOG_INFO_SAMPLE_RATE", "1"))
+# Log only the length of customer messages, not the text
+LOG_REDACT_TEXT = os.environ.get("LOG_REDACT_TEXT", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# Zoho forwarding runs in the background so it never delays the customer's reply
+ZOHO_FORWARD_WORKERS = int(os.environ.get("ZOHO_FORWARD_WORKERS", "4"))
+ZOHO_FORWARD_RETRIES = int(os.environ.get("ZOHO_FORWARD_RETRIES", "2"))
+ZOHO_FORWARD_MAX_PENDING = int(os.environ.get("ZOHO_FORWARD_MAX_PENDING", "200"))
+
+# Cold start: load saved state and pre-warm connections in the background,
+# so the first webhook after a restart isn't the one paying for it
+FAST_STARTUP = os.environ.get("FAST_STARTUP", "true").lower() == "true"
+# Keep-alive connections opened to LINE and Zoho at startup (0 = none)
+PREWARM_CONNECTIONS = int(os.environ.get("PREWARM_CONNECTIONS", "2"))
+# /health reports ready after this long even if startup hasn't finished
+STARTUP_TIMEOUT_SECONDS = float(os.environ.get("STARTUP_TIMEOUT_SECONDS", "10"))
 
 # ============================================================
 # SETUP
 # ============================================================
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+log_pipeline.configure(
+    LOG_LEVEL, LOG_FORMAT, sample_rate=LOG_INFO_SAMPLE_RATE,
+    redact_text=LOG_REDACT_TEXT, queue_size=LOG_QUEUE_SIZE,
+)
 logger = logging.getLogger(__name__)
 
-claude_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# Startup steps are added at the bottom of this file
+startup = warmup.Warmup(STARTUP_TIMEOUT_SECONDS)
 
-# ============================================================
-# CONVERSATION MEMORY
-# Stores recent messages per user for natural conversation flow
-# (This can be in-memory since it's just for current chat context)
-# ============================================================
-conversation_history = defaultdict(list)
-MAX_HISTORY = 10
+def _create_claude_client():
+    # The SDK takes a few hundred ms to import, so it's not imported at the top
+    import anthropic
+    return anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+
+claude_client = warmup.Lazy("Claude client", _create_claude_client)
+
+# Pooled keep-alive sessions (see http_clients.py for the env settings)
+line_http = Upstream.from_env("LINE", pool_size=20, connect_timeout=3.05, read_timeout=10, retries=2)
+zoho_http = Upstream.from_env("ZOHO", pool_size=ZOHO_FORWARD_WORKERS, connect_timeout=3.05, read_timeout=10, retries=1)
 
 # ============================================================
-# PERSISTENT FORM TRACKING (SAVED TO FILE)
+# PERSISTENT FORM TRACKING (SAVED TO DISK)
 # This is the KEY FIX - data survives server restarts!
+# Stored in SQLite by default (see state_store.py); the old JSON
+# file is imported automatically the first time.
 # ============================================================
 FORM_DATA_FILE = "/opt/render/project/src/form_tracking.json"
+# Defaults to the app folder (/opt/render/project/src on Render)
+FORM_DB_FILE = os.environ.get(
+    "FORM_DB_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "form_tracking.db")
+)
+FORM_STORE = os.environ.get("FORM_STORE", "sqlite").lower()
 
-def load_form_data():
-    """Load form tracking data from file."""
-    try:
-        if os.path.exists(FORM_DATA_FILE):
-            with open(FORM_DATA_FILE, "r") as f:
-                data = json.load(f)
-                logger.info(f"Loaded form data: {len(data.get('completed', []))} completed, {len(data.get('link_sent', []))} link sent")
-                return data
-    except Exception as e:
-        logger.error(f"Error loading form data: {e}")
-    return {"completed": [], "link_sent": []}
+# Opened by the startup steps (or by the first webhook, if that's sooner)
+form_store = warmup.Lazy("Form store", lambda: create_form_store(FORM_STORE, FORM_DB_FILE, FORM_DATA_FILE))
 
-def save_form_data():
-    """Save form tracking data to file."""
-    try:
-        data = {
-            "completed": list(form_completed_users),
-            "link_sent": list(form_link_sent_users),
-        }
-        with open(FORM_DATA_FILE, "w") as f:
-            json.dump(data, f)
-        logger.info(f"Saved form data: {len(form_completed_users)} completed, {len(form_link_sent_users)} link sent")
-    except Exception as e:
-        logger.error(f"Error saving form data: {e}")
+def load_form_store():
+    form_counts = form_store.counts()
+    logger.info("Restored: %s completed users, %s link-sent users (%s store)", form_counts["completed"], form_counts["link_sent"], FORM_STORE)
 
-# Load saved data when server starts
-_saved_data = load_form_data()
-form_completed_users = set(_saved_data.get("completed", []))
-form_link_sent_users = set(_saved_data.get("link_sent", []))
-logger.info(f"Restored: {len(form_completed_users)} completed users, {len(form_link_sent_users)} link-sent users")
+# ============================================================
+# CONVERSATION MEMORY
+# Stores recent messages per user for natural conversation flow.
+# In memory by default; set STATE_BACKEND=sqlite to share it between
+# gunicorn workers (see state_store.py).
+# ============================================================
+MAX_HISTORY = 10
+HISTORY_MAX_AGE_SECONDS = 24 * 60 * 60
+# In-memory history keeps at most this many users (least recently active dropped first)
+MAX_TRACKED_CONVERSATIONS = int(os.environ.get("MAX_TRACKED_CONVERSATIONS", "10000"))
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").lower()
+HISTORY_DB_FILE = os.environ.get("HISTORY_DB_FILE", FORM_DB_FILE)
+
+history_store = create_history_store(
+    STATE_BACKEND, HISTORY_DB_FILE, MAX_HISTORY, max_users=MAX_TRACKED_CONVERSATIONS
+)
+# Expiry runs at most this often (it's called for every message)
+HISTORY_CLEAN_INTERVAL_SECONDS = 60
+_last_history_clean = 0.0
 
 def mark_form_completed(user_id):
-    """Mark a user as having completed the form (and save to file)."""
-    form_completed_users.add(user_id)
-    save_form_data()
-    logger.info(f"User {user_id} marked as form completed (saved)")
+    """Mark a user as having completed the form (and save it)."""
+    form_store.mark_completed(user_id)
+    logger.info("User %s marked as form completed (saved)", user_id)
 
 def has_form_been_completed(user_id):
     """Check if user has told us they completed the form."""
-    return user_id in form_completed_users
+    return form_store.is_completed(user_id)
 
 def mark_form_link_sent(user_id):
-    """Mark that we already sent the form link to this user (and save to file)."""
-    form_link_sent_users.add(user_id)
-    save_form_data()
+    """Mark that we already sent the form link to this user (and save it)."""
+    form_store.mark_link_sent(user_id)
 
 def has_form_link_been_sent(user_id):
     """Check if we already sent the form link to this user."""
-    return user_id in form_link_sent_users
+    return form_store.is_link_sent(user_id)
+
+# Compiled once from the phrase lists in system_prompt.py
+form_done_matcher = FormDoneMatcher(FORM_DONE_PHRASES, FORM_DONE_SHORT_REPLIES)
 
 def check_if_user_says_form_done(user_message):
     """Check if the user's message means they completed the form."""
-    done_phrases = [
-        "กรอกแล้ว", "กรอกเรียบร้อย", "เรียบร้อยแล้ว",
-        "เรียบร้อยค่ะ", "เรียบร้อยครับ", "กรอกเสร็จ",
-        "ส่งแล้ว", "ส่งฟอร์มแล้ว", "ทำแล้ว",
-        "ทำเสร็จแล้ว", "เสร็จแล้ว", "เสร็จแล้วค่ะ",
-        "เสร็จแล้วครับ", "กรอกเรียบร้อยค่ะ", "กรอกเรียบร้อยครับ",
-        "กรอกเรียบร้อยค่า", "กรอกเรียบร้อยคะ",
-        "ส่งแล้วค่ะ", "ส่งแล้วครับ", "ส่งไปแล้ว",
-        "ทำเรียบร้อย", "เรียบร้อย", "กรอกฟอร์มแล้ว",
-        "กรอกฟอร์มเรียบร้อย", "กรอกฟอร์มเสร็จ",
-        "กรอกแล้วครับ", "กรอกแล้วค่ะ", "กรอกแล้วค่า",
-        "done", "completed", "finished", "submitted",
-        "filled out", "filled in", "already filled",
-        "already done", "already completed", "i filled",
-        "i completed", "form done", "form completed", "form submitted",
-    ]
-    message_lower = user_message.lower().strip()
-    for phrase in done_phrases:
-        if phrase in message_lower:
-            return True
-    return False
+    return form_done_matcher.matches(user_message)
 
 # ============================================================
 # CONVERSATION HISTORY FUNCTIONS
 # ============================================================
 def add_to_history(user_id, role, content):
     """Add a message to conversation history."""
-    conversation_history[user_id].append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
-    if len(conversation_history[user_id]) > MAX_HISTORY:
-        conversation_history[user_id] = conversation_history[user_id][-MAX_HISTORY:]
+    history_store.append(user_id, role, content)
 
 def get_history(user_id):
     """Get conversation history formatted for Claude API."""
-    messages = []
-    for msg in conversation_history[user_id]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
-    return messages
+    return history_store.get(user_id)
 
 def clean_old_histories():
     """Remove conversation histories older than 24 hours.
     NOTE: We do NOT remove form tracking data anymore!
     """
-    cutoff = datetime.now() - timedelta(hours=24)
-    users_to_remove = []
-    for user_id, messages in conversation_history.items():
-        if messages and datetime.fromisoformat(messages[-1]["timestamp"]) < cutoff:
-            users_to_remove.append(user_id)
-    for user_id in users_to_remove:
-        del conversation_history[user_id]
+    global _last_history_clean
+    now = time.monotonic()
+    if now - _last_history_clean < HISTORY_CLEAN_INTERVAL_SECONDS:
+        return
+    _last_history_clean = now
+    history_store.clean_expired(HISTORY_MAX_AGE_SECONDS)
+
+# ============================================================
+# REDELIVERY DEDUP
+# LINE sends a webhook again (same webhookEventId, isRedelivery=true)
+# when we answer too slowly. Recently seen IDs are remembered so the
+# same message never gets two Claude replies or two team emails.
+# ============================================================
+DEDUP_TTL_SECONDS = int(os.environ.get("DEDUP_TTL_SECONDS", "3600"))
+DEDUP_MAX_EVENTS = int(os.environ.get("DEDUP_MAX_EVENTS", "100000"))
+DEDUP_BACKEND = os.environ.get("DEDUP_BACKEND", "sqlite").lower()
+
+seen_events = (
+    create_seen_events(DEDUP_BACKEND, FORM_DB_FILE, DEDUP_TTL_SECONDS, DEDUP_MAX_EVENTS)
+    if DEDUP_TTL_SECONDS > 0 else None
+)
+dedup_stats = {
+    "checked": 0,
+    "redelivered": 0,
+    "duplicates": 0,
+    "avoided_claude_calls": 0,
+}
+_dedup_lock = threading.Lock()
+
+def is_duplicate_event(event):
+    """True if this webhook event was already received before."""
+    event_id = event.get("webhookEventId")
+    if seen_events is None or not event_id:
+        return False
+    redelivered = event.get("deliveryContext", {}).get("isRedelivery", False)
+    try:
+        first_time = seen_events.add(event_id)
+    except Exception as e:
+        # Never drop a customer's message because the index is unavailable
+        logger.error("Dedup check failed, processing event anyway: %s", e)
+        return False
+    duplicate = not first_time
+    message_type = event.get("message", {}).get("type", "")
+    with _dedup_lock:
+        dedup_stats["checked"] += 1
+        dedup_stats["redelivered"] += 1 if redelivered else 0
+        if duplicate:
+            dedup_stats["duplicates"] += 1
+            if event.get("type") == "message" and message_type == "text":
+                dedup_stats["avoided_claude_calls"] += 1
+    if redelivered:
+        metrics.REDELIVERED_EVENTS_TOTAL.inc(outcome="duplicate" if duplicate else "new")
+    if duplicate:
+        metrics.DUPLICATE_EVENTS_TOTAL.inc(event_type=event.get("type", ""), message_type=message_type)
+        logger.info("Skipping duplicate event %s (redelivery=%s)", event_id, redelivered)
+    return duplicate
+
+# ============================================================
+# CIRCUIT BREAKERS & FORWARDING-ONLY MODE
+# A failing or very slow service is not called again until it has had
+# time to recover. When Claude's breaker trips, the bot switches every
+# worker to forwarding-only (the team answers via Zoho, no apology or
+# email per message) and checks Claude now and then until it's back.
+# The switch lives in the shared SQLite file so all workers agree.
+# ============================================================
+# The shared switch is re-read at most this often per process
+MODE_CHECK_INTERVAL_SECONDS = 2
+
+settings = SqliteKeyValue(FORM_DB_FILE)
+_mode_cache = {"checked_at": None, "values": {}}
+
+def _mode_values():
+    now = time.monotonic()
+    checked_at = _mode_cache["checked_at"]
+    if checked_at is None or now - checked_at >= MODE_CHECK_INTERVAL_SECONDS:
+        try:
+            _mode_cache["values"] = settings.get_many("mode.")
+        except Exception as e:
+            logger.error("Could not read the shared mode switch: %s", e)
+        _mode_cache["checked_at"] = now
+    return _mode_cache["values"]
+
+def _switched_off_by_hand(values):
+    # The /safety endpoints win over the FORWARDING_ONLY env setting
+    manual = values.get("mode.forwarding_only")
+    return manual == "on" or (manual is None and FORWARDING_ONLY)
+
+def forwarding_only():
+    """True if Claude replies are off, by hand or automatically."""
+    values = _mode_values()
+    return _switched_off_by_hand(values) or "mode.auto_probe_at" in values
+
+def current_mode():
+    values = _mode_values()
+    if _switched_off_by_hand(values):
+        return "forwarding_only"
+    if "mode.auto_probe_at" in values:
+        return "auto_forwarding_only"
+    return "full"
+
+def set_forwarding_only(enabled):
+    """Switch Claude replies off/on for every worker."""
+    settings.set("mode.forwarding_only", "on" if enabled else "off")
+    if not enabled:
+        _end_auto_forwarding_only()
+    _mode_cache["checked_at"] = None
+
+def _start_auto_forwarding_only(breaker):
+    if not AUTO_FORWARDING_ONLY:
+        return
+    logger.error("Claude is failing - switching to forwarding-only until it recovers")
+    settings.set("mode.auto_reason", f"{breaker.name} circuit opened")
+    settings.set("mode.auto_probe_at", str(time.time() + breaker.open_seconds))
+    _mode_cache["checked_at"] = None
+
+def _end_auto_forwarding_only():
+    settings.delete("mode.auto_probe_at")
+    settings.delete("mode.auto_reason")
+    claude_breaker.reset()
+    _mode_cache["checked_at"] = None
+
+def maybe_probe_claude():
+    """In automatic forwarding-only mode, check now and then if Claude is back.
+
+    Only one worker runs each check: it claims it by moving the shared
+    next-check time forward.
+    """
+    probe_at = _mode_values().get("mode.auto_probe_at")
+    if probe_at is None or time.time() < float(probe_at):
+        return
+    if not settings.compare_and_set("mode.auto_probe_at", probe_at, str(time.time() + BREAKER_OPEN_SECONDS)):
+        return
+    threading.Thread(target=_probe_claude, name="claude-probe", daemon=True).start()
+
+def _probe_claude():
+    started = time.monotonic()
+    try:
+        claude_client.messages.create(
+            model=CLAUDE_MODEL, max_tokens=1,
+            messages=[{"role": "user", "content": "ping"}],
+            timeout=CLAUDE_SLOW_SECONDS,
+        )
+    except Exception as e:
+        logger.warning("Claude check failed, staying in forwarding-only: %s", e)
+        return
+    logger.info("Claude check succeeded in %.2fs - back to full mode", time.monotonic() - started)
+    _end_auto_forwarding_only()
+
+def _breaker(name, slow_call_seconds, on_open=None):
+    return CircuitBreaker(
+        name,
+        failure_rate=BREAKER_FAILURE_RATE,
+        min_calls=BREAKER_MIN_CALLS,
+        window_seconds=BREAKER_WINDOW_SECONDS,
+        slow_call_seconds=slow_call_seconds,
+        open_seconds=BREAKER_OPEN_SECONDS,
+        on_open=on_open,
+    )
+
+claude_breaker = _breaker("claude", CLAUDE_SLOW_SECONDS, on_open=_start_auto_forwarding_only)
+line_breaker = _breaker("line", UPSTREAM_SLOW_SECONDS)
+zoho_breaker = _breaker("zoho", None)
 
 # ============================================================
 # LINE SIGNATURE VERIFICATION
@@ -187,104 +455,291 @@ def verify_signature(body, signature):
 # ============================================================
 # ZOHO FORWARDING
 # ============================================================
-def forward_to_zoho(body, headers):
-    """Forward the raw LINE webhook data to Zoho."""
+def forward_to_zoho(body, headers, retries=0):
+    """Forward the raw LINE webhook data to Zoho.
+
+    `body` should be the raw request bytes so Zoho receives exactly what
+    LINE sent (and the signature still matches). Connection errors and
+    5xx responses are retried up to `retries` times with backoff. If
+    Zoho still hasn't taken it (or its circuit is open), the forward is
+    kept in the outbox and sent again later - never dropped.
+    """
     if not ZOHO_WEBHOOK_URL:
         logger.warning("ZOHO_WEBHOOK_URL not set, skipping Zoho forwarding")
         return
+    forward_headers = {
+        "Content-Type": headers.get("Content-Type", "application/json"),
+        "X-Line-Signature": headers.get("X-Line-Signature", ""),
+    }
+    for attempt in range(retries + 1):
+        try:
+            if post_to_zoho(body, forward_headers):
+                return
+        except CircuitOpenError:
+            break  # retrying within seconds won't help
+        if attempt < retries:
+            time.sleep(0.5 * (2 ** attempt))
+    hold_zoho_forward(body, forward_headers)
+
+def post_to_zoho(body, forward_headers):
+    """One forward attempt. True if Zoho took it (any answer below 500).
+
+    Raises CircuitOpenError instead of calling Zoho while its breaker is open.
+    """
+    if not zoho_breaker.allow():
+        metrics.ZOHO_FORWARD_SECONDS.observe(0.0, outcome="circuit_open")
+        raise CircuitOpenError("Zoho circuit open")
+    started = time.perf_counter()
     try:
-        forward_headers = {
-            "Content-Type": headers.get("Content-Type", "application/json"),
-            "X-Line-Signature": headers.get("X-Line-Signature", ""),
-        }
-        response = requests.post(ZOHO_WEBHOOK_URL, data=body, headers=forward_headers, timeout=10)
-        logger.info(f"Forwarded to Zoho: status {response.status_code}")
+        response = zoho_http.post(ZOHO_WEBHOOK_URL, data=body, headers=forward_headers)
     except Exception as e:
-        logger.error(f"Failed to forward to Zoho: {e}")
+        zoho_breaker.failure(time.perf_counter() - started)
+        metrics.ZOHO_FORWARD_SECONDS.observe(time.perf_counter() - started, outcome="exception")
+        logger.error("Failed to forward to Zoho: %s", e)
+        return False
+    elapsed = time.perf_counter() - started
+    zoho_breaker.record(elapsed, failed=response.status_code >= 500)
+    metrics.ZOHO_FORWARD_SECONDS.observe(elapsed, outcome="ok" if response.status_code < 500 else "server_error")
+    logger.info("Forwarded to Zoho: status %s", response.status_code)
+    return response.status_code < 500
+
+# Shared with the async server (asgi_app.py)
+def hold_zoho_forward(body, forward_headers):
+    """Keep a forward Zoho didn't take in the outbox (exact bytes, base64)."""
+    outbox.put("zoho", {"body": base64.b64encode(body).decode("ascii"), "headers": forward_headers})
+    logger.warning("Zoho forward not delivered - kept in the outbox to send later")
+
+def _send_held_zoho_forward(payload):
+    try:
+        return post_to_zoho(base64.b64decode(payload["body"]), payload["headers"])
+    except CircuitOpenError:
+        return False
+
+_zoho_executor = None
+_zoho_executor_pid = None
+_zoho_pending = threading.BoundedSemaphore(ZOHO_FORWARD_MAX_PENDING)
+
+def _forward_to_zoho_job(body, headers):
+    try:
+        forward_to_zoho(body, headers, retries=ZOHO_FORWARD_RETRIES)
+    finally:
+        _zoho_pending.release()
+
+def forward_to_zoho_background(body, headers):
+    """Forward to Zoho without waiting for it (fire-and-forget with retries).
+
+    If too many forwards are already pending, forward inline instead so
+    no webhook is ever dropped.
+    """
+    global _zoho_executor, _zoho_executor_pid
+    if not ZOHO_WEBHOOK_URL:
+        logger.warning("ZOHO_WEBHOOK_URL not set, skipping Zoho forwarding")
+        return
+    if not _zoho_pending.acquire(blocking=False):
+        logger.warning("Too many pending Zoho forwards - forwarding inline")
+        forward_to_zoho(body, headers)
+        return
+    # The pool is created lazily so each gunicorn worker gets its own threads
+    if _zoho_executor_pid != os.getpid():
+        _zoho_executor = ThreadPoolExecutor(max_workers=ZOHO_FORWARD_WORKERS, thread_name_prefix="zoho")
+        _zoho_executor_pid = os.getpid()
+    # Run with this webhook's context so its request ID is on the log lines
+    _zoho_executor.submit(contextvars.copy_context().run, _forward_to_zoho_job, body, headers)
 
 # ============================================================
-# LINE REPLY
+# LINE MESSAGES
+# Replies use the event's reply token (free, but only valid for about
+# a minute). If a slow reply's token has expired, the same messages
+# are pushed to the chat instead. Reminder campaigns use multicast.
 # ============================================================
-def reply_to_line(reply_token, text):
+def reply_to_line(reply_token, text, push_to=None, received_at=None):
     """Send a reply message to LINE."""
-    url = "https://api.line.me/v2/bot/message/reply"
+    reply_messages_to_line(reply_token, [{"type": "text", "text": text}], push_to, received_at)
+
+def reply_messages_to_line(reply_token, messages, push_to=None, received_at=None):
+    """Send up to 5 message objects to LINE in one reply.
+
+    With `push_to` (a user, group or room ID), a reply token that is
+    too old or that LINE rejects is replaced by a push to that chat.
+    """
+    if push_instead_of_reply(push_to, received_at):
+        push_to_line(push_to, messages, reason="expired")
+        return
+    held_push_to = push_to if PUSH_FALLBACK else None
+    response = post_to_line("reply", {"replyToken": reply_token, "messages": messages}, push_to=held_push_to)
+    if response is not None and reply_token_rejected(push_to, response.status_code, response.text):
+        push_to_line(push_to, messages, reason="invalid_token")
+
+def push_to_line(to, messages, reason):
+    logger.warning("Reply token %s - pushing the reply to %s instead", reason, to)
+    metrics.PUSH_FALLBACKS_TOTAL.inc(reason=reason)
+    post_to_line("push", {"to": to, "messages": messages}, push_to=to)
+
+def multicast_to_line(user_ids, messages, retry_key):
+    """Send the same messages to up to 500 users (for campaigns.py).
+
+    Retries of the same batch must pass the same `retry_key`, so LINE
+    delivers it only once even if an earlier response was lost.
+    Returns (status, retry_after_seconds, error_text); status is 0 if
+    the request couldn't be sent.
+    """
+    response = post_to_line("multicast", {"to": user_ids, "messages": messages}, retry_key)
+    if response is None:
+        return 0, None, "not sent"
+    retry_after = response.headers.get("Retry-After", "")
+    return response.status_code, float(retry_after) if retry_after.isdigit() else None, response.text
+
+# Shared with the async server (asgi_app.py)
+def line_api_request(api, retry_key=None):
+    """(url, headers) for a LINE message API call: "reply", "push" or "multicast"."""
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
     }
-    data = {"replyToken": reply_token, "messages": [{"type": "text", "text": text}]}
+    if api != "reply":
+        # LINE ignores a repeated push / multicast with the same key. A
+        # caller that retries must pass the key of its first attempt;
+        # otherwise the key only covers the HTTP client's own retries.
+        headers["X-Line-Retry-Key"] = retry_key or str(uuid.uuid4())
+    return f"{LINE_API_BASE_URL}/v2/bot/message/{api}", headers
+
+def push_instead_of_reply(push_to, received_at):
+    """True if the reply token is too old to be worth trying."""
+    return (
+        PUSH_FALLBACK and bool(push_to) and received_at is not None
+        and time.monotonic() - received_at > REPLY_TOKEN_MAX_AGE_SECONDS
+    )
+
+def reply_token_rejected(push_to, status, text):
+    return PUSH_FALLBACK and bool(push_to) and status == 400 and "reply token" in text.lower()
+
+def push_target(event):
+    """The chat a push goes to if the event's reply token has expired."""
+    source = event.get("source", {})
+    return source.get("groupId") or source.get("roomId") or source.get("userId")
+
+def post_to_line(api, data, retry_key=None, push_to=None):
+    """One LINE API call through the breaker. Returns the response, or None if not sent.
+
+    If LINE's circuit is open or LINE answers 5xx and `push_to` is
+    given, the messages are kept in the outbox and pushed to that chat
+    later.
+    """
+    url, headers = line_api_request(api, retry_key)
+    if not line_breaker.allow():
+        metrics.LINE_ERRORS_TOTAL.inc(status="circuit_open")
+        if push_to:
+            hold_line_push(push_to, data["messages"], "circuit open")
+        else:
+            logger.error("LINE circuit open - %s not sent", api)
+        return None
+    started = time.perf_counter()
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=10)
-        logger.info(f"LINE reply: status {response.status_code}")
+        response = line_http.post(url, headers=headers, json=data)
+        elapsed = time.perf_counter() - started
+        if api == "reply":
+            metrics.LINE_REPLY_SECONDS.observe(elapsed)
+        # 4xx (e.g. an expired reply token) is our problem, not LINE being down
+        line_breaker.record(elapsed, failed=response.status_code >= 500)
+        logger.info("LINE %s: status %s", api, response.status_code)
         if response.status_code != 200:
-            logger.error(f"LINE reply error: {response.text}")
+            metrics.LINE_ERRORS_TOTAL.inc(status=response.status_code)
+            logger.error("LINE %s error: %s", api, response.text)
+            if response.status_code >= 500 and push_to:
+                hold_line_push(push_to, data["messages"], f"status {response.status_code}")
+        return response
     except Exception as e:
-        logger.error(f"Failed to reply on LINE: {e}")
+        line_breaker.failure(time.perf_counter() - started)
+        metrics.LINE_ERRORS_TOTAL.inc(status="exception")
+        logger.error("Failed to %s on LINE: %s", api, e)
+        return None
+
+# Shared with the async server (asgi_app.py)
+def hold_line_push(to, messages, reason):
+    """Keep messages LINE didn't take, to push them to `to` later."""
+    # One retry key for every later attempt, so LINE delivers them once
+    outbox.put("line_push", {"to": to, "messages": messages, "retry_key": str(uuid.uuid4())})
+    metrics.PUSH_FALLBACKS_TOTAL.inc(reason="held")
+    logger.warning("LINE %s - messages for %s kept in the outbox to push later", reason, to)
+
+def _send_held_line_push(payload):
+    response = post_to_line("push", {"to": payload["to"], "messages": payload["messages"]}, payload["retry_key"])
+    # A 4xx won't get better by trying again; 409 = already delivered
+    return response is not None and response.status_code < 500
 
 # ============================================================
-# TEAM NOTIFICATION (EMAIL)
+# OUTBOX
+# Zoho forwards and LINE messages that couldn't be sent are kept in the
+# shared SQLite file and sent again every OUTBOX_RETRY_SECONDS, by
+# whichever worker gets to them first (see outbox.py)
 # ============================================================
-def send_team_notification(user_message, handoff_reason):
-    """Send email notification to team when handoff is triggered."""
-    team_emails = os.environ.get("TEAM_EMAIL_ADDRESSES", "").split(",")
-    team_emails = [email.strip() for email in team_emails if email.strip()]
-    if not team_emails:
-        logger.warning("TEAM_EMAIL_ADDRESSES not set, skipping team notification")
-        return
-
-    topic_subjects = {
-        "booking": "New Booking Request",
-        "payment": "Payment Inquiry",
-        "contract": "Contract Question",
-        "visa": "Visa Support Request",
-        "customer_needs_help": "Customer Needs Help",
-        "unknown": "Customer Needs Help"
-    }
-    subject = topic_subjects.get(handoff_reason, "Customer Needs Help")
-    if len(user_message) > 200:
-        user_message = user_message[:200] + "..."
+outbox = Outbox(
+    FORM_DB_FILE,
+    {"zoho": _send_held_zoho_forward, "line_push": _send_held_line_push},
+    retry_seconds=OUTBOX_RETRY_SECONDS,
+)
 
-    email_body = f"""
-A customer needs team assistance:
+# ============================================================
+# REMINDER CAMPAIGNS
+# Multicast a reminder to everyone who got the form link but hasn't
+# filled it in (MODE C). See campaigns.py.
+# ============================================================
+REMINDER_MESSAGE = (
+    "สวัสดีค่ะ 😊 ทีมงาน Peyton & Charmed เองนะคะ "
+    "ถ้าน้องยังสนใจหาที่พักอยู่ กรอกแบบฟอร์มที่เราส่งให้ได้เลยนะคะ "
+    "กรอกเสร็จแล้วพิมพ์บอกเราว่า 'กรอกแล้วค่ะ' จะได้ช่วยน้องต่อได้เลยค่ะ"
+)
+LINE_TEXT_MAX_CHARS = 5000
 
-Topic: {handoff_reason.title()}
-Customer Message: "{user_message}"
+reminder_campaigns = ReminderCampaigns(
+    settings, form_store, multicast_to_line, batches_per_second=CAMPAIGN_BATCHES_PER_SECOND,
+)
 
-Please check Zoho CRM for full customer details and follow up accordingly.
+def campaign_endpoint(action, authorization, payload):
+    """The /campaigns endpoints, shared by both servers. Returns (status, body)."""
+    if not CAMPAIGN_API_TOKEN:
+        return 403, {"error": "campaigns are disabled (CAMPAIGN_API_TOKEN is not set)"}
+    if not hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {CAMPAIGN_API_TOKEN}".encode("utf-8")):
+        return 401, {"error": "unauthorized"}
+    if action == "list":
+        return 200, {"campaigns": reminder_campaigns.list()}
+    if action == "cancel":
+        campaign = reminder_campaigns.cancel(str(payload.get("id", "")))
+        return (200, campaign) if campaign is not None else (404, {"error": "no such campaign"})
+
+    text = payload.get("message") or REMINDER_MESSAGE
+    start_at = payload.get("start_at")
+    min_age_hours = payload.get("min_age_hours", REMINDER_MIN_AGE_HOURS)
+    if not isinstance(text, str) or len(text) > LINE_TEXT_MAX_CHARS:
+        return 400, {"error": f"message must be text of at most {LINE_TEXT_MAX_CHARS} characters"}
+    if not all(isinstance(v, (int, float)) for v in (start_at or 0, min_age_hours)):
+        return 400, {"error": "start_at (unix time) and min_age_hours must be numbers"}
+    campaign = reminder_campaigns.create(
+        [{"type": "text", "text": text}], start_at=start_at, min_age_seconds=min_age_hours * 3600,
+    )
+    return 200, campaign
 
-Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+# ============================================================
+# TEAM NOTIFICATION (EMAIL)
+# ============================================================
+notification_dispatcher = NotificationDispatcher(
+    smtp_server=SMTP_SERVER,
+    smtp_port=int(SMTP_PORT),
+    sender_email=SENDER_EMAIL,
+    sender_password=SENDER_PASSWORD,
+    recipients=[email.strip() for email in TEAM_EMAIL_ADDRESSES.split(",") if email.strip()],
+    starttls=SMTP_STARTTLS,
+    auth=SMTP_AUTH,
+    batch_window=NOTIFICATION_BATCH_SECONDS,
+)
 
----
-Peyton & Charmed Bot Alert System
-"""
-    try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-
-        smtp_server = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
-        smtp_port = int(os.environ.get("SMTP_PORT", "587"))
-        sender_email = os.environ.get("SENDER_EMAIL", "")
-        sender_password = os.environ.get("SENDER_PASSWORD", "")
-        if not sender_email or not sender_password:
-            logger.warning("Email credentials not configured, skipping notification")
-            return
+def send_team_notification(user_message, handoff_reason):
+    """Queue an email notification to the team when handoff is triggered.
 
-        message = MIMEMultipart()
-        message["From"] = sender_email
-        message["To"] = ", ".join(team_emails)
-        message["Subject"] = subject
-        message.attach(MIMEText(email_body, "plain"))
-
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        text = message.as_string()
-        server.sendmail(sender_email, team_emails, text)
-        server.quit()
-        logger.info(f"Team notification email sent to {len(team_emails)} recipients")
-    except Exception as e:
-        logger.error(f"Failed to send team notification email: {e}")
+    The email is sent in the background (see notifications.py); handoffs
+    that arrive within NOTIFICATION_BATCH_SECONDS are sent as one digest.
+    """
+    notification_dispatcher.notify(user_message, handoff_reason)
 
 # ============================================================
 # HANDOFF DETECTION & CLEANUP
@@ -295,48 +750,795 @@ def detect_handoff_trigger(bot_reply):
 def strip_handoff_tag(bot_reply):
     return bot_reply.replace("[HANDOFF]", "").strip()
 
+# ============================================================
+# PROMPT CACHING
+# The big mode prompts are identical for every customer, so they are
+# sent as cacheable system blocks. Only the MODE A form link is per-user
+# and goes in a small uncached block after the cached prefix.
+# ============================================================
+SYSTEM_PROMPTS = {
+    "A": SYSTEM_PROMPT_MODE_A,
+    "B": SYSTEM_PROMPT_MODE_B,
+    "C": SYSTEM_PROMPT_MODE_C,
+}
+
+prompt_cache_stats = {
+    "requests": 0,
+    "cache_hits": 0,
+    "cache_writes": 0,
+    "input_tokens": 0,
+    "cache_read_input_tokens": 0,
+    "cache_creation_input_tokens": 0,
+    "output_tokens": 0,
+}
+_prompt_cache_lock = threading.Lock()
+
+# Answers to repeated MODE B questions (see reply_cache.py). The prompt
+# version in each key means edited prompts never serve old answers.
+PROMPT_VERSION = prompt_version(SYSTEM_PROMPT_MODE_A, SYSTEM_PROMPT_MODE_B, SYSTEM_PROMPT_MODE_C)
+reply_cache = ReplyCache(
+    PROMPT_VERSION,
+    ttl_seconds=REPLY_CACHE_TTL_SECONDS,
+    max_entries=REPLY_CACHE_MAX_ENTRIES,
+)
+
+def get_form_link(user_id):
+    return f"{ZOHO_FORM_BASE_URL}?Line_ID={user_id}"
+
+def build_system_blocks(mode, user_id):
+    """Build the system prompt blocks for a mode (cached prefix first)."""
+    blocks = [{
+        "type": "text",
+        "text": SYSTEM_PROMPTS[mode],
+        "cache_control": {"type": "ephemeral"},
+    }]
+    if mode == "A":
+        blocks.append({"type": "text", "text": f"{FORM_LINK_INSTRUCTION} {get_form_link(user_id)}"})
+    return blocks
+
+def record_prompt_cache_usage(user_id, mode, usage):
+    """Log and count prompt cache hits/misses from a Claude response."""
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    with _prompt_cache_lock:
+        prompt_cache_stats["requests"] += 1
+        prompt_cache_stats["cache_hits"] += 1 if cache_read else 0
+        prompt_cache_stats["cache_writes"] += 1 if cache_write else 0
+        prompt_cache_stats["input_tokens"] += usage.input_tokens
+        prompt_cache_stats["cache_read_input_tokens"] += cache_read
+        prompt_cache_stats["cache_creation_input_tokens"] += cache_write
+        prompt_cache_stats["output_tokens"] += usage.output_tokens
+    logger.info(
+        "User %s: MODE %s tokens in=%s out=%s cache_read=%s cache_write=%s",
+        user_id, mode, usage.input_tokens, usage.output_tokens, cache_read, cache_write,
+    )
+
 # ============================================================
 # CLAUDE - Get AI Response (NOW WITH 3 MODES)
 # ============================================================
-def get_jenny_reply(user_id, user_message, form_completed=False, form_link_sent=False):
+HANDOFF_FALLBACK_REPLY = "ขอโทษนะคะ ระบบมีปัญหาทางเทคนิคค่ะ ทีมจะติดต่อกลับเร็วๆ นี้นะคะ [HANDOFF]"
+# Sent instead of a Claude reply when a rate limit is hit (no handoff)
+USER_RATE_LIMITED_REPLY = "น้องส่งข้อความมาเร็วมากเลยค่ะ 😊 รอสักครู่แล้วพิมพ์คำถามมาอีกครั้งนะคะ"
+CLAUDE_BUSY_REPLY = "ตอนนี้มีน้องๆ ทักมาเยอะมากเลยค่ะ 🙏 รบกวนรอสักครู่แล้วส่งคำถามมาอีกครั้งนะคะ"
+
+MAX_REPLY_TOKENS = 500
+
+model_router = ModelRouter(
+    parse_routes(MODEL_ROUTES, CLAUDE_MODEL, CLAUDE_FAST_MODEL), CLAUDE_MODEL, MAX_REPLY_TOKENS,
+    long_message_chars=MODEL_ROUTE_LONG_MESSAGE_CHARS, escalate=MODEL_ESCALATION,
+)
+
+user_rate_limiter = UserRateLimiter(
+    USER_MESSAGES_PER_MINUTE, USER_MESSAGE_BURST, max_users=MAX_TRACKED_CONVERSATIONS
+)
+claude_token_budget = TokenBudget(CLAUDE_TOKENS_PER_MINUTE)
+# Claude calls running at once in this process; more wait for a free slot
+# until the reply deadline
+claude_slots = threading.BoundedSemaphore(CLAUDE_MAX_CONCURRENT) if CLAUDE_MAX_CONCURRENT > 0 else None
+claude_slot_stats = {"in_flight": 0, "waited": 0, "timed_out": 0}
+_claude_slot_lock = threading.Lock()
+
+def get_jenny_reply(user_id, user_message, form_completed=False, form_link_sent=False,
+                    deadline=None, timing=None):
     """Get a reply from Claude.
     
     3 MODES:
     - MODE A: New customer, never got form link -> send form link
     - MODE C: Customer got form link but hasn't completed -> remind gently, NO link
     - MODE B: Customer completed form -> full FAQ helper
+
+    `deadline` is a time.monotonic() value; if Claude hasn't finished by
+    then we fall back to the handoff message. Stage timings (seconds) are
+    written into the `timing` dict if one is given.
+
+    Returns None if Claude's circuit breaker is open (no reply is sent;
+    the message reaches the team through Zoho).
     """
+    if timing is None:
+        timing = {}
+    if deadline is None:
+        deadline = time.monotonic() + REPLY_DEADLINE_SECONDS
 
+    reply, plan = prepare_claude_request(user_id, user_message, form_completed, form_link_sent, deadline, timing)
+    if plan is None:
+        return reply
+
+    # Wait for a free Claude slot, but never past the reply deadline
+    if claude_slots is not None:
+        waited = time.monotonic()
+        if not claude_slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            return claude_slot_timed_out(user_id, plan, timing)
+        claude_slot_acquired(plan, timing, time.monotonic() - waited)
+    try:
+        if not claude_breaker.allow():
+            return claude_unavailable(user_id, plan, timing)
+        started = time.monotonic()
+        try:
+            while True:
+                if CLAUDE_STREAMING:
+                    reply, usage = _stream_claude_reply(plan["request_args"], deadline, started, timing)
+                else:
+                    response = claude_client.with_options(max_retries=0).messages.create(
+                        **within_deadline(plan["request_args"], deadline)
+                    )
+                    reply, usage = response.content[0].text, response.usage
+                    timing["first_token"] = time.monotonic() - started
+                timing["generation"] = time.monotonic() - started
+                escalated = escalate_claude_request(user_id, plan, reply, usage, timing, deadline)
+                if escalated is None:
+                    break
+                plan = escalated
+                started = time.monotonic()
+            return finish_claude_reply(user_id, user_message, plan, reply, usage, timing)
+        except Exception as e:
+            timing["generation"] = time.monotonic() - started
+            return claude_reply_failed(user_id, plan, e, timing)
+    finally:
+        if claude_slots is not None:
+            claude_slot_released()
+            claude_slots.release()
+
+# The steps before and after the Claude call are shared with the async
+# server (asgi_app.py), so both servers reply exactly the same way.
+def choose_mode(user_id, form_completed, form_link_sent):
+    # The mode is logged with the request (see prepare_claude_request)
     if form_completed:
         # MODE B: Form done, full helper
-        system_prompt = SYSTEM_PROMPT_MODE_B
-        logger.info(f"User {user_id}: Using MODE B (form completed)")
-    elif form_link_sent:
+        return "B"
+    if form_link_sent:
         # MODE C: Form link already sent, just remind
-        system_prompt = SYSTEM_PROMPT_MODE_C
-        logger.info(f"User {user_id}: Using MODE C (waiting for form)")
-    else:
-        # MODE A: First time, send form link
-        form_link = f"{ZOHO_FORM_BASE_URL}?Line_ID={user_id}"
-        system_prompt = SYSTEM_PROMPT_MODE_A.replace("{form_link}", form_link)
-        logger.info(f"User {user_id}: Using MODE A (new customer)")
+        return "C"
+    # MODE A: First time, send form link
+    return "A"
+
+def prepare_claude_request(user_id, user_message, form_completed, form_link_sent, deadline, timing):
+    """Pick the mode, update history and build the Claude request.
+
+    Returns (reply, None) if the reply is already decided (reply cache
+    hit, or the deadline has passed), otherwise (None, plan) where plan
+    holds the mode, the request arguments and whether the answer may be
+    cached.
+    """
+    mode = choose_mode(user_id, form_completed, form_link_sent)
+    route = model_router.route_for(mode, user_message)
+    timing["mode"] = mode
+    timing["route"] = route.name
+    system_blocks = build_system_blocks(mode, user_id)
+
+    # MODE B FAQ repeats can be answered from the reply cache. Answers are
+    # only stored for, and only served to, questions asked without earlier
+    # context: mid-conversation "ราคาเท่าไหร่" depends on what came before.
+    cacheable = False
+    if mode == "B" and reply_cache.enabled and not get_history(user_id):
+        cached_reply = reply_cache.get(mode, user_message)
+        if cached_reply is not None:
+            logger.info("User %s: MODE %s answered from reply cache", user_id, mode)
+            timing["reply_cache_hit"] = True
+            add_to_history(user_id, "user", user_message)
+            add_to_history(user_id, "assistant", cached_reply)
+            return cached_reply, None
+        cacheable = True
+
+    # A customer sending messages faster than the limit gets a short
+    # canned reply (not saved to history, so it doesn't crowd it out)
+    if not user_rate_limiter.allow(user_id):
+        logger.warning("User %s: over %g messages/minute, sending canned reply", user_id, USER_MESSAGES_PER_MINUTE)
+        timing["rate_limited"] = "user"
+        metrics.RATE_LIMITED_TOTAL.inc(limit="user")
+        return USER_RATE_LIMITED_REPLY, None
 
     add_to_history(user_id, "user", user_message)
-    messages = get_history(user_id)
+    messages, dropped = window_history(get_history(user_id), HISTORY_TOKEN_BUDGET)
+    if dropped and HISTORY_SUMMARY:
+        summary = summarize_history(dropped, HISTORY_SUMMARY_TOKENS)
+        if summary:
+            system_blocks.append({"type": "text", "text": f"{HISTORY_SUMMARY_INTRO}\n{summary}"})
+    logger.info(
+        "User %s: MODE %s via %s, sending %s messages (~%s tokens), %s older messages %s",
+        user_id, mode, route.name, len(messages), log_pipeline.Deferred(estimate_messages_tokens, messages),
+        len(dropped), "summarised" if dropped and HISTORY_SUMMARY else "dropped",
+    )
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        logger.warning("User %s: reply deadline already passed, handing off", user_id)
+        timing["deadline_exceeded"] = True
+        metrics.CLAUDE_ERRORS_TOTAL.inc(kind="deadline")
+        return HANDOFF_FALLBACK_REPLY, None
+
+    # Reserve the worst case (whole prompt + longest reply); the real
+    # usage is settled when Claude answers
+    reserved_tokens = (
+        sum(estimate_tokens(block["text"]) for block in system_blocks)
+        + estimate_messages_tokens(messages) + route.max_tokens
+    )
+    if not claude_token_budget.reserve(reserved_tokens):
+        logger.warning("User %s: Claude tokens-per-minute budget used up, sending busy reply", user_id)
+        timing["rate_limited"] = "tokens"
+        metrics.RATE_LIMITED_TOTAL.inc(limit="tokens")
+        add_to_history(user_id, "assistant", CLAUDE_BUSY_REPLY)
+        return CLAUDE_BUSY_REPLY, None
+
+    request_args = {
+        "model": route.model,
+        "max_tokens": route.max_tokens,
+        "system": system_blocks,
+        "messages": messages,
+        "timeout": remaining,
+    }
+    return None, {"mode": mode, "route": route, "request_args": request_args, "cacheable": cacheable,
+                  "reserved_tokens": reserved_tokens}
+
+def record_claude_call(user_id, plan, seconds, usage, failed=False, rate_limited=False):
+    """Breaker, metrics and token budget bookkeeping for one Claude call."""
+    mode = plan["mode"]
+    route = plan["route"]
+    metrics.CLAUDE_SECONDS.observe(seconds, mode=mode)
+    metrics.CLAUDE_ROUTE_SECONDS.observe(seconds, route=route.name, model=route.model)
+    if rate_limited:
+        # A 429 means Anthropic is up and answering; it gets the busy reply
+        # and must not trip the breaker (and forwarding-only with it)
+        claude_breaker.success()
+    else:
+        claude_breaker.record(seconds, failed=failed)
+    model_router.record(route, seconds, usage, failed=failed)
+    if usage is not None:
+        metrics.CLAUDE_ROUTE_TOKENS_TOTAL.inc(usage.input_tokens, route=route.name, kind="input")
+        metrics.CLAUDE_ROUTE_TOKENS_TOTAL.inc(usage.output_tokens, route=route.name, kind="output")
+        record_prompt_cache_usage(user_id, mode, usage)
+        claude_token_budget.settle(
+            plan["reserved_tokens"],
+            usage.input_tokens + usage.output_tokens
+            + (getattr(usage, "cache_read_input_tokens", None) or 0)
+            + (getattr(usage, "cache_creation_input_tokens", None) or 0),
+        )
+    else:
+        # The call failed: nothing to count, so give the reservation back
+        # (as claude_unavailable and claude_slot_timed_out do)
+        claude_token_budget.settle(plan["reserved_tokens"], 0)
 
-    try:
-        response = claude_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=500,
-            system=system_prompt,
-            messages=messages
+def escalate_claude_request(user_id, plan, reply, usage, timing, deadline):
+    """Ask the main model again if a fast-model reply looks unsure.
+
+    Returns the plan for the second call (the first one is recorded
+    here), or None to keep the reply as it is.
+    """
+    if reply is None:
+        return None
+    route, reason = model_router.escalation_for(
+        plan["route"], reply, usage.output_tokens if usage is not None else 0
+    )
+    if route is None:
+        return None
+    remaining = deadline - time.monotonic()
+    reserved_tokens = plan["reserved_tokens"] - plan["route"].max_tokens + route.max_tokens
+    if remaining <= 0 or not claude_token_budget.reserve(reserved_tokens):
+        return None  # the fast reply is better than none
+    logger.info("User %s: %s reply looks unsure (%s), asking %s", user_id, plan["route"].name, reason, route.model)
+    record_claude_call(user_id, plan, timing["generation"], usage)
+    model_router.record_escalation(plan["route"], reason)
+    metrics.CLAUDE_ESCALATIONS_TOTAL.inc(route=plan["route"].name, reason=reason)
+    timing["escalated"] = reason
+    request_args = dict(plan["request_args"], model=route.model, max_tokens=route.max_tokens, timeout=remaining)
+    return dict(plan, route=route, request_args=request_args, reserved_tokens=reserved_tokens)
+
+def finish_claude_reply(user_id, user_message, plan, reply, usage, timing):
+    """Record a Claude reply (or a missed deadline if reply is None)."""
+    mode = plan["mode"]
+    record_claude_call(user_id, plan, timing["generation"], usage, failed=reply is None)
+    if tracer.enabled:
+        timing["_trace"] = (plan, reply, usage)
+    if reply is None:
+        logger.warning("User %s: Claude missed the reply deadline, handing off", user_id)
+        timing["deadline_exceeded"] = True
+        metrics.CLAUDE_ERRORS_TOTAL.inc(kind="deadline")
+        return HANDOFF_FALLBACK_REPLY
+    metrics.REPLIES_TOTAL.inc(mode=mode)
+    if mode == "A":
+        reply = reply.replace("{form_link}", get_form_link(user_id))
+    if plan["cacheable"] and not detect_handoff_trigger(reply):
+        reply_cache.put(
+            mode, user_message, reply,
+            seconds=timing["generation"],
+            output_tokens=usage.output_tokens if usage is not None else 0,
         )
-        reply = response.content[0].text
-        add_to_history(user_id, "assistant", reply)
-        return reply
-    except Exception as e:
-        logger.error(f"Claude API error: {e}")
-        return "ขอโทษนะคะ ระบบมีปัญหาทางเทคนิคค่ะ ทีมจะติดต่อกลับเร็วๆ นี้นะคะ [HANDOFF]"
+    add_to_history(user_id, "assistant", reply)
+    return reply
+
+def within_deadline(request_args, deadline):
+    """Request arguments whose timeout ends at the reply deadline.
+
+    Reply calls go through the client with max_retries=0: the SDK would
+    retry a timed-out call with a fresh timeout, well past the deadline.
+    """
+    return dict(request_args, timeout=max(0.1, deadline - time.monotonic()))
+
+def claude_reply_failed(user_id, plan, error, timing):
+    import anthropic  # already loaded by the client
+    rate_limited = isinstance(error, anthropic.RateLimitError)
+    record_claude_call(user_id, plan, timing["generation"], None, failed=True, rate_limited=rate_limited)
+    timing["error"] = type(error).__name__
+    if tracer.enabled:
+        timing["_trace"] = (plan, None, None)
+    metrics.CLAUDE_ERRORS_TOTAL.inc(kind=type(error).__name__)
+    if rate_limited:
+        # Anthropic's own limit: ask the customer to try again rather
+        # than handing off to the team
+        logger.warning("User %s: Anthropic rate limit hit, sending busy reply", user_id)
+        timing["rate_limited"] = "anthropic"
+        metrics.RATE_LIMITED_TOTAL.inc(limit="anthropic")
+        add_to_history(user_id, "assistant", CLAUDE_BUSY_REPLY)
+        return CLAUDE_BUSY_REPLY
+    logger.error("Claude API error: %s", error)
+    return HANDOFF_FALLBACK_REPLY
+
+def claude_unavailable(user_id, plan, timing):
+    """Claude's breaker is open: fail fast and leave the message to the team."""
+    logger.warning("User %s: Claude circuit open - no reply, message left for the team", user_id)
+    timing["circuit_open"] = True
+    metrics.CLAUDE_ERRORS_TOTAL.inc(kind="circuit_open")
+    claude_token_budget.settle(plan["reserved_tokens"], 0)
+    return None
+
+def claude_slot_acquired(plan, timing, waited):
+    timing["slot_wait"] = waited
+    metrics.CLAUDE_SLOT_WAIT_SECONDS.observe(waited)
+    with _claude_slot_lock:
+        claude_slot_stats["in_flight"] += 1
+        claude_slot_stats["waited"] += 1 if waited > 0.001 else 0
+
+def claude_slot_released():
+    with _claude_slot_lock:
+        claude_slot_stats["in_flight"] -= 1
+
+def claude_slot_timed_out(user_id, plan, timing):
+    """No Claude slot came free before the reply deadline."""
+    logger.warning("User %s: no free Claude slot before the deadline, sending busy reply", user_id)
+    timing["rate_limited"] = "concurrency"
+    metrics.RATE_LIMITED_TOTAL.inc(limit="concurrency")
+    with _claude_slot_lock:
+        claude_slot_stats["timed_out"] += 1
+    claude_token_budget.settle(plan["reserved_tokens"], 0)
+    add_to_history(user_id, "assistant", CLAUDE_BUSY_REPLY)
+    return CLAUDE_BUSY_REPLY
+
+def _stream_claude_reply(request_args, deadline, started, timing):
+    """Stream a Claude reply, stopping as soon as it is complete.
+
+    Returns (reply, usage). The reply is None if the deadline passed
+    before the reply was complete.
+    """
+    parts = []
+    tail = ""
+    with claude_client.with_options(max_retries=0).messages.stream(**within_deadline(request_args, deadline)) as stream:
+        for text in stream.text_stream:
+            if not parts:
+                timing["first_token"] = time.monotonic() - started
+            parts.append(text)
+            # [HANDOFF] always goes at the end, so once it's there we're done
+            tail = (tail + text)[-32:]
+            if "[HANDOFF]" in tail:
+                timing["stopped_early"] = True
+                break
+            if time.monotonic() > deadline:
+                return None, stream.current_message_snapshot.usage
+        usage = stream.current_message_snapshot.usage
+    return "".join(parts), usage
+
+# ============================================================
+# REPLY TIMING
+# Per-stage timings for recent replies (shown in /health)
+# ============================================================
+recent_reply_timings = deque(maxlen=200)
+
+tracer = TraceRecorder(
+    TRACE_DIR, sample_rate=TRACE_SAMPLE_RATE,
+    max_file_bytes=int(TRACE_MAX_FILE_MB * 1_000_000), max_files=TRACE_MAX_FILES,
+)
+
+def record_reply_timing(user_id, timing):
+    """Keep a reply's stage timings and log them (and trace the reply)."""
+    claude_call = timing.pop("_trace", None)
+    recent_reply_timings.append(timing)
+    logger.info("User %s: reply timing %s", user_id, log_pipeline.Deferred(_timing_stages, timing))
+    if tracer.sampled():
+        tracer.record("reply", **reply_trace(user_id, timing, claude_call))
+
+def reply_trace(user_id, timing, claude_call):
+    """What bench/replay.py needs to ask Claude the same question again."""
+    trace = {
+        "user": hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:12],
+        "prompt_version": PROMPT_VERSION,
+        "mode": timing.get("mode"),
+        "route": timing.get("route"),
+        "timings": {k: round(v, 4) for k, v in timing.items() if isinstance(v, float)},
+        # e.g. reply_cache_hit, rate_limited, escalated, deadline_exceeded, error
+        "flags": {k: v for k, v in timing.items() if not isinstance(v, float) and k not in ("mode", "route")},
+    }
+    if claude_call is None:
+        return trace
+    plan, reply, usage = claude_call
+    request_args = plan["request_args"]
+    system_blocks = request_args["system"]
+    trace.update(
+        route=plan["route"].name,
+        model=request_args["model"],
+        max_tokens=request_args["max_tokens"],
+        # The mode prompt itself is identified by prompt_version; only its size is kept
+        prompt_tokens=estimate_tokens(system_blocks[0]["text"]),
+        system_extra=[block["text"] for block in system_blocks[1:]],
+        messages=list(request_args["messages"]),
+        reply=reply,
+        usage=None if usage is None else {
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+        },
+        # A missed deadline or failed call gets the handoff fallback
+        handoff=reply is None or detect_handoff_trigger(reply),
+    )
+    return trace
+
+def trace_webhook(events, started, forwarding_only_mode=False):
+    """Trace one webhook: what arrived and how long the acknowledgement took."""
+    if tracer.sampled():
+        tracer.record(
+            "webhook",
+            events=len(events),
+            types=[f"{e.get('type')}.{e['message'].get('type')}" if "message" in e else e.get("type") for e in events],
+            ack_seconds=round(time.monotonic() - started, 4),
+            forwarding_only=forwarding_only_mode,
+        )
+
+def _timing_stages(timing):
+    return " ".join(f"{k}={v:.3f}s" for k, v in timing.items() if isinstance(v, float))
+
+def reply_timing_summary():
+    """Average and max of each stage over the recent replies."""
+    summary = {}
+    for timing in list(recent_reply_timings):
+        for stage, value in timing.items():
+            if not isinstance(value, float):
+                continue
+            entry = summary.setdefault(stage, {"count": 0, "avg": 0.0, "max": 0.0})
+            entry["count"] += 1
+            entry["avg"] += value
+            entry["max"] = max(entry["max"], value)
+    for entry in summary.values():
+        entry["avg"] = round(entry["avg"] / entry["count"], 3)
+        entry["max"] = round(entry["max"], 3)
+    return summary
+
+# ============================================================
+# EVENT PROCESSING
+# ============================================================
+FORM_DONE_REPLY = (
+    "ขอบคุณน้องมากค่ะ 😊\n\n"
+    "ทีมงานได้รับข้อมูลจากแบบฟอร์มแล้วค่ะ "
+    "จะมีทีมติดต่อกลับไปให้น้องเร็วๆ นี้เลยค่ะ "
+    "พร้อมกับแนะนำตัวเลือกที่พักที่เหมาะกับความต้องการของน้องโดยเฉพาะเลยนะคะ\n\n"
+    "รอติดต่อกลับไปนะคะ ขอบคุณค่ะ"
+)
+
+def handle_event(event):
+    """Process a single LINE event (Claude reply, LINE reply, notifications)."""
+    if not is_text_message(event):
+        reply_token, messages = quick_reply_for(event.get("_quick_events", [event]))
+        if reply_token and messages:
+            reply_messages_to_line(reply_token, messages, push_target(event), event.get("_received_at"))
+        return
+
+    target = event_target(event)
+    if target is None:
+        return
+    reply_token, user_id, message = target
+
+    # Claude may have been switched off since this event was queued
+    if forwarding_only():
+        logger.info("Forwarding only mode - not answering %s", user_id)
+        return
+
+    clean_old_histories()
+
+    # ============================================================
+    # CHECK FORM STATUS (reads from PERSISTENT file storage)
+    # ============================================================
+    form_completed, form_link_sent = form_store.status(user_id)
+
+    user_text = message.get("text", "")
+    logger.info(
+        "User %s: %s | completed=%s | link_sent=%s",
+        user_id, log_pipeline.UserText(user_text), form_completed, form_link_sent,
+    )
+
+    # CHECK: Did the user just say they completed the form?
+    received_at = event.get("_received_at", time.monotonic())
+    form_done_reply = None
+    if not form_completed:
+        done, rest = split_form_done(event, user_text)
+        if done:
+            form_done_reply = handle_form_done(user_id, "\n".join(done))
+            if not rest:
+                reply_to_line(reply_token, form_done_reply, push_target(event), received_at)
+                return
+            # Messages sent together with it still get an answer (now MODE B)
+            form_completed, user_text = True, "\n".join(rest)
+
+    # Regular text message - get Claude reply with correct MODE
+    timing = {"queued": time.monotonic() - received_at}
+    reply = get_jenny_reply(
+        user_id, user_text, form_completed, form_link_sent,
+        deadline=received_at + REPLY_DEADLINE_SECONDS, timing=timing,
+    )
+    if reply is None:
+        if form_done_reply is not None:
+            reply_to_line(reply_token, form_done_reply, push_target(event), received_at)
+        return
+    clean_reply = after_claude_reply(user_id, user_text, reply)
+    line_started = time.monotonic()
+    reply_messages_to_line(reply_token, reply_messages(form_done_reply, clean_reply), push_target(event), received_at)
+    timing["line_post"] = time.monotonic() - line_started
+    timing["total"] = time.monotonic() - received_at
+    record_reply_timing(user_id, timing)
+    metrics.REPLY_TOTAL_SECONDS.observe(timing["total"], mode=timing.get("mode", ""))
+
+# The pieces of handle_event that don't talk to the network, shared with
+# the async server (asgi_app.py)
+def event_target(event):
+    """Count the event; return (reply_token, user_id, message) if it needs a reply."""
+    metrics.EVENTS_TOTAL.inc(
+        event_type=event.get("type", ""), message_type=event.get("message", {}).get("type", "")
+    )
+    if event.get("type") != "message":
+        return None
+
+    reply_token = event.get("replyToken", "")
+    user_id = event.get("source", {}).get("userId", "")
+    if not reply_token or not user_id:
+        return None
+    return reply_token, user_id, event.get("message", {})
+
+def split_form_done(event, user_text):
+    """(form-done texts, other texts) among the customer's messages in an event.
+
+    A coalesced event is checked message by message, so "กรอกแล้วค่ะ"
+    followed by a question gets the form-done reply and an answer.
+    Messages that are only "ขอบคุณค่ะ", "ok" and the like need no answer.
+    """
+    done, rest = [], []
+    for text in event.get("_texts") or [user_text]:
+        if check_if_user_says_form_done(text):
+            done.append(text)
+        elif not form_done_matcher.is_filler(text):
+            rest.append(text)
+    return done, rest
+
+def reply_messages(*texts):
+    """LINE text messages for the texts that aren't None (one reply, in order)."""
+    return [{"type": "text", "text": text} for text in texts if text is not None]
+
+def handle_form_done(user_id, user_text):
+    """The customer says they filled in the form: save it, tell the team, return the reply."""
+    mark_form_completed(user_id)
+    logger.info("User %s says form is completed!", user_id)
+    metrics.HANDOFFS_TOTAL.inc(reason="form_completed")
+    send_team_notification(user_text, "customer_needs_help")
+    return strip_handoff_tag(FORM_DONE_REPLY)
+
+def after_claude_reply(user_id, user_text, reply):
+    """Track the form link and handoffs in a Claude reply; return the text to send."""
+    # If Claude's reply contains the form link, mark it as sent
+    if ZOHO_FORM_BASE_URL in reply:
+        mark_form_link_sent(user_id)
+
+    # Check if this reply triggers a handoff to team
+    if detect_handoff_trigger(reply):
+        logger.info("Handoff triggered for user %s", user_id)
+        metrics.HANDOFFS_TOTAL.inc(reason="claude")
+        send_team_notification(user_text, "customer_needs_help")
+
+    # ALWAYS strip [HANDOFF] tag before sending to customer
+    return strip_handoff_tag(reply)
+
+# ============================================================
+# NON-TEXT EVENTS (stickers, images, files, locations, follow, unfollow, postback)
+# Answered from a table of handlers with ready-made replies: no Claude,
+# no history, and at most one form-status read (images only). All of a
+# user's non-text events in one webhook get a single LINE reply.
+# ============================================================
+MAX_MESSAGES_PER_REPLY = 5  # LINE's limit per reply call
+
+def _text_message(text):
+    return {"type": "text", "text": text}
+
+IMAGE_REPLY_FORM_DONE = _text_message("ได้รับรูปแล้วค่ะ 😊 มีอะไรให้ช่วยดูไหมคะ?")
+IMAGE_REPLY_WAITING_FOR_FORM = _text_message(
+    "ได้รับรูปแล้วค่ะ 😊 กรอกฟอร์มเสร็จแล้วบอกเราด้วยนะคะ จะได้ช่วยน้องต่อได้เลยค่ะ"
+)
+MEDIA_REPLY = _text_message(
+    "ได้รับแล้วค่ะ 😊 ทีมงานตอบได้ทางข้อความนะคะ "
+    "พิมพ์คำถามมาได้เลยค่ะ ยินดีช่วยเหลือค่ะ"
+)
+LOCATION_REPLY = _text_message(
+    "ได้รับตำแหน่งแล้วค่ะ 📍 ถ้าอยากหาที่พักแถวนี้ "
+    "พิมพ์บอกชื่อมหาวิทยาลัยหรือย่านที่สนใจมาได้เลยนะคะ"
+)
+
+def _no_reply(user_id, event):
+    return []
+
+def _image_reply(user_id, event):
+    form_completed, form_link_sent = form_store.status(user_id)
+    if form_completed:
+        return [IMAGE_REPLY_FORM_DONE]
+    if form_link_sent:
+        return [IMAGE_REPLY_WAITING_FOR_FORM]
+    mark_form_link_sent(user_id)
+    return [_text_message(
+        f"ได้รับรูปแล้วค่ะ 😊 ทีมงานดูรูปไม่ได้ "
+        f"แต่ยินดีช่วยเหลือเรื่องที่พักนะคะ "
+        f"รบกวนกรอกฟอร์มนี้ให้เราก่อนนะคะ {get_form_link(user_id)}"
+    )]
+
+def _media_reply(user_id, event):
+    return [MEDIA_REPLY]
+
+def _location_reply(user_id, event):
+    return [LOCATION_REPLY]
+
+def _unfollow(user_id, event):
+    forget_user(user_id)
+    return []
+
+# (event type, message type) -> handler(user_id, event) returning LINE message objects
+QUICK_EVENT_HANDLERS = {
+    ("message", "sticker"): _no_reply,
+    ("message", "image"): _image_reply,
+    ("message", "audio"): _media_reply,
+    ("message", "video"): _media_reply,
+    ("message", "file"): _media_reply,
+    ("message", "location"): _location_reply,
+    ("follow", ""): _no_reply,
+    ("unfollow", ""): _unfollow,
+    ("postback", ""): _no_reply,
+}
+
+def quick_reply_for(events):
+    """Run the handlers for one user's non-text events.
+
+    Returns (reply_token, messages): the replies merged into one LINE
+    call (each handler runs once), answered with the first event's token.
+    """
+    # Claude may have been switched off since these events were queued
+    if forwarding_only():
+        return None, []
+    reply_token = None
+    messages = []
+    handled = set()
+    for event in events:
+        event_type = event.get("type", "")
+        message_type = event.get("message", {}).get("type", "")
+        metrics.EVENTS_TOTAL.inc(event_type=event_type, message_type=message_type)
+        user_id = event.get("source", {}).get("userId", "")
+        handler = QUICK_EVENT_HANDLERS.get((event_type, message_type))
+        if handler is None or not user_id:
+            logger.info("Ignoring %s event (%s)", event_type, message_type or "no message")
+            continue
+        # e.g. three photos in a row get one "photo received" reply
+        if handler not in handled:
+            handled.add(handler)
+            for reply in handler(user_id, event):
+                if reply not in messages:
+                    messages.append(reply)
+        if reply_token is None and event.get("replyToken"):
+            reply_token = event["replyToken"]
+    return reply_token, messages[:MAX_MESSAGES_PER_REPLY]
+
+def forget_user(user_id):
+    """Drop what we keep about a user who blocked the bot (form tracking stays)."""
+    history_store.clear(user_id)
+    user_rate_limiter.forget(user_id)
+    logger.info("User %s unfollowed - conversation history cleared", user_id)
+
+def process_event(event):
+    """handle_event, logging under the request ID of the webhook it came in."""
+    with log_pipeline.request_context(event.get("_request_id")):
+        handle_event(event)
+
+# Background worker pool (used when ASYNC_EVENT_PROCESSING or coalescing is on)
+event_queue = EventQueue(process_event, workers=EVENT_WORKERS, max_size=EVENT_QUEUE_SIZE)
+
+def dispatch_event(event, background=True):
+    """Process an event on the background queue, or inline."""
+    if background:
+        # Events for the same user stay in order on the same worker
+        user_id = event.get("source", {}).get("userId", "")
+        if event_queue.submit(user_id, event):
+            return
+        logger.warning("Event queue full - processing event for %s inline", user_id)
+    process_event(event)
+
+def is_text_message(event):
+    return event.get("type") == "message" and event.get("message", {}).get("type") == "text"
+
+def batch_events(events, received_at):
+    """The events of one webhook, in the order to process them.
+
+    Redelivered duplicates are dropped. Each user's non-text events are
+    merged into one event (answered with a single LINE reply), which
+    comes before that user's next text message so the order is kept.
+    """
+    quick = {}
+    for event in events:
+        if is_duplicate_event(event):
+            continue
+        # Reply deadlines are measured from when the webhook arrived
+        event["_received_at"] = received_at
+        event["_request_id"] = log_pipeline.request_id.get()
+        user_id = event.get("source", {}).get("userId", "")
+        if not is_text_message(event):
+            merged = quick.get(user_id)
+            if merged is None:
+                quick[user_id] = {
+                    "type": "_quick",
+                    "source": event.get("source", {}),
+                    "_received_at": received_at,
+                    "_request_id": event["_request_id"],
+                    "_quick_events": [event],
+                }
+            else:
+                merged["_quick_events"].append(event)
+            continue
+        if user_id in quick:
+            yield quick.pop(user_id)
+        yield event
+    yield from quick.values()
+
+# Merges a user's rapid-fire text messages into one Claude turn.
+# Merged events are always processed on the background queue.
+event_coalescer = EventCoalescer(
+    dispatch_event,
+    window=COALESCE_WINDOW_MS / 1000,
+    max_wait=COALESCE_MAX_WAIT_MS / 1000,
+)
+
+def drain_events():
+    """Answer held and queued events, then send pending handoff emails, before the process exits."""
+    flushed = event_coalescer.flush_all()
+    unfinished = event_queue.drain(EVENT_DRAIN_SECONDS)
+    if flushed or unfinished:
+        logger.info("Shutdown: flushed %s held users, %s events left unanswered", flushed, unfinished)
+    if unfinished:
+        logger.warning("Shutdown: %s queued events not answered within %ss", unfinished, EVENT_DRAIN_SECONDS)
+    # Last: the events answered above may have queued handoff emails
+    unsent = notification_dispatcher.flush(NOTIFICATION_FLUSH_SECONDS)
+    if unsent:
+        logger.warning("Shutdown: %s team notifications not sent within %ss", unsent, NOTIFICATION_FLUSH_SECONDS)
+
+# Runs when a gunicorn worker exits normally (SIGTERM on deploy); worker
+# threads are daemons, so without this their queued events would be lost
+atexit.register(drain_events)
 
 # ============================================================
 # MAIN WEBHOOK ENDPOINT
@@ -344,19 +1546,25 @@ def get_jenny_reply(user_id, user_message, form_completed=False, form_link_sent=
 @app.route("/callback", methods=["POST"])
 def callback():
     """Main webhook endpoint - receives all LINE events."""
+    started = time.monotonic()
+    log_pipeline.new_request_id()
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
 
-    if not verify_signature(body, signature):
+    with metrics.SIGNATURE_SECONDS.time():
+        valid = verify_signature(body, signature)
+    if not valid:
         logger.warning("Invalid signature")
         abort(400)
 
-    # STEP 1: Forward EVERYTHING to Zoho
-    forward_to_zoho(body, dict(request.headers))
+    # STEP 1: Forward EVERYTHING to Zoho (raw bytes, in the background)
+    forward_to_zoho_background(request.get_data(), dict(request.headers))
 
     # STEP 2: Process with Claude if applicable
-    if FORWARDING_ONLY:
+    if forwarding_only():
         logger.info("Forwarding only mode - skipping Claude")
+        maybe_probe_claude()
+        trace_webhook([], started, forwarding_only_mode=True)
         return "OK"
 
     try:
@@ -365,108 +1573,105 @@ def callback():
         logger.error("Invalid JSON body")
         return "OK"
 
-    for event in events:
-        if event.get("type") != "message":
-            continue
-
-        reply_token = event.get("replyToken", "")
-        user_id = event.get("source", {}).get("userId", "")
-        message = event.get("message", {})
-        message_type = message.get("type", "")
-
-        if not reply_token or not user_id:
-            continue
-
-        clean_old_histories()
-
-        # ============================================================
-        # CHECK FORM STATUS (reads from PERSISTENT file storage)
-        # ============================================================
-        form_completed = has_form_been_completed(user_id)
-        form_link_sent = has_form_link_been_sent(user_id)
-
-        if message_type == "text":
-            user_text = message.get("text", "")
-            logger.info(f"User {user_id}: {user_text[:50]}... | completed={form_completed} | link_sent={form_link_sent}")
-
-            # CHECK: Did the user just say they completed the form?
-            if not form_completed and check_if_user_says_form_done(user_text):
-                mark_form_completed(user_id)
-                form_completed = True
-                logger.info(f"User {user_id} says form is completed!")
-
-                reply = (
-                    "ขอบคุณน้องมากค่ะ 😊\n\n"
-                    "ทีมงานได้รับข้อมูลจากแบบฟอร์มแล้วค่ะ "
-                    "จะมีทีมติดต่อกลับไปให้น้องเร็วๆ นี้เลยค่ะ "
-                    "พร้อมกับแนะนำตัวเลือกที่พักที่เหมาะกับความต้องการของน้องโดยเฉพาะเลยนะคะ\n\n"
-                    "รอติดต่อกลับไปนะคะ ขอบคุณค่ะ"
-                )
-                clean_reply = strip_handoff_tag(reply)
-                reply_to_line(reply_token, clean_reply)
-                send_team_notification(user_text, "customer_needs_help")
+    for event in batch_events(events, time.monotonic()):
+        if COALESCE_WINDOW_MS > 0:
+            user_id = event.get("source", {}).get("userId", "")
+            if is_text_message(event):
+                # Hold it briefly in case more messages from this user follow
+                event_coalescer.add(user_id, event)
                 continue
+            # Anything else: send held texts first so the order is kept
+            event_coalescer.flush_user(user_id)
+        # With coalescing on, everything goes through the queue so a user's
+        # held texts and later events are still processed in order
+        dispatch_event(event, background=ASYNC_EVENT_PROCESSING or COALESCE_WINDOW_MS > 0)
 
-            # Regular text message - get Claude reply with correct MODE
-            reply = get_jenny_reply(user_id, user_text, form_completed, form_link_sent)
-
-            # If Claude's reply contains the form link, mark it as sent
-            if ZOHO_FORM_BASE_URL in reply:
-                mark_form_link_sent(user_id)
-
-            # Check if this reply triggers a handoff to team
-            if detect_handoff_trigger(reply):
-                logger.info(f"Handoff triggered for user {user_id}")
-                send_team_notification(user_text, "customer_needs_help")
-
-            # ALWAYS strip [HANDOFF] tag before sending to customer
-            clean_reply = strip_handoff_tag(reply)
-            reply_to_line(reply_token, clean_reply)
-
-        elif message_type == "sticker":
-            logger.info(f"Sticker from {user_id} - ignoring")
-            continue
-
-        elif message_type == "image":
-            if form_completed:
-                reply = "ได้รับรูปแล้วค่ะ 😊 มีอะไรให้ช่วยดูไหมคะ?"
-            elif form_link_sent:
-                reply = "ได้รับรูปแล้วค่ะ 😊 กรอกฟอร์มเสร็จแล้วบอกเราด้วยนะคะ จะได้ช่วยน้องต่อได้เลยค่ะ"
-            else:
-                form_link = f"{ZOHO_FORM_BASE_URL}?Line_ID={user_id}"
-                reply = (
-                    f"ได้รับรูปแล้วค่ะ 😊 ทีมงานดูรูปไม่ได้ "
-                    f"แต่ยินดีช่วยเหลือเรื่องที่พักนะคะ "
-                    f"รบกวนกรอกฟอร์มนี้ให้เราก่อนนะคะ {form_link}"
-                )
-                mark_form_link_sent(user_id)
-            reply_to_line(reply_token, reply)
-
-        elif message_type in ("audio", "video", "file"):
-            reply = (
-                "ได้รับแล้วค่ะ 😊 ทีมงานตอบได้ทางข้อความนะคะ "
-                "พิมพ์คำถามมาได้เลยค่ะ ยินดีช่วยเหลือค่ะ"
-            )
-            reply_to_line(reply_token, reply)
-        else:
-            logger.info(f"Ignoring message type: {message_type}")
-
+    trace_webhook(events, started)
     return "OK"
 
+# ============================================================
+# METRICS ENDPOINT (Prometheus text format)
+# ============================================================
+metrics.Gauge("bot_event_queue_depth", "Events waiting in the background queue", event_queue.depth)
+metrics.Gauge("bot_coalescer_pending_users", "Users with held messages", event_coalescer.pending_users)
+metrics.Gauge("bot_notification_queue_depth", "Team notifications waiting to be sent", notification_dispatcher.pending)
+metrics.Gauge("bot_outbox_pending", "Zoho forwards and LINE messages waiting to be sent again",
+              lambda: sum(outbox.pending().values()))
+metrics.Gauge("bot_active_conversations", "Users with chat history", history_store.count)
+metrics.Gauge("bot_form_completed_users", "Users who completed the form", lambda: form_store.counts()["completed"])
+metrics.Gauge("bot_form_link_sent_users", "Users who got the form link", lambda: form_store.counts()["link_sent"])
+metrics.Gauge("bot_claude_in_flight", "Claude calls running now", lambda: claude_slot_stats["in_flight"])
+metrics.Gauge("bot_forwarding_only", "1 if Claude replies are disabled", lambda: int(forwarding_only()))
+for _b in (claude_breaker, line_breaker, zoho_breaker):
+    metrics.Gauge(f"bot_{_b.name}_circuit_open", f"1 if the {_b.name} circuit breaker is not closed",
+                  lambda b=_b: int(b.state != "closed"))
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # ============================================================
 # HEALTH CHECK ENDPOINT
 # ============================================================
 @app.route("/health", methods=["GET"])
 def health():
+    # 503 until startup has finished, so nothing is routed to a cold worker
+    return health_status(), 200 if startup.ready else 503
+
+def health_status():
+    # Not waiting for the form store here: /health must answer during startup
+    form_counts = form_store.counts() if form_store.loaded else {"completed": None, "link_sent": None}
+    mode_values = _mode_values()
     return {
-        "status": "ok",
+        "status": "ok" if startup.ready else "starting",
+        "startup": startup.stats(),
         "bot": "Peyton & Charmed Team Bot",
         "forwarding": "active" if ZOHO_WEBHOOK_URL else "not configured",
         "claude": "active" if ANTHROPIC_API_KEY else "not configured",
-        "email_notifications": "active" if TEAM_EMAIL_ADDRESSES and SENDER_EMAIL else "not configured",
-        "mode": "forwarding_only" if FORWARDING_ONLY else "full",
-        "form_completed_users": len(form_completed_users),
-        "form_link_sent_users": len(form_link_sent_users)
+        "email_notifications": "active" if notification_dispatcher.is_configured() else "not configured",
+        "notifications": notification_dispatcher.stats(),
+        "mode": current_mode(),
+        "auto_forwarding_only": {
+            "enabled": AUTO_FORWARDING_ONLY,
+            "reason": mode_values.get("mode.auto_reason"),
+            "next_check_in_seconds": (
+                round(max(0.0, float(mode_values["mode.auto_probe_at"]) - time.time()), 1)
+                if "mode.auto_probe_at" in mode_values else None
+            ),
+        },
+        "circuit_breakers": {b.name: b.stats() for b in (claude_breaker, line_breaker, zoho_breaker)},
+        "outbox": outbox.stats(),
+        "form_completed_users": form_counts["completed"],
+        "form_link_sent_users": form_counts["link_sent"],
+        "state_backend": STATE_BACKEND,
+        "active_conversations": history_store.count(),
+        "event_processing": "background" if ASYNC_EVENT_PROCESSING else "inline",
+        "event_queue": event_queue.stats(),
+        "coalescing": {
+            "window_ms": COALESCE_WINDOW_MS,
+            "pending_users": event_coalescer.pending_users(),
+            "merged_events": event_coalescer.merged_events,
+        },
+        "prompt_cache": dict(prompt_cache_stats),
+        "reply_cache": reply_cache.stats(),
+        "dedup": dict(
+            dedup_stats,
+            enabled=seen_events is not None,
+            backend=DEDUP_BACKEND,
+            tracked_events=seen_events.count() if seen_events is not None else 0,
+        ),
+        "claude_streaming": CLAUDE_STREAMING,
+        "push_fallback": {"enabled": PUSH_FALLBACK, "max_reply_token_age_seconds": REPLY_TOKEN_MAX_AGE_SECONDS},
+        "campaigns": reminder_campaigns.stats(),
+        "model_routing": model_router.stats(),
+        "rate_limits": {
+            "user": user_rate_limiter.stats(),
+            "tokens": claude_token_budget.stats(),
+            "claude_slots": dict(claude_slot_stats, max=CLAUDE_MAX_CONCURRENT),
+        },
+        "reply_timings": reply_timing_summary(),
+        "traces": tracer.stats(),
+        "logging": log_pipeline.stats(),
     }
 
 # ============================================================
@@ -474,23 +1679,67 @@ def health():
 # ============================================================
 @app.route("/safety/forwarding-only", methods=["POST"])
 def enable_forwarding_only():
-    global FORWARDING_ONLY
-    FORWARDING_ONLY = True
+    set_forwarding_only(True)
     return {"status": "forwarding_only_enabled", "claude_replies": "disabled"}
 
 @app.route("/safety/full-mode", methods=["POST"])
 def enable_full_mode():
-    global FORWARDING_ONLY
-    FORWARDING_ONLY = False
+    set_forwarding_only(False)
     return {"status": "full_mode_enabled", "claude_replies": "enabled"}
 
+@app.route("/campaigns/reminders", methods=["GET"])
+def list_campaigns():
+    status, body = campaign_endpoint("list", request.headers.get("Authorization", ""), {})
+    return body, status
+
+@app.route("/campaigns/reminders/start", methods=["POST"])
+def start_campaign():
+    payload = request.get_json(silent=True) or {}
+    status, body = campaign_endpoint("start", request.headers.get("Authorization", ""), payload)
+    return body, status
+
+@app.route("/campaigns/reminders/cancel", methods=["POST"])
+def cancel_campaign():
+    payload = request.get_json(silent=True) or {}
+    status, body = campaign_endpoint("cancel", request.headers.get("Authorization", ""), payload)
+    return body, status
+
+# ============================================================
+# STARTUP
+# Loads the form store, imports the Anthropic SDK and opens
+# connections to LINE, Zoho and Anthropic on a background thread
+# (with FAST_STARTUP=false they run before the server starts)
+# ============================================================
+def prewarm_claude():
+    import anthropic
+    import httpx
+    try:
+        claude_client.with_options(max_retries=0).get("/v1/models", cast_to=httpx.Response)
+    except anthropic.APIStatusError:
+        pass  # any HTTP answer means the connection is open
+
+startup.add("form_store", load_form_store)
+if warmup.prewarm_blocking_clients:
+    startup.add("claude_client", claude_client.get)
+    if PREWARM_CONNECTIONS > 0:
+        startup.add("prewarm_line", lambda: line_http.prewarm(LINE_API_BASE_URL, PREWARM_CONNECTIONS))
+        if ZOHO_WEBHOOK_URL:
+            startup.add("prewarm_zoho", lambda: zoho_http.prewarm(ZOHO_WEBHOOK_URL, PREWARM_CONNECTIONS))
+        if ANTHROPIC_API_KEY:
+            startup.add("prewarm_claude", prewarm_claude)
+startup.start(background=FAST_STARTUP)
+# Picks up scheduled campaigns, and ones interrupted by a restart
+reminder_campaigns.start()
+# Sends what earlier runs couldn't
+outbox.start()
+
 # ============================================================
 # RUN
 # ============================================================
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    logger.info(f"Starting Peyton & Charmed Bot on port {port}")
-    logger.info(f"Zoho forwarding: {'active' if ZOHO_WEBHOOK_URL else 'NOT CONFIGURED'}")
-    logger.info(f"Claude replies: {'disabled' if FORWARDING_ONLY else 'active'}")
-    logger.info(f"Form tracking file: {FORM_DATA_FILE}")
+    logger.info("Starting Peyton & Charmed Bot on port %s", port)
+    logger.info("Zoho forwarding: %s", "active" if ZOHO_WEBHOOK_URL else "NOT CONFIGURED")
+    logger.info("Claude replies: %s", "disabled" if forwarding_only() else "active")
+    logger.info("Form tracking: %s store (%s)", FORM_STORE, FORM_DB_FILE if FORM_STORE == "sqlite" else FORM_DATA_FILE)
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,598 @@
+# ============================================================
+# Peyton & Charmed - Async (ASGI) Server
+# Same bot as app.py, but waiting on Claude, LINE and Zoho never
+# holds a worker: one process can serve hundreds of conversations
+# at once.
+# ============================================================
+# Run with:
+#   uvicorn asgi_app:application --host 0.0.0.0 --port $PORT
+#
+# Serves /callback, /health, /metrics and the /safety endpoints. All the
+# bot logic (modes, prompts, form tracking, history, reply cache,
+# notifications) is shared with app.py; only the network calls differ:
+# - Claude: anthropic.AsyncAnthropic
+# - LINE and Zoho: httpx.AsyncClient (pool sizes and timeouts from the
+#   same LINE_* / ZOHO_* settings as app.py)
+#
+# Form tracking, chat history, event dedup and the mode switch can live
+# in SQLite, whose writes may wait on a lock (busy_timeout 10 s). Every
+# bot call that touches them runs on a thread (asyncio.to_thread), so it
+# never stalls the event loop.
+
+import asyncio
+import json
+import time
+import logging
+
+import httpx
+
+import warmup
+# Set before app.py is imported: its blocking LINE / Zoho / Claude
+# clients aren't used here, so app.py shouldn't pre-warm them
+warmup.prewarm_blocking_clients = False
+
+import app as bot
+import log_pipeline
+import metrics
+from circuit_breaker import CircuitOpenError
+from coalescer import EventCoalescer
+from http_clients import site_root
+
+logger = logging.getLogger(__name__)
+
+def _create_claude_client():
+    import anthropic
+    return anthropic.AsyncAnthropic(api_key=bot.ANTHROPIC_API_KEY)
+
+# Built by the startup steps (the SDK import is too slow for the event loop)
+claude_client = warmup.Lazy("Async Claude client", _create_claude_client)
+
+# Created when the server starts (one set per server process)
+line_client = None
+zoho_client = None
+event_coalescer = None
+claude_slots = None
+_loop = None
+# This server's own startup steps; app.py's (form store) run as well
+async_startup = None
+
+# Background event tasks, and a lock per user so each customer's
+# events are still answered in order
+_event_tasks = set()
+_zoho_tasks = set()
+_user_locks = {}
+
+
+def _http_client(upstream):
+    connect_timeout, read_timeout = upstream.timeout
+    # The pool limits go on the transport: httpx ignores AsyncClient's
+    # `limits` when a transport is given
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        # Like app.py, only connection errors are retried (a reply token works once)
+        transport=httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=upstream.pool_size, max_keepalive_connections=upstream.pool_size),
+            retries=upstream.retries,
+        ),
+    )
+
+
+async def startup():
+    global line_client, zoho_client, event_coalescer, claude_slots, _loop, async_startup
+    _loop = asyncio.get_running_loop()
+    if bot.CLAUDE_MAX_CONCURRENT > 0:
+        claude_slots = asyncio.Semaphore(bot.CLAUDE_MAX_CONCURRENT)
+    line_client = _http_client(bot.line_http)
+    zoho_client = _http_client(bot.zoho_http)
+    event_coalescer = EventCoalescer(
+        lambda event: _loop.call_soon_threadsafe(spawn_event, event),
+        window=bot.COALESCE_WINDOW_MS / 1000,
+        max_wait=bot.COALESCE_MAX_WAIT_MS / 1000,
+    )
+
+    # Same steps as app.py's, with the async clients. They run on a
+    # thread; the pre-warm requests themselves are sent on this loop.
+    async_startup = warmup.Warmup(bot.STARTUP_TIMEOUT_SECONDS)
+    async_startup.add("claude_client", claude_client.get)
+    if bot.PREWARM_CONNECTIONS > 0:
+        async_startup.add("prewarm_line", _on_loop(_prewarm, line_client, bot.LINE_API_BASE_URL))
+        if bot.ZOHO_WEBHOOK_URL:
+            async_startup.add("prewarm_zoho", _on_loop(_prewarm, zoho_client, bot.ZOHO_WEBHOOK_URL))
+        if bot.ANTHROPIC_API_KEY:
+            async_startup.add("prewarm_claude", _on_loop(_prewarm_claude))
+    if bot.FAST_STARTUP:
+        async_startup.start()
+    else:
+        await asyncio.to_thread(async_startup.start, background=False)
+    forwarding_only = await asyncio.to_thread(bot.forwarding_only)
+    logger.info("Async server started (Claude replies: %s)", "disabled" if forwarding_only else "active")
+
+
+async def shutdown():
+    # Send held messages now, then let replies that are already being written finish
+    if event_coalescer is not None and event_coalescer.flush_all():
+        await asyncio.sleep(0)  # the flushed events are spawned via call_soon_threadsafe
+    pending = _event_tasks | _zoho_tasks
+    if pending:
+        logger.info("Waiting for %s background tasks before shutdown", len(pending))
+        await asyncio.wait(pending, timeout=bot.REPLY_DEADLINE_SECONDS)
+    # Handoff emails from those replies (and any still batching or retrying)
+    unsent = await asyncio.to_thread(bot.notification_dispatcher.flush, bot.NOTIFICATION_FLUSH_SECONDS)
+    if unsent:
+        logger.warning("Shutdown: %s team notifications not sent within %ss", unsent, bot.NOTIFICATION_FLUSH_SECONDS)
+    await line_client.aclose()
+    await zoho_client.aclose()
+    if claude_client.loaded:
+        await claude_client.close()
+
+
+def _on_loop(coroutine_function, *args):
+    """A startup step that runs a coroutine on the server's event loop."""
+    return lambda: asyncio.run_coroutine_threadsafe(coroutine_function(*args), _loop).result()
+
+
+async def _prewarm(client, url):
+    """Async version of Upstream.prewarm."""
+    root = site_root(url)
+    await asyncio.gather(*(client.head(root) for _ in range(bot.PREWARM_CONNECTIONS)))
+
+
+async def _prewarm_claude():
+    import anthropic
+    try:
+        await claude_client.with_options(max_retries=0).get("/v1/models", cast_to=httpx.Response)
+    except anthropic.APIStatusError:
+        pass  # any HTTP answer means the connection is open
+
+
+# ============================================================
+# ZOHO FORWARDING
+# ============================================================
+async def forward_to_zoho(body, headers, retries=0):
+    """Async version of app.forward_to_zoho (same outbox when Zoho won't take it)."""
+    if not bot.ZOHO_WEBHOOK_URL:
+        logger.warning("ZOHO_WEBHOOK_URL not set, skipping Zoho forwarding")
+        return
+    forward_headers = {
+        "Content-Type": headers.get("content-type", "application/json"),
+        "X-Line-Signature": headers.get("x-line-signature", ""),
+    }
+    for attempt in range(retries + 1):
+        try:
+            if await post_to_zoho(body, forward_headers):
+                return
+        except CircuitOpenError:
+            break
+        if attempt < retries:
+            await asyncio.sleep(0.5 * (2 ** attempt))
+    await asyncio.to_thread(bot.hold_zoho_forward, body, forward_headers)
+
+
+async def post_to_zoho(body, forward_headers):
+    """Async version of app.post_to_zoho."""
+    if not bot.zoho_breaker.allow():
+        metrics.ZOHO_FORWARD_SECONDS.observe(0.0, outcome="circuit_open")
+        raise CircuitOpenError("Zoho circuit open")
+    started = time.perf_counter()
+    try:
+        response = await zoho_client.post(bot.ZOHO_WEBHOOK_URL, content=body, headers=forward_headers)
+    except Exception as e:
+        bot.zoho_breaker.failure(time.perf_counter() - started)
+        metrics.ZOHO_FORWARD_SECONDS.observe(time.perf_counter() - started, outcome="exception")
+        logger.error("Failed to forward to Zoho: %s", e)
+        return False
+    elapsed = time.perf_counter() - started
+    bot.zoho_breaker.record(elapsed, failed=response.status_code >= 500)
+    metrics.ZOHO_FORWARD_SECONDS.observe(elapsed, outcome="ok" if response.status_code < 500 else "server_error")
+    logger.info("Forwarded to Zoho: status %s", response.status_code)
+    return response.status_code < 500
+
+
+async def forward_to_zoho_background(body, headers):
+    """Forward to Zoho without waiting for it; inline if too many are pending."""
+    if not bot.ZOHO_WEBHOOK_URL:
+        logger.warning("ZOHO_WEBHOOK_URL not set, skipping Zoho forwarding")
+        return
+    if len(_zoho_tasks) >= bot.ZOHO_FORWARD_MAX_PENDING:
+        logger.warning("Too many pending Zoho forwards - forwarding inline")
+        await forward_to_zoho(body, headers)
+        return
+    task = asyncio.create_task(forward_to_zoho(body, headers, retries=bot.ZOHO_FORWARD_RETRIES))
+    _zoho_tasks.add(task)
+    task.add_done_callback(_zoho_tasks.discard)
+
+
+# ============================================================
+# LINE MESSAGES
+# ============================================================
+async def reply_to_line(reply_token, text, push_to=None, received_at=None):
+    """Async version of app.reply_to_line."""
+    await reply_messages_to_line(reply_token, [{"type": "text", "text": text}], push_to, received_at)
+
+
+async def reply_messages_to_line(reply_token, messages, push_to=None, received_at=None):
+    """Async version of app.reply_messages_to_line (same push fallback)."""
+    if bot.push_instead_of_reply(push_to, received_at):
+        await push_to_line(push_to, messages, reason="expired")
+        return
+    held_push_to = push_to if bot.PUSH_FALLBACK else None
+    response = await post_to_line("reply", {"replyToken": reply_token, "messages": messages}, held_push_to)
+    if response is not None and bot.reply_token_rejected(push_to, response.status_code, response.text):
+        await push_to_line(push_to, messages, reason="invalid_token")
+
+
+async def push_to_line(to, messages, reason):
+    logger.warning("Reply token %s - pushing the reply to %s instead", reason, to)
+    metrics.PUSH_FALLBACKS_TOTAL.inc(reason=reason)
+    await post_to_line("push", {"to": to, "messages": messages}, to)
+
+
+async def post_to_line(api, data, push_to=None):
+    """Async version of app.post_to_line (same outbox for messages LINE didn't take)."""
+    url, headers = bot.line_api_request(api)
+    if not bot.line_breaker.allow():
+        metrics.LINE_ERRORS_TOTAL.inc(status="circuit_open")
+        if push_to:
+            await asyncio.to_thread(bot.hold_line_push, push_to, data["messages"], "circuit open")
+        else:
+            logger.error("LINE circuit open - %s not sent", api)
+        return None
+    started = time.perf_counter()
+    try:
+        response = await line_client.post(url, headers=headers, json=data)
+        elapsed = time.perf_counter() - started
+        if api == "reply":
+            metrics.LINE_REPLY_SECONDS.observe(elapsed)
+        bot.line_breaker.record(elapsed, failed=response.status_code >= 500)
+        logger.info("LINE %s: status %s", api, response.status_code)
+        if response.status_code != 200:
+            metrics.LINE_ERRORS_TOTAL.inc(status=response.status_code)
+            logger.error("LINE %s error: %s", api, response.text)
+            if response.status_code >= 500 and push_to:
+                await asyncio.to_thread(bot.hold_line_push, push_to, data["messages"], f"status {response.status_code}")
+        return response
+    except Exception as e:
+        bot.line_breaker.failure(time.perf_counter() - started)
+        metrics.LINE_ERRORS_TOTAL.inc(status="exception")
+        logger.error("Failed to %s on LINE: %s", api, e)
+        return None
+
+
+# ============================================================
+# CLAUDE
+# ============================================================
+async def get_jenny_reply(user_id, user_message, form_completed=False, form_link_sent=False,
+                          deadline=None, timing=None):
+    """Async version of app.get_jenny_reply (same modes, cache and deadline)."""
+    if timing is None:
+        timing = {}
+    if deadline is None:
+        deadline = time.monotonic() + bot.REPLY_DEADLINE_SECONDS
+
+    reply, plan = await asyncio.to_thread(
+        bot.prepare_claude_request, user_id, user_message, form_completed, form_link_sent, deadline, timing,
+    )
+    if plan is None:
+        return reply
+
+    # Wait for a free Claude slot, but never past the reply deadline
+    if claude_slots is not None:
+        waited = time.monotonic()
+        try:
+            await asyncio.wait_for(claude_slots.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            return await asyncio.to_thread(bot.claude_slot_timed_out, user_id, plan, timing)
+        bot.claude_slot_acquired(plan, timing, time.monotonic() - waited)
+    try:
+        if not bot.claude_breaker.allow():
+            return bot.claude_unavailable(user_id, plan, timing)
+        if not claude_client.loaded:
+            # Only before the startup steps have built it
+            await asyncio.to_thread(claude_client.get)
+        started = time.monotonic()
+        try:
+            while True:
+                if bot.CLAUDE_STREAMING:
+                    reply, usage = await _stream_claude_reply(plan["request_args"], deadline, started, timing)
+                else:
+                    response = await claude_client.with_options(max_retries=0).messages.create(
+                        **bot.within_deadline(plan["request_args"], deadline)
+                    )
+                    reply, usage = response.content[0].text, response.usage
+                    timing["first_token"] = time.monotonic() - started
+                timing["generation"] = time.monotonic() - started
+                escalated = bot.escalate_claude_request(user_id, plan, reply, usage, timing, deadline)
+                if escalated is None:
+                    break
+                plan = escalated
+                started = time.monotonic()
+            return await asyncio.to_thread(bot.finish_claude_reply, user_id, user_message, plan, reply, usage, timing)
+        except Exception as e:
+            timing["generation"] = time.monotonic() - started
+            return await asyncio.to_thread(bot.claude_reply_failed, user_id, plan, e, timing)
+    finally:
+        if claude_slots is not None:
+            bot.claude_slot_released()
+            claude_slots.release()
+
+
+async def _stream_claude_reply(request_args, deadline, started, timing):
+    """Async version of app._stream_claude_reply."""
+    parts = []
+    tail = ""
+    async with claude_client.with_options(max_retries=0).messages.stream(
+        **bot.within_deadline(request_args, deadline)
+    ) as stream:
+        async for text in stream.text_stream:
+            if not parts:
+                timing["first_token"] = time.monotonic() - started
+            parts.append(text)
+            # [HANDOFF] always goes at the end, so once it's there we're done
+            tail = (tail + text)[-32:]
+            if "[HANDOFF]" in tail:
+                timing["stopped_early"] = True
+                break
+            if time.monotonic() > deadline:
+                return None, stream.current_message_snapshot.usage
+        usage = stream.current_message_snapshot.usage
+    return "".join(parts), usage
+
+
+# ============================================================
+# EVENT PROCESSING
+# ============================================================
+async def handle_event(event):
+    """Async version of app.handle_event."""
+    if not bot.is_text_message(event):
+        reply_token, messages = await asyncio.to_thread(bot.quick_reply_for, event.get("_quick_events", [event]))
+        if reply_token and messages:
+            await reply_messages_to_line(reply_token, messages, bot.push_target(event), event.get("_received_at"))
+        return
+
+    target = bot.event_target(event)
+    if target is None:
+        return
+    reply_token, user_id, message = target
+
+    if await asyncio.to_thread(bot.forwarding_only):
+        logger.info("Forwarding only mode - not answering %s", user_id)
+        return
+
+    await asyncio.to_thread(bot.clean_old_histories)
+    form_completed, form_link_sent = await asyncio.to_thread(bot.form_store.status, user_id)
+
+    user_text = message.get("text", "")
+    logger.info(
+        "User %s: %s | completed=%s | link_sent=%s",
+        user_id, log_pipeline.UserText(user_text), form_completed, form_link_sent,
+    )
+
+    received_at = event.get("_received_at", time.monotonic())
+    form_done_reply = None
+    if not form_completed:
+        done, rest = bot.split_form_done(event, user_text)
+        if done:
+            form_done_reply = await asyncio.to_thread(bot.handle_form_done, user_id, "\n".join(done))
+            if not rest:
+                await reply_to_line(reply_token, form_done_reply, bot.push_target(event), received_at)
+                return
+            form_completed, user_text = True, "\n".join(rest)
+
+    timing = {"queued": time.monotonic() - received_at}
+    reply = await get_jenny_reply(
+        user_id, user_text, form_completed, form_link_sent,
+        deadline=received_at + bot.REPLY_DEADLINE_SECONDS, timing=timing,
+    )
+    if reply is None:
+        if form_done_reply is not None:
+            await reply_to_line(reply_token, form_done_reply, bot.push_target(event), received_at)
+        return
+    clean_reply = await asyncio.to_thread(bot.after_claude_reply, user_id, user_text, reply)
+    line_started = time.monotonic()
+    await reply_messages_to_line(
+        reply_token, bot.reply_messages(form_done_reply, clean_reply), bot.push_target(event), received_at,
+    )
+    timing["line_post"] = time.monotonic() - line_started
+    timing["total"] = time.monotonic() - received_at
+    bot.record_reply_timing(user_id, timing)
+    metrics.REPLY_TOTAL_SECONDS.observe(timing["total"], mode=timing.get("mode", ""))
+
+
+async def process_event(event):
+    """Handle an event after any earlier events from the same user."""
+    user_id = event.get("source", {}).get("userId", "")
+    entry = _user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            # A task has its own context, so this stays with this event
+            log_pipeline.request_id.set(event.get("_request_id"))
+            await handle_event(event)
+    except Exception:
+        logger.exception("Event worker error")
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[user_id]
+
+
+def spawn_event(event):
+    task = asyncio.create_task(process_event(event))
+    _event_tasks.add(task)
+    task.add_done_callback(_event_tasks.discard)
+
+
+async def dispatch_event(event, background=True):
+    """Process an event as a background task, or before answering LINE."""
+    if background:
+        if len(_event_tasks) < bot.EVENT_QUEUE_SIZE:
+            spawn_event(event)
+            return
+        logger.warning("Too many events in progress - processing event inline")
+    await process_event(event)
+
+
+# ============================================================
+# ENDPOINTS
+# ============================================================
+async def callback(headers, body):
+    """Main webhook endpoint - same steps as app.callback."""
+    started = time.monotonic()
+    log_pipeline.new_request_id()
+    signature = headers.get("x-line-signature", "")
+    text = body.decode("utf-8", "replace")
+
+    with metrics.SIGNATURE_SECONDS.time():
+        valid = bot.verify_signature(text, signature)
+    if not valid:
+        logger.warning("Invalid signature")
+        return 400, "text/plain", b"Bad Request"
+
+    await forward_to_zoho_background(body, headers)
+
+    if await asyncio.to_thread(bot.forwarding_only):
+        logger.info("Forwarding only mode - skipping Claude")
+        await asyncio.to_thread(bot.maybe_probe_claude)
+        bot.trace_webhook([], started, forwarding_only_mode=True)
+        return 200, "text/plain", b"OK"
+
+    try:
+        events = json.loads(text).get("events", [])
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON body")
+        return 200, "text/plain", b"OK"
+
+    # batch_events is a generator; list() runs it (and its dedup writes) on the thread
+    batched = await asyncio.to_thread(lambda: list(bot.batch_events(events, time.monotonic())))
+    for event in batched:
+        if bot.COALESCE_WINDOW_MS > 0:
+            user_id = event.get("source", {}).get("userId", "")
+            if bot.is_text_message(event):
+                event_coalescer.add(user_id, event)
+                continue
+            event_coalescer.flush_user(user_id)
+        await dispatch_event(event, background=bot.ASYNC_EVENT_PROCESSING or bot.COALESCE_WINDOW_MS > 0)
+
+    bot.trace_webhook(events, started)
+    return 200, "text/plain", b"OK"
+
+
+async def health(headers, body):
+    status = await asyncio.to_thread(bot.health_status)
+    ready = bot.startup.ready and async_startup.ready
+    status["status"] = "ok" if ready else "starting"
+    status["startup"]["async_steps"] = async_startup.stats()
+    status["server"] = "asgi"
+    status["event_tasks"] = {"in_progress": len(_event_tasks), "max": bot.EVENT_QUEUE_SIZE}
+    status["zoho_pending"] = len(_zoho_tasks)
+    del status["event_queue"]
+    status["coalescing"]["pending_users"] = event_coalescer.pending_users()
+    status["coalescing"]["merged_events"] = event_coalescer.merged_events
+    return 200 if ready else 503, "application/json", json.dumps(status).encode("utf-8")
+
+
+async def metrics_endpoint(headers, body):
+    return 200, "text/plain; version=0.0.4", metrics.render().encode("utf-8")
+
+
+async def enable_forwarding_only(headers, body):
+    await asyncio.to_thread(bot.set_forwarding_only, True)
+    return 200, "application/json", json.dumps({"status": "forwarding_only_enabled", "claude_replies": "disabled"}).encode()
+
+
+async def enable_full_mode(headers, body):
+    await asyncio.to_thread(bot.set_forwarding_only, False)
+    return 200, "application/json", json.dumps({"status": "full_mode_enabled", "claude_replies": "enabled"}).encode()
+
+
+async def _campaigns(action, headers, body):
+    # Campaigns are sent by app.py's thread (blocking client); this only manages them
+    try:
+        payload = json.loads(body) if body else {}
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    status, result = await asyncio.to_thread(bot.campaign_endpoint, action, headers.get("authorization", ""), payload)
+    return status, "application/json", json.dumps(result, ensure_ascii=False).encode("utf-8")
+
+
+async def list_campaigns(headers, body):
+    return await _campaigns("list", headers, body)
+
+
+async def start_campaign(headers, body):
+    return await _campaigns("start", headers, body)
+
+
+async def cancel_campaign(headers, body):
+    return await _campaigns("cancel", headers, body)
+
+
+ROUTES = {
+    "/callback": ("POST", callback),
+    "/health": ("GET", health),
+    "/metrics": ("GET", metrics_endpoint),
+    "/safety/forwarding-only": ("POST", enable_forwarding_only),
+    "/safety/full-mode": ("POST", enable_full_mode),
+    "/campaigns/reminders": ("GET", list_campaigns),
+    "/campaigns/reminders/start": ("POST", start_campaign),
+    "/campaigns/reminders/cancel": ("POST", cancel_campaign),
+}
+
+metrics.Gauge("bot_async_event_tasks", "Events being processed by the async server", lambda: len(_event_tasks))
+
+
+# ============================================================
+# ASGI APPLICATION
+# ============================================================
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _send_response(send, status, content_type, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    route = ROUTES.get(scope["path"])
+    if route is None:
+        await _send_response(send, 404, "text/plain", b"Not Found")
+        return
+    method, endpoint = route
+    if scope["method"] != method:
+        await _send_response(send, 405, "text/plain", b"Method Not Allowed")
+        return
+
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    body = await _read_body(receive)
+    status, content_type, response_body = await endpoint(headers, body)
+    await _send_response(send, status, content_type, response_body)
@@ -0,0 +1,116 @@
+# ============================================================
+# Benchmark: "form done" detection
+# Compares the compiled matcher (form_matcher.py) with the original
+# phrase-by-phrase scan, on speed and on a labelled message corpus.
+#
+# Run from the repo root:
+#   python bench/bench_form_matcher.py
+# ============================================================
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from form_matcher import FormDoneMatcher
+from system_prompt import FORM_DONE_PHRASES, FORM_DONE_SHORT_REPLIES
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "form_done_corpus.jsonl")
+
+# The phrase list and scan used before the compiled matcher
+LEGACY_PHRASES = [
+    "กรอกแล้ว", "กรอกเรียบร้อย", "เรียบร้อยแล้ว",
+    "เรียบร้อยค่ะ", "เรียบร้อยครับ", "กรอกเสร็จ",
+    "ส่งแล้ว", "ส่งฟอร์มแล้ว", "ทำแล้ว",
+    "ทำเสร็จแล้ว", "เสร็จแล้ว", "เสร็จแล้วค่ะ",
+    "เสร็จแล้วครับ", "กรอกเรียบร้อยค่ะ", "กรอกเรียบร้อยครับ",
+    "กรอกเรียบร้อยค่า", "กรอกเรียบร้อยคะ",
+    "ส่งแล้วค่ะ", "ส่งแล้วครับ", "ส่งไปแล้ว",
+    "ทำเรียบร้อย", "เรียบร้อย", "กรอกฟอร์มแล้ว",
+    "กรอกฟอร์มเรียบร้อย", "กรอกฟอร์มเสร็จ",
+    "กรอกแล้วครับ", "กรอกแล้วค่ะ", "กรอกแล้วค่า",
+    "done", "completed", "finished", "submitted",
+    "filled out", "filled in", "already filled",
+    "already done", "already completed", "i filled",
+    "i completed", "form done", "form completed", "form submitted",
+]
+
+
+# Everyday messages that mention no "done" phrase at all - most traffic looks like this
+EVERYDAY_MESSAGES = [
+    "สวัสดีค่ะ สนใจหอพักนักศึกษาที่แมนเชสเตอร์ค่ะ",
+    "ห้องแบบ en-suite ราคาประมาณเท่าไหร่คะ",
+    "ต้องจ่ายมัดจำก่อนไหมคะ แล้วถ้ายกเลิกได้เงินคืนไหม",
+    "Hi, I'm starting at King's College in September, do you have studios nearby?",
+    "Can my parents be the guarantor?",
+    "ขอบคุณค่ะ",
+    "สัญญาเช่ากี่เดือนคะ 51 สัปดาห์หรือ 44 สัปดาห์",
+    "What is included in the rent? Bills, wifi, gym?",
+] * 4
+
+
+def legacy_matches(message):
+    message_lower = message.lower().strip()
+    for phrase in LEGACY_PHRASES:
+        if phrase in message_lower:
+            return True
+    return False
+
+
+def load_corpus():
+    with open(CORPUS_FILE, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def score(predict, corpus):
+    tp = fp = fn = tn = 0
+    misses = []
+    for example in corpus:
+        predicted = predict(example["text"])
+        if predicted and example["done"]:
+            tp += 1
+        elif predicted:
+            fp += 1
+            misses.append(("false positive", example["text"]))
+        elif example["done"]:
+            fn += 1
+            misses.append(("false negative", example["text"]))
+        else:
+            tn += 1
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return {"precision": precision, "recall": recall, "tp": tp, "fp": fp, "fn": fn, "tn": tn}, misses
+
+
+def throughput(predict, messages, seconds=1.0):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for message in messages:
+            predict(message)
+        count += len(messages)
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    corpus = load_corpus()
+    messages = [example["text"] for example in corpus]
+    matcher = FormDoneMatcher(FORM_DONE_PHRASES, FORM_DONE_SHORT_REPLIES)
+    for name, predict in (("legacy scan", legacy_matches), ("compiled matcher", matcher.matches)):
+        result, misses = score(predict, corpus)
+        corpus_rate = throughput(predict, messages)
+        everyday_rate = throughput(predict, EVERYDAY_MESSAGES)
+        print(
+            f"{name:17s} precision={result['precision']:.2f} recall={result['recall']:.2f} "
+            f"(tp={result['tp']} fp={result['fp']} fn={result['fn']} tn={result['tn']}) | "
+            f"corpus {corpus_rate:,.0f} msgs/s | everyday {everyday_rate:,.0f} msgs/s"
+        )
+        if "-v" in sys.argv:
+            for kind, text in misses:
+                print(f"    {kind}: {text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+# ============================================================
+# Load test: replays signed LINE webhook batches against app.py
+# running under gunicorn, with LINE, Zoho, Anthropic and SMTP
+# replaced by local stubs (bench/stubs.py)
+# ============================================================
+# For each gunicorn configuration it reports:
+# - throughput (webhooks/s acknowledged, replies/s delivered)
+# - p50/p95/p99 latency of the webhook "200 OK" (ack) and of the
+#   full reply (webhook sent -> reply arrives at the LINE stub)
+# - worker saturation: average busy slots (Little's law, throughput x
+#   mean latency) over available slots - gunicorn threads, or the
+#   background event workers when async=1 - plus the deepest background
+#   queue seen on /health
+# - cold start: how long importing the app takes, how soon the server
+#   accepts connections and reports ready on /health, and when the
+#   reply to a webhook sent the moment it accepts connections arrives
+#   (all measured from the process starting)
+#
+# Run from the repo root:
+#   python bench/loadtest.py
+#   python bench/loadtest.py --batches 300 --concurrency 32 \
+#       --config workers=2,threads=4 --config workers=2,threads=4,async=1 \
+#       --anthropic-latency 2 --anthropic-error-rate 0.02
+#
+# server=asgi runs asgi_app.py under uvicorn instead of app.py under gunicorn.
+# Any other app setting can be passed through a config, e.g.
+#   --config workers=1,threads=8,CLAUDE_STREAMING=false
+#   --config workers=1,threads=4,FAST_STARTUP=false
+# ============================================================
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import stubs
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = "loadtest-secret"
+
+DEFAULT_CONFIGS = [
+    "workers=1,threads=4",
+    "workers=2,threads=4",
+    "workers=2,threads=4,async=1",
+    "server=asgi,workers=1",
+]
+
+TEXTS = [
+    "สวัสดีค่ะ สนใจหอพักที่ลอนดอนค่ะ",
+    "ค่าเช่าต่อสัปดาห์เท่าไหร่คะ",
+    "สัญญากี่สัปดาห์คะ",
+    "ใกล้ UCL ไหมคะ",
+    "Is there an en-suite room near Manchester uni?",
+    "ต้องจ่ายมัดจำเท่าไหร่ครับ",
+    "กรอกฟอร์มแล้วค่ะ",
+]
+
+# (weight, event kinds in the batch)
+BATCH_MIX = [
+    (60, ["text"]),
+    (10, ["sticker"]),
+    (10, ["image"]),
+    (10, ["text", "text"]),
+    (5, ["text", "sticker"]),
+    (5, ["follow", "text"]),
+]
+
+# Event kinds the app answers through the LINE reply API
+REPLYING_KINDS = {"text", "image"}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_config(text):
+    config = {"workers": 1, "threads": 4, "async": 0, "server": "gunicorn", "env": {}}
+    for part in filter(None, text.split(",")):
+        key, _, value = part.partition("=")
+        if key == "server":
+            config[key] = value
+        elif key in ("workers", "threads", "async"):
+            config[key] = int(value)
+        else:
+            config["env"][key] = value
+    config["name"] = text
+    return config
+
+
+# ============================================================
+# Webhook batches
+# ============================================================
+def make_event(kind, user_id, counter):
+    token = f"rt-{counter}"
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": token,
+        "webhookEventId": f"ev-{counter}",
+        "deliveryContext": {"isRedelivery": False},
+    }
+    if kind == "text":
+        event["message"] = {"type": "text", "id": str(counter), "text": random.choice(TEXTS)}
+    elif kind == "sticker":
+        event["message"] = {"type": "sticker", "id": str(counter), "packageId": "446", "stickerId": "1988"}
+    elif kind == "image":
+        event["message"] = {"type": "image", "id": str(counter), "contentProvider": {"type": "line"}}
+    else:
+        event["type"] = kind
+    return event
+
+
+def sign(body):
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+
+
+def make_batches(count, users, seed, redelivery_rate=0.0):
+    random.seed(seed)
+    weights = [w for w, _ in BATCH_MIX]
+    kinds = [k for _, k in BATCH_MIX]
+    batches = []
+    counter = 0
+    for _ in range(count):
+        user_id = f"Uloadtest{random.randrange(users):05d}"
+        events = []
+        expected = []
+        for kind in random.choices(kinds, weights)[0]:
+            counter += 1
+            events.append(make_event(kind, user_id, counter))
+            if kind in REPLYING_KINDS:
+                expected.append(events[-1]["replyToken"])
+        body = json.dumps({"destination": "Ubot", "events": events}, ensure_ascii=False).encode("utf-8")
+        batches.append((body, sign(body), expected))
+        # LINE redelivering the same events: these should get no new reply
+        if random.random() < redelivery_rate:
+            for event in events:
+                event["deliveryContext"] = {"isRedelivery": True}
+            body = json.dumps({"destination": "Ubot", "events": events}, ensure_ascii=False).encode("utf-8")
+            batches.append((body, sign(body), []))
+    return batches
+
+
+# ============================================================
+# Running one configuration
+# ============================================================
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def app_environment(config, stub_set, workdir):
+    env = dict(os.environ)
+    env.update(stubs.app_env(stub_set))
+    env.update({
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "loadtest-token",
+        "ASYNC_EVENT_PROCESSING": "true" if config["async"] else "false",
+        "FORM_DB_FILE": os.path.join(workdir, "form_tracking.db"),
+        "HISTORY_DB_FILE": os.path.join(workdir, "history.db"),
+    })
+    env.update(config["env"])
+    return env
+
+
+def measure_import(config, env, runs=3):
+    """Seconds to import the app module in a fresh interpreter (best of `runs`)."""
+    module = "asgi_app" if config["server"] == "asgi" else "app"
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, env=env,
+                                capture_output=True, text=True, check=True)
+        times.append(float(result.stdout.split()[-1]))
+    return min(times)
+
+
+def cold_start_webhook():
+    event = make_event("text", "Ucoldstart", 0)
+    event["replyToken"] = "rt-cold-start"
+    event["webhookEventId"] = "ev-cold-start"
+    body = json.dumps({"destination": "Ubot", "events": [event]}, ensure_ascii=False).encode("utf-8")
+    return body, sign(body), event["replyToken"]
+
+
+def start_app(config, stub_set, port, env):
+    """Start the server and wait until /health says it's ready.
+
+    Returns (process, base_url, cold_start timings in seconds).
+    """
+    if config["server"] == "asgi":
+        command = [
+            sys.executable, "-m", "uvicorn", "asgi_app:application",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(config["workers"]),
+            "--log-level", "warning",
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "gunicorn", "app:app",
+            "--bind", f"127.0.0.1:{port}",
+            "--workers", str(config["workers"]),
+            "--threads", str(config["threads"]),
+            "--timeout", "120",
+            "--log-level", "warning",
+        ]
+    spawned = time.monotonic()
+    process = subprocess.Popen(command, cwd=REPO_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    base = f"http://127.0.0.1:{port}"
+    body, signature, token = cold_start_webhook()
+    cold_start = {"listening": None, "ready": None, "first_reply": None}
+    deadline = spawned + 30
+    while cold_start["ready"] is None:
+        if time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("server did not become ready within 30s")
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited: {process.stderr.read().decode(errors='replace')[-2000:]}")
+        try:
+            urllib.request.urlopen(f"{base}/health", timeout=1).read()
+            status = 200
+        except urllib.error.HTTPError as e:
+            status = e.code  # 503 while starting up
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.02)
+            continue
+        if cold_start["listening"] is None:
+            cold_start["listening"] = time.monotonic() - spawned
+            # The first customer message after a restart, sent as soon as connections are accepted
+            threading.Thread(target=post_webhook, args=(base, body, signature), daemon=True).start()
+        if status == 200:
+            cold_start["ready"] = time.monotonic() - spawned
+        else:
+            time.sleep(0.02)
+
+    received = stub_set["line"].received
+    while token not in received and time.monotonic() < deadline:
+        time.sleep(0.02)
+    if token in received:
+        cold_start["first_reply"] = received[token][0] - spawned
+    return process, base, cold_start
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def watch_queue(base, stop, samples):
+    """Sample the background queue depth from /health while the test runs."""
+    while not stop.is_set():
+        try:
+            health = json.loads(urllib.request.urlopen(f"{base}/health", timeout=2).read())
+            if "event_queue" in health:
+                samples.append(health["event_queue"]["depth"])
+            else:
+                samples.append(health.get("event_tasks", {}).get("in_progress", 0))
+        except Exception:
+            pass
+        stop.wait(0.25)
+
+
+def post_webhook(base, body, signature):
+    req = urllib.request.Request(
+        f"{base}/callback", data=body, method="POST",
+        headers={"Content-Type": "application/json", "X-Line-Signature": signature},
+    )
+    started = time.monotonic()
+    try:
+        status = urllib.request.urlopen(req, timeout=120).status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = 0
+    return started, time.monotonic(), status
+
+
+def run_config(config, stub_set, batches, concurrency, drain_seconds):
+    stub_set["line"].received.clear()
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = app_environment(config, stub_set, workdir)
+        import_seconds = measure_import(config, env)
+        process, base, cold_start = start_app(config, stub_set, port, env)
+        try:
+            depth_samples = []
+            stop = threading.Event()
+            watcher = threading.Thread(target=watch_queue, args=(base, stop, depth_samples), daemon=True)
+            watcher.start()
+
+            sent_at = {}
+            ack_latencies = []
+            statuses = {}
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = [(pool.submit(post_webhook, base, body, sig), expected)
+                           for body, sig, expected in batches]
+                for future, expected in futures:
+                    t_sent, t_acked, status = future.result()
+                    ack_latencies.append(t_acked - t_sent)
+                    statuses[status] = statuses.get(status, 0) + 1
+                    for token in expected:
+                        sent_at[token] = t_sent
+            acked = time.monotonic()
+
+            # Wait for replies still being produced in the background
+            deadline = acked + drain_seconds
+            received = stub_set["line"].received
+            while time.monotonic() < deadline and not all(t in received for t in sent_at):
+                time.sleep(0.1)
+            stop.set()
+            watcher.join()
+        finally:
+            stop_app(process)
+
+    reply_latencies = [received[t][0] - sent_at[t] for t in sent_at if t in received]
+    last_reply = max((received[t][0] for t in sent_at if t in received), default=acked)
+    ack_elapsed = acked - started
+    total_elapsed = max(acked, last_reply) - started
+    slots = config["workers"] * config["threads"]
+    if config["server"] == "asgi":
+        # No fixed pool of worker threads to saturate
+        slots = 0
+    elif config["async"]:
+        # Replies are produced by the background event workers instead
+        slots = config["workers"] * int(config["env"].get("EVENT_WORKERS", 4))
+    mean_ack = sum(ack_latencies) / len(ack_latencies) if ack_latencies else 0.0
+    ack_throughput = len(batches) / ack_elapsed if ack_elapsed else 0.0
+    reply_throughput = len(reply_latencies) / total_elapsed if total_elapsed else 0.0
+    mean_reply = sum(reply_latencies) / len(reply_latencies) if reply_latencies else 0.0
+    # Little's law: work in flight = arrival rate x time in system.
+    # More in flight than there are slots means requests are queueing.
+    background = config["async"] or config["server"] == "asgi"
+    in_flight = reply_throughput * mean_reply if background else ack_throughput * mean_ack
+    return {
+        "config": config["name"],
+        "webhooks": len(batches),
+        "statuses": statuses,
+        "webhooks_per_s": ack_throughput,
+        "replies": len(reply_latencies),
+        "replies_expected": len(sent_at),
+        "replies_per_s": reply_throughput,
+        "ack": [percentile(ack_latencies, p) for p in (50, 95, 99)],
+        "reply": [percentile(reply_latencies, p) for p in (50, 95, 99)],
+        "busy_slots": in_flight,
+        "utilisation": min(1.0, in_flight / slots) if slots else None,
+        "max_queue_depth": max(depth_samples, default=0),
+        "import_seconds": import_seconds,
+        "cold_start": cold_start,
+    }
+
+
+def print_report(results):
+    header = (f"{'config':<38} {'hooks/s':>8} {'replies/s':>9} {'ack p50/p95/p99 (ms)':>22} "
+              f"{'reply p50/p95/p99 (s)':>22} {'busy':>6} {'util':>5} {'queue':>5} {'missing':>7}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        ack = "/".join(f"{v * 1000:.0f}" for v in r["ack"])
+        reply = "/".join(f"{v:.2f}" for v in r["reply"])
+        missing = r["replies_expected"] - r["replies"]
+        util = "-" if r["utilisation"] is None else f"{r['utilisation']:.0%}"
+        print(f"{r['config']:<38} {r['webhooks_per_s']:>8.1f} {r['replies_per_s']:>9.1f} {ack:>22} "
+              f"{reply:>22} {r['busy_slots']:>6.1f} {util:>5} {r['max_queue_depth']:>5} {missing:>7}")
+        errors = {k: v for k, v in r["statuses"].items() if k != 200}
+        if errors:
+            print(f"    non-200 webhook responses: {errors}")
+
+    print()
+    header = f"{'cold start (from process start)':<38} {'import (ms)':>11} {'listening (s)':>13} {'ready (s)':>9} {'first reply (s)':>15}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cold = {k: "-" if v is None else f"{v:.2f}" for k, v in r["cold_start"].items()}
+        print(f"{r['config']:<38} {r['import_seconds'] * 1000:>11.0f} {cold['listening']:>13} "
+              f"{cold['ready']:>9} {cold['first_reply']:>15}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test app.py against local stubs")
+    parser.add_argument("--config", action="append", help="gunicorn config, e.g. workers=2,threads=4,async=1 (repeatable)")
+    parser.add_argument("--batches", type=int, default=200, help="webhook requests to send per config")
+    parser.add_argument("--concurrency", type=int, default=16, help="webhooks in flight at once")
+    parser.add_argument("--users", type=int, default=50, help="distinct LINE users in the mix")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--redelivery-rate", type=float, default=0.0, help="fraction of batches LINE sends twice")
+    parser.add_argument("--drain-seconds", type=float, default=60, help="how long to wait for background replies")
+    parser.add_argument("--json", help="also write the results to this file")
+    for name, latency in (("line", 0.05), ("zoho", 0.1), ("anthropic", 1.0), ("smtp", 0.1)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency)
+        parser.add_argument(f"--{name}-jitter", type=float, default=latency / 2)
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+    parser.add_argument("--handoff-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    faults = {
+        name: stubs.Fault(getattr(args, f"{name}_latency"), getattr(args, f"{name}_jitter"),
+                          getattr(args, f"{name}_error_rate"))
+        for name in ("line", "zoho", "anthropic", "smtp")
+    }
+    stub_set = stubs.start_all(handoff_rate=args.handoff_rate, **faults)
+    batches = make_batches(args.batches, args.users, args.seed, args.redelivery_rate)
+
+    results = []
+    for text in args.config or DEFAULT_CONFIGS:
+        config = parse_config(text)
+        print(f"Running {config['name']} ...", flush=True)
+        results.append(run_config(config, stub_set, batches, args.concurrency, args.drain_seconds))
+
+    print()
+    print_report(results)
+    print(f"\nstub calls: anthropic={stub_set['anthropic'].requests} (errors {stub_set['anthropic'].errors}), "
+          f"zoho={stub_set['zoho'].requests} (errors {stub_set['zoho'].errors}), "
+          f"smtp={stub_set['smtp'].requests} (errors {stub_set['smtp'].errors})")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
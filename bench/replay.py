@@ -0,0 +1,226 @@
+# ============================================================
+# Replay: re-runs recorded conversation traces (traces.py) with a
+# candidate system prompt and/or model, and compares it with the
+# current one before it is deployed
+# ============================================================
+# Record traces in production (or a load test) with TRACE_DIR set,
+# copy the files here, then e.g.:
+#   python bench/replay.py traces/ --prompt candidate_system_prompt.py
+#   python bench/replay.py traces/ --model claude-3-5-haiku-20241022 --modes A,C
+#
+# Each reply trace is asked twice, with the same history and extra
+# system blocks (form link, history summary): once with the baseline
+# (system_prompt.py and the recorded model) and once with the candidate.
+# Both go to the same Anthropic endpoint:
+# - default: the local stand-in from bench/stubs.py (no cost, checks the
+#   plumbing and prompt size; its replies and latency are made up)
+# - --anthropic-url https://api.anthropic.com with ANTHROPIC_API_KEY set:
+#   real replies, latency, token usage and handoff rate
+# - --recorded: no calls at all. The baseline is what was recorded; the
+#   candidate keeps the recorded reply and latency and only its input
+#   tokens change by the difference in (estimated) prompt size
+#
+# Reports per mode: replies, latency p50/p95, average input/output
+# tokens and handoff rate for both, and the candidate's change.
+# ============================================================
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stubs
+from history_window import estimate_tokens
+from loadtest import percentile
+from reply_cache import prompt_version
+from traces import read_traces
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ("A", "B", "C")
+
+
+def load_prompts(path):
+    """{mode: prompt text} from a system_prompt.py-style file."""
+    spec = importlib.util.spec_from_file_location(f"replay_prompt_{abs(hash(path))}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return {mode: getattr(module, f"SYSTEM_PROMPT_MODE_{mode}") for mode in MODES}
+
+
+def load_traces(paths, modes, limit):
+    replayable = []
+    skipped = 0
+    for trace in read_traces(paths, kind="reply"):
+        if not trace.get("messages") or trace.get("mode") not in modes:
+            skipped += 1  # cache hits, rate-limited replies, other modes
+            continue
+        replayable.append(trace)
+        if limit and len(replayable) >= limit:
+            break
+    return replayable, skipped
+
+
+def recorded_result(trace):
+    usage = trace.get("usage") or {}
+    return {
+        "seconds": trace["timings"].get("generation"),
+        "input_tokens": usage.get("input_tokens"),
+        "output_tokens": usage.get("output_tokens"),
+        "handoff": trace.get("handoff", False),
+        "failed": trace.get("reply") is None,
+    }
+
+
+def request_for(trace, prompts, model):
+    system = [{"type": "text", "text": prompts[trace["mode"]], "cache_control": {"type": "ephemeral"}}]
+    system += [{"type": "text", "text": text} for text in trace.get("system_extra", [])]
+    return {
+        "model": model or trace["model"],
+        "max_tokens": trace["max_tokens"],
+        "system": system,
+        "messages": trace["messages"],
+    }
+
+
+def ask(client, request_args):
+    started = time.monotonic()
+    try:
+        response = client.messages.create(**request_args)
+    except Exception as e:
+        return {"seconds": time.monotonic() - started, "input_tokens": None, "output_tokens": None,
+                "handoff": True, "failed": True, "error": type(e).__name__}
+    text = response.content[0].text if response.content else ""
+    return {
+        "seconds": time.monotonic() - started,
+        "input_tokens": response.usage.input_tokens,
+        "output_tokens": response.usage.output_tokens,
+        "handoff": "[HANDOFF]" in text or not text.strip(),
+        "failed": False,
+    }
+
+
+def replay(traces, baseline_prompts, candidate_prompts, candidate_model, client, concurrency):
+    """[(trace, baseline result, candidate result)] with both asked live."""
+    def one(trace):
+        baseline = ask(client, request_for(trace, baseline_prompts, None))
+        candidate = ask(client, request_for(trace, candidate_prompts, candidate_model))
+        return trace, baseline, candidate
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, traces))
+
+
+def replay_recorded(traces, candidate_prompts):
+    """[(trace, recorded result, estimated candidate result)] without calling Claude."""
+    results = []
+    for trace in traces:
+        baseline = recorded_result(trace)
+        candidate = dict(baseline)
+        if baseline["input_tokens"] is not None:
+            prompt_change = estimate_tokens(candidate_prompts[trace["mode"]]) - trace.get("prompt_tokens", 0)
+            candidate["input_tokens"] = baseline["input_tokens"] + prompt_change
+        results.append((trace, baseline, candidate))
+    return results
+
+
+def summarise(results):
+    values = [r for r in results if not r["failed"]]
+    seconds = [r["seconds"] for r in values if r["seconds"] is not None]
+    inputs = [r["input_tokens"] for r in values if r["input_tokens"] is not None]
+    outputs = [r["output_tokens"] for r in values if r["output_tokens"] is not None]
+    return {
+        "replies": len(results),
+        "failed": len(results) - len(values),
+        "p50": percentile(seconds, 50),
+        "p95": percentile(seconds, 95),
+        "input_tokens": sum(inputs) / len(inputs) if inputs else 0.0,
+        "output_tokens": sum(outputs) / len(outputs) if outputs else 0.0,
+        "handoff_rate": sum(r["handoff"] for r in results) / len(results) if results else 0.0,
+    }
+
+
+def build_report(results):
+    report = {}
+    groups = {mode: [r for r in results if r[0]["mode"] == mode] for mode in MODES}
+    groups["all"] = results
+    for name, group in groups.items():
+        if group:
+            report[name] = {
+                "baseline": summarise([baseline for _, baseline, _ in group]),
+                "candidate": summarise([candidate for _, _, candidate in group]),
+            }
+    return report
+
+
+def print_report(report):
+    header = (f"{'mode':<5} {'':<10} {'replies':>7} {'failed':>6} {'p50 (s)':>8} {'p95 (s)':>8} "
+              f"{'input tok':>10} {'output tok':>10} {'handoff':>8}")
+    print(header)
+    print("-" * len(header))
+    for mode, sides in report.items():
+        for side in ("baseline", "candidate"):
+            s = sides[side]
+            print(f"{mode if side == 'baseline' else '':<5} {side:<10} {s['replies']:>7} {s['failed']:>6} "
+                  f"{s['p50']:>8.2f} {s['p95']:>8.2f} {s['input_tokens']:>10.0f} {s['output_tokens']:>10.0f} "
+                  f"{s['handoff_rate']:>8.1%}")
+        b, c = sides["baseline"], sides["candidate"]
+        print(f"{'':<5} {'change':<10} {'':>7} {c['failed'] - b['failed']:>+6} {c['p50'] - b['p50']:>+8.2f} "
+              f"{c['p95'] - b['p95']:>+8.2f} {c['input_tokens'] - b['input_tokens']:>+10.0f} "
+              f"{c['output_tokens'] - b['output_tokens']:>+10.0f} {(c['handoff_rate'] - b['handoff_rate']) * 100:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traces with a candidate prompt or model")
+    parser.add_argument("traces", nargs="+", help="trace files or directories (TRACE_DIR)")
+    parser.add_argument("--prompt", help="candidate prompt file (same names as system_prompt.py)")
+    parser.add_argument("--baseline-prompt", default=os.path.join(REPO_DIR, "system_prompt.py"))
+    parser.add_argument("--model", help="candidate model (default: the model each trace used)")
+    parser.add_argument("--modes", default="A,B,C", help="modes to replay, e.g. A,C")
+    parser.add_argument("--limit", type=int, default=0, help="replay at most this many traces")
+    parser.add_argument("--recorded", action="store_true", help="don't call Claude; compare with the recorded replies")
+    parser.add_argument("--anthropic-url", help="Anthropic API to replay against (default: local stub)")
+    parser.add_argument("--anthropic-latency", type=float, default=1.0, help="stub latency (seconds)")
+    parser.add_argument("--handoff-rate", type=float, default=0.05, help="stub handoff rate")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    baseline_prompts = load_prompts(args.baseline_prompt)
+    candidate_prompts = load_prompts(args.prompt) if args.prompt else baseline_prompts
+    traces, skipped = load_traces(args.traces, set(args.modes.split(",")), args.limit)
+    if not traces:
+        sys.exit(f"No replayable reply traces found ({skipped} skipped)")
+    versions = {t["prompt_version"] for t in traces}
+    print(f"Replaying {len(traces)} traces ({skipped} skipped), recorded prompt versions {sorted(versions)}")
+    print(f"baseline prompt {prompt_version(*baseline_prompts.values())}, "
+          f"candidate prompt {prompt_version(*candidate_prompts.values())}, "
+          f"candidate model {args.model or 'as recorded'}")
+
+    if args.recorded:
+        results = replay_recorded(traces, candidate_prompts)
+    else:
+        import anthropic
+        if args.anthropic_url:
+            client = anthropic.Anthropic(base_url=args.anthropic_url, max_retries=0)
+        else:
+            stub = stubs.FakeAnthropic(
+                fault=stubs.Fault(args.anthropic_latency, args.anthropic_latency / 2), handoff_rate=args.handoff_rate,
+            ).start()
+            client = anthropic.Anthropic(base_url=stub.url, api_key="stub-key", max_retries=0)
+        results = replay(traces, baseline_prompts, candidate_prompts, args.model, client, args.concurrency)
+
+    report = build_report(results)
+    print()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
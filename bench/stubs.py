@@ -0,0 +1,362 @@
+# ============================================================
+# Local stand-ins for LINE, Zoho, Anthropic and SMTP
+# Used by the load test (bench/loadtest.py) so app.py can be
+# benchmarked without touching any live service.
+# ============================================================
+# Every stub has configurable latency (base + random jitter, seconds)
+# and an error rate (0.0 - 1.0) for failure injection.
+#
+# Run them on their own (e.g. to point a manually started app at them):
+#   python bench/stubs.py --line-port 9001 --zoho-port 9002 \
+#       --anthropic-port 9003 --smtp-port 9025 --anthropic-latency 1.5
+# then start the app with:
+#   LINE_API_BASE_URL=http://127.0.0.1:9001 ZOHO_WEBHOOK_URL=http://127.0.0.1:9002/zoho \
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:9003 SMTP_SERVER=127.0.0.1 SMTP_PORT=9025 \
+#   SMTP_STARTTLS=false SMTP_AUTH=false ...
+
+import argparse
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_TEXTS = [
+    "สวัสดีค่ะ ยินดีต้อนรับสู่ Peyton & Charmed นะคะ 😊 มีอะไรให้ช่วยไหมคะ",
+    "ห้อง en-suite ใกล้มหาวิทยาลัยเริ่มต้นประมาณ £250 ต่อสัปดาห์ค่ะ ขึ้นอยู่กับเมืองและสัญญานะคะ",
+    "สัญญาส่วนใหญ่เป็น 44 หรือ 51 สัปดาห์ค่ะ ทีมงานจะช่วยเช็กตัวเลือกที่เหมาะกับน้องให้นะคะ",
+]
+HANDOFF_TEXT = "เรื่องนี้ขอให้ทีมงานช่วยดูให้นะคะ จะติดต่อกลับเร็วๆ นี้ค่ะ [HANDOFF]"
+FORM_LINK_PATTERN = re.compile(r"https://zfrmz\.\S+")
+
+
+class Fault:
+    """Latency and error injection settings shared by the stubs."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self, scale=1.0):
+        seconds = (self.latency + random.uniform(0, self.jitter)) * scale
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Connection pre-warming at app startup (not counted as API calls)
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self._send_json(200, {"data": []})
+
+
+class StubServer:
+    """A threaded HTTP server running in the background."""
+
+    handler = _StubHandler
+
+    def __init__(self, port=0, fault=None):
+        self.fault = fault or Fault()
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        handler = type(f"{type(self).__name__}Handler", (self.handler,), {"stub": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, failed=False):
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+
+
+# ============================================================
+# LINE Messaging API
+# ============================================================
+class _LineHandler(_StubHandler):
+    def do_POST(self):
+        body = self._read_body()
+        self.stub.fault.delay()
+        if self.stub.fault.should_fail():
+            self.stub.count(failed=True)
+            self._send_json(500, {"message": "injected error"})
+            return
+        payload = json.loads(body or b"{}")
+        self.stub.record(self.path, payload)
+        self.stub.count()
+        self._send_json(200, {})
+
+
+class FakeLine(StubServer):
+    """Records every reply / push with the time it arrived."""
+
+    handler = _LineHandler
+
+    def __init__(self, port=0, fault=None):
+        super().__init__(port, fault)
+        self.received = {}
+        self.pushes = []
+
+    def record(self, path, payload):
+        now = time.monotonic()
+        if path.endswith("/reply"):
+            self.received[payload.get("replyToken", "")] = (now, payload)
+        else:
+            self.pushes.append((now, path, payload))
+
+
+# ============================================================
+# Zoho webhook
+# ============================================================
+class _ZohoHandler(_StubHandler):
+    def do_POST(self):
+        self._read_body()
+        self.stub.fault.delay()
+        failed = self.stub.fault.should_fail()
+        self.stub.count(failed=failed)
+        self._send_json(503 if failed else 200, {})
+
+
+class FakeZoho(StubServer):
+    handler = _ZohoHandler
+
+
+# ============================================================
+# Anthropic Messages API (plain and streaming)
+# ============================================================
+class _AnthropicHandler(_StubHandler):
+    def do_POST(self):
+        request = json.loads(self._read_body() or b"{}")
+        stub = self.stub
+        if stub.fault.should_fail():
+            stub.fault.delay()
+            stub.count(failed=True)
+            self._send_json(529, {"type": "error", "error": {"type": "overloaded_error", "message": "injected"}})
+            return
+        text = stub.reply_for(request)
+        usage = {
+            "input_tokens": stub.input_tokens(request),
+            "output_tokens": max(1, len(text) // 2),
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+        }
+        stub.count()
+        if request.get("stream"):
+            self._stream(request, text, usage)
+        else:
+            stub.fault.delay(stub.latency_scale(request))
+            self._send_json(200, {
+                "id": "msg_stub", "type": "message", "role": "assistant",
+                "model": request.get("model", ""), "stop_reason": "end_turn", "stop_sequence": None,
+                "content": [{"type": "text", "text": text}], "usage": usage,
+            })
+
+    def _stream(self, request, text, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(name, data):
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        start_usage = dict(usage, output_tokens=1)
+        event("message_start", {"type": "message_start", "message": {
+            "id": "msg_stub", "type": "message", "role": "assistant", "model": request.get("model", ""),
+            "content": [], "stop_reason": None, "stop_sequence": None, "usage": start_usage}})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                       "content_block": {"type": "text", "text": ""}})
+        # Spread the configured latency over the chunks, like real generation
+        chunks = [text[i:i + 8] for i in range(0, len(text), 8)] or [""]
+        per_chunk = ((self.stub.fault.latency + random.uniform(0, self.stub.fault.jitter))
+                     * self.stub.latency_scale(request) / len(chunks))
+        try:
+            for chunk in chunks:
+                time.sleep(per_chunk)
+                event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                              "delta": {"type": "text_delta", "text": chunk}})
+            event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                    "usage": {"output_tokens": usage["output_tokens"]}})
+            event("message_stop", {"type": "message_stop"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped early (e.g. after [HANDOFF])
+
+
+class FakeAnthropic(StubServer):
+    handler = _AnthropicHandler
+
+    def __init__(self, port=0, fault=None, handoff_rate=0.05):
+        super().__init__(port, fault)
+        self.handoff_rate = handoff_rate
+
+    @staticmethod
+    def latency_scale(request):
+        # Haiku models answer in well under half the time
+        return 0.4 if "haiku" in request.get("model", "") else 1.0
+
+    def reply_for(self, request):
+        if random.random() < self.handoff_rate:
+            return HANDOFF_TEXT
+        text = random.choice(REPLY_TEXTS)
+        # MODE A: echo the customer's form link so the app marks it as sent
+        system = request.get("system", "")
+        system_text = system if isinstance(system, str) else " ".join(b.get("text", "") for b in system)
+        link = FORM_LINK_PATTERN.search(system_text)
+        if link:
+            text += f" กรอกฟอร์มนี้ได้เลยนะคะ 👉 {link.group(0)}"
+        return text
+
+    @staticmethod
+    def input_tokens(request):
+        size = len(json.dumps(request.get("system", ""), ensure_ascii=False))
+        size += len(json.dumps(request.get("messages", []), ensure_ascii=False))
+        return size // 2
+
+
+# ============================================================
+# SMTP server
+# ============================================================
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        stub = self.server.stub
+        self._reply("220 stub ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self._reply("250 stub")
+            elif command.startswith("DATA"):
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                stub.fault.delay()
+                if stub.fault.should_fail():
+                    stub.count(failed=True)
+                    self._reply("451 injected error")
+                else:
+                    stub.count()
+                    self._reply("250 OK")
+            elif command.startswith("QUIT"):
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class FakeSmtp:
+    def __init__(self, port=0, fault=None):
+        self.fault = fault or Fault()
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", port), _SmtpHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+
+    start = StubServer.start
+    stop = StubServer.stop
+    count = StubServer.count
+
+
+def start_all(line=None, zoho=None, anthropic=None, smtp=None, handoff_rate=0.05, ports=(0, 0, 0, 0)):
+    """Start all four stubs and return them as a dict."""
+    return {
+        "line": FakeLine(ports[0], line).start(),
+        "zoho": FakeZoho(ports[1], zoho).start(),
+        "anthropic": FakeAnthropic(ports[2], anthropic, handoff_rate=handoff_rate).start(),
+        "smtp": FakeSmtp(ports[3], smtp).start(),
+    }
+
+
+def app_env(stubs):
+    """Environment variables that point app.py at the stubs."""
+    return {
+        "LINE_API_BASE_URL": stubs["line"].url,
+        "ZOHO_WEBHOOK_URL": f"{stubs['zoho'].url}/zoho",
+        "ANTHROPIC_BASE_URL": stubs["anthropic"].url,
+        "ANTHROPIC_API_KEY": "stub-key",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(stubs["smtp"].port),
+        "SMTP_STARTTLS": "false",
+        "SMTP_AUTH": "false",
+        "SENDER_EMAIL": "bot@example.com",
+        "TEAM_EMAIL_ADDRESSES": "team@example.com",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local stand-ins for LINE, Zoho, Anthropic and SMTP")
+    for name, port in (("line", 9001), ("zoho", 9002), ("anthropic", 9003), ("smtp", 9025)):
+        parser.add_argument(f"--{name}-port", type=int, default=port)
+        parser.add_argument(f"--{name}-latency", type=float, default=1.5 if name == "anthropic" else 0.05)
+        parser.add_argument(f"--{name}-jitter", type=float, default=0.0)
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+    parser.add_argument("--handoff-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    faults = {
+        name: Fault(getattr(args, f"{name}_latency"), getattr(args, f"{name}_jitter"), getattr(args, f"{name}_error_rate"))
+        for name in ("line", "zoho", "anthropic", "smtp")
+    }
+    stubs = start_all(
+        ports=(args.line_port, args.zoho_port, args.anthropic_port, args.smtp_port),
+        handoff_rate=args.handoff_rate, **faults,
+    )
+    for key, value in app_env(stubs).items():
+        print(f"{key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
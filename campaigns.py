@@ -0,0 +1,223 @@
+# ============================================================
+# Peyton & Charmed - Reminder Campaigns
+# Nudges customers who got the form link but never filled it in
+# (MODE C) through LINE's multicast API
+# ============================================================
+# - Campaigns are created through /campaigns/reminders/start and saved
+#   in the shared SQLite file, so they survive restarts and every
+#   worker sees them. A campaign can be scheduled for later.
+# - One worker at a time sends a campaign: it holds a lease that it
+#   renews after every batch. If that worker dies, another one takes
+#   over once the lease runs out.
+# - Recipients go out in batches of up to 500 (LINE's multicast limit),
+#   in user ID order. The last user ID sent is saved after each batch,
+#   so an interrupted campaign carries on where it stopped.
+# - Batches are paced (`batches_per_second`). A 429 from LINE waits for
+#   Retry-After and sends the same batch again; running out of the
+#   monthly message quota stops the campaign.
+# - A batch keeps its recipients and its X-Line-Retry-Key (saved with
+#   the campaign) until LINE accepts it, so a retry - also by another
+#   worker after a restart - is never delivered twice. LINE answers 409
+#   to a key it has already accepted.
+
+import os
+import json
+import socket
+import threading
+import time
+import uuid
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MULTICAST_MAX_RECIPIENTS = 500
+
+SCHEDULED = "scheduled"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class ReminderCampaigns:
+    def __init__(self, kv, form_store, send_multicast, batch_size=MULTICAST_MAX_RECIPIENTS,
+                 batches_per_second=1.0, poll_seconds=30, lease_seconds=120, max_retries=5):
+        self.kv = kv
+        self.form_store = form_store
+        # send_multicast(user_ids, messages, retry_key) -> (status, retry_after, error_text)
+        self.send_multicast = send_multicast
+        self.batch_size = min(batch_size, MULTICAST_MAX_RECIPIENTS)
+        self.batches_per_second = batches_per_second
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.max_retries = max_retries
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # ---- Campaign records (kv "campaign.<id>") ----
+    def create(self, messages, start_at=None, min_age_seconds=0):
+        now = time.time()
+        campaign = {
+            "id": uuid.uuid4().hex[:12],
+            "status": SCHEDULED,
+            "messages": messages,
+            "start_at": start_at or now,
+            # Only customers whose link went out at least this long before the campaign starts
+            "min_age_seconds": min_age_seconds,
+            "cursor": "",
+            # The batch being sent: {"recipients": [...], "retry_key": ...}
+            "pending": None,
+            "sent": 0,
+            "batches": 0,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        self._save(campaign)
+        logger.info("Reminder campaign %s scheduled for %s", campaign["id"], time.ctime(campaign["start_at"]))
+        self.start()
+        self._wake.set()
+        return campaign
+
+    def get(self, campaign_id):
+        value = self.kv.get(f"campaign.{campaign_id}")
+        return json.loads(value) if value else None
+
+    def list(self):
+        campaigns = [json.loads(v) for v in self.kv.get_many("campaign.").values()]
+        return sorted(campaigns, key=lambda c: c["created_at"], reverse=True)
+
+    def cancel(self, campaign_id):
+        campaign = self.get(campaign_id)
+        if campaign is None or campaign["status"] not in (SCHEDULED, RUNNING):
+            return campaign
+        # The sender checks the status before every batch
+        campaign["status"] = CANCELLED
+        self._save(campaign)
+        logger.info("Reminder campaign %s cancelled after %s recipients", campaign_id, campaign["sent"])
+        return campaign
+
+    def _save(self, campaign):
+        campaign["updated_at"] = time.time()
+        self.kv.set(f"campaign.{campaign['id']}", json.dumps(campaign, ensure_ascii=False))
+
+    # ---- Leases (kv "campaign_lease.<id>" = "<owner> <expires>") ----
+    def _take_lease(self, campaign_id):
+        key = f"campaign_lease.{campaign_id}"
+        value = f"{self._owner} {time.time() + self.lease_seconds}"
+        if self.kv.add(key, value):
+            return value
+        current = self.kv.get(key)
+        if current is not None and float(current.rsplit(" ", 1)[1]) < time.time():
+            if self.kv.compare_and_set(key, current, value):
+                return value
+        return None
+
+    def _renew_lease(self, campaign_id, lease):
+        value = f"{self._owner} {time.time() + self.lease_seconds}"
+        return value if self.kv.compare_and_set(f"campaign_lease.{campaign_id}", lease, value) else None
+
+    # ---- Sending ----
+    def start(self):
+        """Start the background sender (once per process)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._owner = f"{socket.gethostname()}:{os.getpid()}"
+            self._thread = threading.Thread(target=self._run, name="campaigns", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                for campaign in self.list():
+                    if campaign["status"] in (SCHEDULED, RUNNING) and campaign["start_at"] <= time.time():
+                        lease = self._take_lease(campaign["id"])
+                        if lease is not None:
+                            self._send_campaign(campaign["id"], lease)
+            except Exception as e:
+                logger.error("Reminder campaigns: %s", e)
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def _send_campaign(self, campaign_id, lease):
+        pause = 1.0 / self.batches_per_second if self.batches_per_second > 0 else 0.0
+        attempt = 0
+        while True:
+            # Re-read every batch: it may have been cancelled meanwhile
+            campaign = self.get(campaign_id)
+            if campaign is None or campaign["status"] not in (SCHEDULED, RUNNING):
+                break
+            if campaign["status"] == SCHEDULED:
+                campaign["status"] = RUNNING
+                logger.info("Reminder campaign %s started", campaign_id)
+            if not campaign.get("pending"):
+                recipients = self.form_store.waiting_for_form(
+                    after=campaign["cursor"], limit=self.batch_size,
+                    updated_before=campaign["start_at"] - campaign["min_age_seconds"],
+                )
+                if not recipients:
+                    campaign["status"] = DONE
+                    self._save(campaign)
+                    logger.info("Reminder campaign %s done: %s recipients", campaign_id, campaign["sent"])
+                    break
+                # Saved before sending, so every retry of this batch sends the
+                # same recipients with the same key
+                campaign["pending"] = {"recipients": recipients, "retry_key": str(uuid.uuid4())}
+                self._save(campaign)
+            recipients = campaign["pending"]["recipients"]
+
+            started = time.monotonic()
+            status, retry_after, error = self.send_multicast(
+                recipients, campaign["messages"], campaign["pending"]["retry_key"]
+            )
+            if status == 409:
+                logger.info("Reminder campaign %s: batch already accepted by LINE (retry key)", campaign_id)
+            if status in (200, 409):
+                attempt = 0
+                campaign["pending"] = None
+                campaign["cursor"] = recipients[-1]
+                campaign["sent"] += len(recipients)
+                campaign["batches"] += 1
+                campaign["error"] = None
+                metrics.CAMPAIGN_RECIPIENTS_TOTAL.inc(len(recipients))
+            else:
+                attempt += 1
+                campaign["error"] = f"{status}: {error}"[:300]
+                if (status == 429 and "monthly limit" in (error or "")) or attempt > self.max_retries \
+                        or (400 <= status < 500 and status != 429):
+                    campaign["status"] = FAILED
+                    self._save(campaign)
+                    logger.error("Reminder campaign %s stopped after %s recipients: %s", campaign_id, campaign["sent"], campaign["error"])
+                    break
+                # Rate limited or LINE unavailable: same batch again, after a wait
+                delay = min(retry_after if retry_after is not None else 2 ** attempt, self.lease_seconds / 2)
+                logger.warning("Reminder campaign %s: LINE returned %s, retrying in %ss", campaign_id, status, delay)
+                time.sleep(delay)
+            if self.get(campaign_id)["status"] == CANCELLED:
+                campaign["status"] = CANCELLED  # cancelled while this batch was going out
+            self._save(campaign)
+
+            lease = self._renew_lease(campaign_id, lease)
+            if lease is None:
+                logger.warning("Reminder campaign %s: lease lost, leaving it to another worker", campaign_id)
+                return
+            time.sleep(max(0.0, pause - (time.monotonic() - started)))
+        self.kv.delete(f"campaign_lease.{campaign_id}")
+
+    def stats(self):
+        counts = {}
+        active = []
+        for campaign in self.list():
+            counts[campaign["status"]] = counts.get(campaign["status"], 0) + 1
+            if campaign["status"] in (SCHEDULED, RUNNING):
+                active.append({k: campaign[k] for k in ("id", "status", "start_at", "sent", "batches", "error")})
+        return {"by_status": counts, "active": active}
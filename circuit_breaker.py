@@ -0,0 +1,135 @@
+# ============================================================
+# Peyton & Charmed - Circuit Breakers
+# Stop calling a service that is failing or very slow, instead of
+# making every customer wait for the full timeout.
+# ============================================================
+# - closed: calls go through; the error rate over the last
+#   `window_seconds` is tracked (calls slower than `slow_call_seconds`
+#   count as errors)
+# - open: calls fail fast for `open_seconds`
+# - half_open: one trial call is let through; success closes the
+#   breaker, failure opens it again for twice as long (up to
+#   `max_open_seconds`)
+#
+# Breakers are per server process. The forwarding-only switch that a
+# tripped Claude breaker turns on is shared (see app.py).
+
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose breaker is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window_seconds=60,
+                 slow_call_seconds=None, open_seconds=30, max_open_seconds=300, on_open=None):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.on_open = on_open
+        self.state = CLOSED
+        self.open_seconds = open_seconds
+        self.opened_at = None
+        self._calls = deque()  # (time, failed)
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self):
+        """True if a call may go ahead now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._trial_running = False
+                logger.info("Circuit %s: half-open, letting one trial call through", self.name)
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, duration, failed=False):
+        """Record the outcome of a call that `allow()` let through."""
+        if self.slow_call_seconds is not None and duration > self.slow_call_seconds:
+            failed = True
+        now = time.monotonic()
+        opened = False
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+                if failed:
+                    self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+                    self._open(now)
+                    opened = True
+                else:
+                    self._close()
+                    logger.info("Circuit %s: trial call succeeded, closed", self.name)
+            elif self.state == CLOSED:
+                self._calls.append((now, failed))
+                while self._calls and self._calls[0][0] < now - self.window_seconds:
+                    self._calls.popleft()
+                failures = sum(1 for _, f in self._calls if f)
+                if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_rate:
+                    self.open_seconds = self.base_open_seconds
+                    self._open(now)
+                    opened = True
+        if opened and self.on_open is not None:
+            self.on_open(self)
+
+    def success(self, duration=0.0):
+        self.record(duration, failed=False)
+
+    def failure(self, duration=0.0):
+        self.record(duration, failed=True)
+
+    def reset(self):
+        """Close the breaker (e.g. after an operator or probe says it's fine)."""
+        with self._lock:
+            self._close()
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._calls.clear()
+        logger.error("Circuit %s: OPEN for %.0fs", self.name, self.open_seconds)
+
+    def _close(self):
+        self.state = CLOSED
+        self.opened_at = None
+        self.open_seconds = self.base_open_seconds
+        self._trial_running = False
+        self._calls.clear()
+
+    def stats(self):
+        with self._lock:
+            calls = len(self._calls)
+            failures = sum(1 for _, f in self._calls if f)
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = round(max(0.0, self.opened_at + self.open_seconds - time.monotonic()), 1)
+            return {
+                "state": self.state,
+                "recent_calls": calls,
+                "recent_failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "retry_in_seconds": retry_in,
+            }
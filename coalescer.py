@@ -0,0 +1,109 @@
+# ============================================================
+# Peyton & Charmed - Message Coalescing
+# Customers often send 3-5 short messages in a row. Instead of
+# asking Claude once per message, wait a moment and answer them
+# together in one reply.
+# ============================================================
+# A user's text messages are held until they stop typing for `window`
+# seconds (or `max_wait` seconds after the first one, whichever comes
+# first), then merged into a single event that uses the newest reply token.
+
+import copy
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EventCoalescer:
+    """Debounces text message events per user and merges them."""
+
+    def __init__(self, flush, window=1.5, max_wait=4.0):
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        # user_id -> {"events": [...], "first_at": t, "last_at": t}
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.merged_events = 0
+        self.flushed_batches = 0
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+            self._thread.start()
+
+    def add(self, user_id, event):
+        """Hold a text event until the user stops typing."""
+        now = time.monotonic()
+        with self._cond:
+            self._ensure_started()
+            pending = self._pending.setdefault(user_id, {"events": [], "first_at": now, "last_at": now})
+            pending["events"].append(event)
+            pending["last_at"] = now
+            self._cond.notify()
+
+    def flush_user(self, user_id):
+        """Send anything held for this user right away (keeps message order)."""
+        with self._cond:
+            pending = self._pending.pop(user_id, None)
+        if pending:
+            self._emit(pending["events"])
+
+    def flush_all(self):
+        """Send everything held right away (at shutdown)."""
+        with self._cond:
+            batches = [p["events"] for p in self._pending.values()]
+            self._pending.clear()
+        for events in batches:
+            self._emit(events)
+        return len(batches)
+
+    def pending_users(self):
+        return len(self._pending)
+
+    def _due_at(self, pending):
+        return min(pending["last_at"] + self.window, pending["first_at"] + self.max_wait)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [u for u, p in self._pending.items() if self._due_at(p) <= now]
+                if not due:
+                    next_due = min(self._due_at(p) for p in self._pending.values())
+                    self._cond.wait(timeout=max(0.0, next_due - now))
+                    continue
+                batches = [self._pending.pop(u)["events"] for u in due]
+            for events in batches:
+                self._emit(events)
+
+    def _emit(self, events):
+        try:
+            self.flush(merge_text_events(events))
+            self.flushed_batches += 1
+            self.merged_events += len(events) - 1
+        except Exception as e:
+            logger.error("Coalescer flush error: %s", e)
+
+
+def merge_text_events(events):
+    """Merge consecutive text message events into one.
+
+    The merged event is a copy of the newest event (freshest reply
+    token), with the texts joined by newlines. The separate texts are
+    kept in "_texts" for checks that must see each message on its own
+    (e.g. "I filled in the form").
+    """
+    if len(events) == 1:
+        return events[0]
+    merged = copy.deepcopy(events[-1])
+    texts = [e.get("message", {}).get("text", "") for e in events]
+    merged["message"]["text"] = "\n".join(texts)
+    merged["_texts"] = texts
+    merged["_coalesced"] = len(events)
+    return merged
@@ -0,0 +1,120 @@
+# ============================================================
+# Peyton & Charmed - Background Event Queue
+# Lets /callback answer LINE right away while a small pool of
+# worker threads does the slow work (Claude, LINE reply, email)
+# ============================================================
+# Events for the same user always go to the same worker, so a
+# customer's messages are still answered in the order they were sent.
+
+import os
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EventQueue:
+    """Bounded in-process queue served by a pool of worker threads.
+
+    Each worker owns its own queue. A user is pinned to one worker
+    (by hashing the user ID), which keeps that user's events in order
+    while different users are processed in parallel.
+    """
+
+    def __init__(self, handler, workers=4, max_size=1000, name="events"):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.max_size = max(1, int(max_size))
+        self.name = name
+        self._queues = []
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def _ensure_started(self):
+        """Start worker threads on first use (and again after a gunicorn fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            per_worker = max(1, self.max_size // self.workers)
+            self._queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+            self._threads = []
+            for i, q in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run, args=(q,), name=f"{self.name}-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+            logger.info("Event queue started: %s workers, %s max queued events", self.workers, self.max_size)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                self.handler(item)
+                self.processed += 1
+            except Exception:
+                self.errors += 1
+                logger.exception("Event worker error")
+            finally:
+                q.task_done()
+
+    def submit(self, key, item):
+        """Queue an item for background processing.
+
+        Returns False if the queue for this key is full, so the caller
+        can decide what to do instead (e.g. process it inline).
+        """
+        self._ensure_started()
+        q = self._queues[hash(key) % self.workers]
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def depth(self):
+        """Number of events waiting to be processed."""
+        return sum(q.qsize() for q in self._queues)
+
+    def join(self):
+        """Block until every queued event has been processed."""
+        for q in self._queues:
+            q.join()
+
+    def drain(self, timeout):
+        """Wait up to `timeout` seconds for queued events to finish (at shutdown).
+
+        Returns the number of events still unfinished.
+        """
+        if self._pid != os.getpid():
+            return 0  # this process never started workers
+        deadline = time.monotonic() + timeout
+        while True:
+            unfinished = sum(q.unfinished_tasks for q in self._queues)
+            if unfinished == 0 or time.monotonic() >= deadline:
+                return unfinished
+            time.sleep(0.05)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_size": self.max_size,
+            "depth": self.depth(),
+            "worker_depths": [q.qsize() for q in self._queues],
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
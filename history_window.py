@@ -0,0 +1,101 @@
+# ============================================================
+# Peyton & Charmed - Token-Budgeted History
+# Decides how much of the conversation to send to Claude
+# ============================================================
+# Instead of always sending the last 10 messages (however long they
+# are), keep the newest messages that fit in a token budget. Older
+# messages can optionally be squeezed into a short summary.
+#
+# Token counts are estimated locally (no API call). Thai text costs
+# far more tokens per character than English, so the two are counted
+# separately.
+
+import math
+
+# Rough per-message overhead (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """Cheap local estimate of how many tokens a text will use."""
+    ascii_chars = 0
+    other_chars = 0
+    for ch in text:
+        if ord(ch) < 128:
+            ascii_chars += 1
+        else:
+            other_chars += 1
+    # ~4 ASCII characters per token; Thai/emoji are roughly 1 token per character
+    return math.ceil(ascii_chars / 4) + other_chars
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def window_history(messages, budget):
+    """Keep the newest messages that fit in `budget` tokens.
+
+    The newest message (the customer's current question) is always kept;
+    if it alone is over the budget, it is cut to fit, so the tokens sent
+    never exceed the budget whatever the customer pastes in.
+    The window always starts with a customer message, as Claude expects.
+    Returns (kept, dropped).
+    """
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        cost = estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if not kept and cost > budget:
+            # Copy: the stored history keeps the full message
+            content = truncate_to_tokens(message["content"], budget - MESSAGE_OVERHEAD_TOKENS)
+            message = dict(message, content=content)
+            cost = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    while len(kept) > 1 and kept[0]["role"] != "user":
+        kept.pop(0)
+    dropped = messages[:len(messages) - len(kept)]
+    return kept, dropped
+
+
+def truncate_to_tokens(text, budget):
+    """The start of `text` that fits in `budget` estimated tokens (marked with "…")."""
+    if estimate_tokens(text) <= budget:
+        return text
+    budget -= 1  # the "…"
+    ascii_chars = 0
+    other_chars = 0
+    for end, ch in enumerate(text):
+        if ord(ch) < 128:
+            ascii_chars += 1
+        else:
+            other_chars += 1
+        if math.ceil(ascii_chars / 4) + other_chars > budget:
+            return text[:end] + "…"
+    return text
+
+
+def summarize_history(dropped, budget, customer_label="ลูกค้า", team_label="เรา"):
+    """Squeeze older messages into a short bullet list that fits `budget` tokens.
+
+    Newer messages get priority; each one is shortened to a snippet.
+    """
+    lines = []
+    used = 0
+    for message in reversed(dropped):
+        label = customer_label if message["role"] == "user" else team_label
+        snippet = " ".join(message["content"].split())
+        if len(snippet) > 80:
+            snippet = snippet[:80] + "…"
+        line = f"- {label}: {snippet}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    return "\n".join(lines)
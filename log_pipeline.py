@@ -0,0 +1,202 @@
+# ============================================================
+# Peyton & Charmed - Logging Pipeline
+# Keeps log I/O off the webhook and event worker threads
+# ============================================================
+# - Log calls only put the record on a queue; one background thread
+#   per process formats and writes it. A full queue drops the record
+#   (counted) instead of blocking a worker.
+# - Messages are formatted by that thread too, so hot-path log calls
+#   pass %-style arguments and pay nothing up front.
+# - Records are JSON lines (LOG_FORMAT=json) or plain text, and carry
+#   the request ID of the webhook they belong to, also on the event
+#   workers and async tasks that process its events later.
+# - INFO lines can be sampled (LOG_INFO_SAMPLE_RATE). Whole webhooks
+#   are kept or dropped together, so a kept request is never missing
+#   lines. Warnings and errors are always kept.
+# - Customer text is logged through UserText, which shows only its
+#   length when LOG_REDACT_TEXT is on.
+
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+import zlib
+
+# The webhook being handled (None outside a request)
+request_id = contextvars.ContextVar("request_id", default=None)
+
+_settings = {"redact_text": True}
+
+
+def new_request_id():
+    """Start a new request: a fresh ID for every log line that follows."""
+    value = uuid.uuid4().hex[:12]
+    request_id.set(value)
+    return value
+
+
+@contextlib.contextmanager
+def request_context(value):
+    """Log under `value` (e.g. an event's webhook) for the duration, then restore."""
+    token = request_id.set(value)
+    try:
+        yield
+    finally:
+        request_id.reset(token)
+
+
+class UserText:
+    """Customer text in a log line; redacted unless LOG_REDACT_TEXT is off."""
+
+    def __init__(self, text, limit=50):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self):
+        if _settings["redact_text"]:
+            return f"<{len(self.text)} chars>"
+        return self.text[:self.limit] + ("..." if len(self.text) > self.limit else "")
+
+
+class Deferred:
+    """A log argument computed only if the line is actually written."""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+class RequestFilter(logging.Filter):
+    """Adds the request ID and samples INFO lines (per request)."""
+
+    def __init__(self, sample_rate=1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.sampled_out = 0
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        if self.sample_rate >= 1 or record.levelno != logging.INFO:
+            return True
+        if record.request_id is not None:
+            keep = zlib.crc32(record.request_id.encode("ascii")) / 2 ** 32 < self.sample_rate
+        else:
+            keep = random.random() < self.sample_rate
+        if not keep:
+            self.sampled_out += 1
+        return keep
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """logging.basicConfig's lines, with the request ID (if any) in front."""
+
+    def format(self, record):
+        line = super().format(record)
+        request = getattr(record, "request_id", None)
+        return f"[{request}] {line}" if request else line
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks and starts its writer per process."""
+
+    def __init__(self, target, queue_size=10000):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Unlike the standard QueueHandler, leave formatting (and the
+        # arguments) to the writer thread
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        # After a gunicorn fork the parent's writer thread is gone
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Write out whatever is still queued (at exit)."""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+
+_handler = None
+_filter = None
+
+
+def configure(level="INFO", log_format="json", sample_rate=1.0, redact_text=True, queue_size=10000):
+    """Send all logging through the queue (replaces logging.basicConfig)."""
+    global _handler, _filter
+    _settings["redact_text"] = redact_text
+    target = logging.StreamHandler()
+    if log_format == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(TextFormatter("%(levelname)s:%(name)s:%(message)s"))
+    _filter = RequestFilter(sample_rate)
+    _handler = QueueLogHandler(target, queue_size)
+    _handler.addFilter(_filter)
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    atexit.register(_handler.stop)
+
+
+def stats():
+    if _handler is None:
+        return {"configured": False}
+    return {
+        "configured": True,
+        "queued": _handler.queue.qsize(),
+        "dropped": _handler.dropped,
+        "sampled_out": _filter.sampled_out,
+        "info_sample_rate": _filter.sample_rate,
+        "redact_text": _settings["redact_text"],
+    }
@@ -0,0 +1,149 @@
+# ============================================================
+# Peyton & Charmed - Metrics
+# Counters, gauges and latency histograms, served at /metrics in
+# the Prometheus text format
+# ============================================================
+# Metrics are kept per server process. With several gunicorn workers,
+# each scrape shows the worker that answered it.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+_registry = []
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose value is read from a function at scrape time."""
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, entry in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {entry[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {entry[-1]}")
+        return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================
+# Bot metrics
+# ============================================================
+SIGNATURE_SECONDS = Histogram("bot_signature_verify_seconds", "Time to verify the LINE signature")
+ZOHO_FORWARD_SECONDS = Histogram("bot_zoho_forward_seconds", "Time per Zoho forward attempt", ["outcome"])
+CLAUDE_SECONDS = Histogram("bot_claude_call_seconds", "Time per Claude call", ["mode"])
+CLAUDE_ROUTE_SECONDS = Histogram("bot_claude_route_seconds", "Time per Claude call by model route", ["route", "model"])
+LINE_REPLY_SECONDS = Histogram("bot_line_reply_seconds", "Time per LINE reply call")
+SMTP_SEND_SECONDS = Histogram("bot_smtp_send_seconds", "Time per notification email send", ["outcome"])
+CLAUDE_SLOT_WAIT_SECONDS = Histogram("bot_claude_slot_wait_seconds", "Time waiting for a free Claude slot")
+REPLY_TOTAL_SECONDS = Histogram("bot_reply_total_seconds", "Time from webhook arrival to LINE reply", ["mode"])
+
+EVENTS_TOTAL = Counter("bot_events_total", "LINE events received", ["event_type", "message_type"])
+REPLIES_TOTAL = Counter("bot_claude_replies_total", "Claude replies by mode", ["mode"])
+HANDOFFS_TOTAL = Counter("bot_handoffs_total", "Handoffs to the team", ["reason"])
+CLAUDE_ERRORS_TOTAL = Counter("bot_claude_errors_total", "Claude calls that failed or missed the deadline", ["kind"])
+LINE_ERRORS_TOTAL = Counter("bot_line_errors_total", "LINE API calls that did not return 200", ["status"])
+DUPLICATE_EVENTS_TOTAL = Counter("bot_duplicate_events_total", "Redelivered webhook events skipped as duplicates", ["event_type", "message_type"])
+REDELIVERED_EVENTS_TOTAL = Counter("bot_redelivered_events_total", "Events LINE marked as redelivered", ["outcome"])
+CLAUDE_ROUTE_TOKENS_TOTAL = Counter("bot_claude_route_tokens_total", "Claude tokens by model route", ["route", "kind"])
+CLAUDE_ESCALATIONS_TOTAL = Counter("bot_claude_escalations_total", "Fast-model replies asked again on the main model", ["route", "reason"])
+PUSH_FALLBACKS_TOTAL = Counter("bot_push_fallbacks_total", "Replies sent with the push API (reply token expired, or held while LINE was failing)", ["reason"])
+CAMPAIGN_RECIPIENTS_TOTAL = Counter("bot_campaign_recipients_total", "Reminder campaign messages sent (one per recipient)")
+RATE_LIMITED_TOTAL = Counter("bot_rate_limited_total", "Replies replaced by a canned reply because of a rate limit", ["limit"])
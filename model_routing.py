@@ -0,0 +1,117 @@
+# ============================================================
+# Peyton & Charmed - Model Routing
+# Picks the Claude model and reply length for each message
+# ============================================================
+# MODE A and MODE C replies only greet, nudge and point back to the
+# form (see system_prompt.py), so by default they go to a fast, cheap
+# model with a short reply. MODE B answers real FAQ questions and
+# gets the main model.
+#
+# Routes are set with MODEL_ROUTES, "<route>=<model>:<max tokens>":
+#   A=fast:300,A.long=main:500,C=fast:200,C.long=main:500,B=main:500
+# "<mode>.long" is used when the customer's message is longer than
+# MODEL_ROUTE_LONG_MESSAGE_CHARS (a real question rather than "hi").
+# The model is "fast", "main" or a full model name.
+#
+# A fast-model reply that looks unsure (empty, cut off at the token
+# limit, or handing off to the team) is asked again on the main model.
+
+import threading
+
+DEFAULT_ROUTES = "A=fast:300,A.long=main:500,C=fast:200,C.long=main:500,B=main:500"
+
+
+class Route:
+    def __init__(self, name, model, max_tokens):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def __repr__(self):
+        return f"Route({self.name}: {self.model}, {self.max_tokens} tokens)"
+
+
+def parse_routes(text, main_model, fast_model):
+    """Parse MODEL_ROUTES into {route name: Route}."""
+    aliases = {"main": main_model, "fast": fast_model}
+    routes = {}
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        name, _, target = part.partition("=")
+        model, _, max_tokens = target.rpartition(":")
+        if not model or not max_tokens.isdigit():
+            raise ValueError(f"Bad model route {part!r}, expected e.g. A=fast:300")
+        routes[name.strip()] = Route(name.strip(), aliases.get(model, model), int(max_tokens))
+    return routes
+
+
+class ModelRouter:
+    def __init__(self, routes, main_model, main_max_tokens, long_message_chars=200, escalate=True):
+        self.routes = routes
+        self.main_model = main_model
+        self.main_max_tokens = main_max_tokens
+        self.long_message_chars = long_message_chars
+        self.escalate = escalate
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def route_for(self, mode, user_message):
+        if len(user_message) > self.long_message_chars and f"{mode}.long" in self.routes:
+            return self.routes[f"{mode}.long"]
+        return self.routes.get(mode) or Route(mode, self.main_model, self.main_max_tokens)
+
+    def escalation_for(self, route, reply, output_tokens):
+        """(route to ask again on, reason), or (None, None) if the reply will do."""
+        if not self.escalate or route.model == self.main_model:
+            return None, None
+        if not reply.strip():
+            reason = "empty"
+        elif output_tokens >= route.max_tokens:
+            reason = "truncated"
+        elif "[HANDOFF]" in reply:
+            reason = "handoff"
+        else:
+            return None, None
+        return Route(f"{route.name}>main", self.main_model, self.main_max_tokens), reason
+
+    def record_escalation(self, route, reason):
+        with self._lock:
+            escalations = self._route_stats(route.name)["escalations"]
+            escalations[reason] = escalations.get(reason, 0) + 1
+
+    def record(self, route, seconds, usage=None, failed=False):
+        with self._lock:
+            stats = self._route_stats(route.name)
+            stats["model"] = route.model
+            stats["calls"] += 1
+            stats["failed"] += 1 if failed else 0
+            stats["seconds"] += seconds
+            if usage is not None:
+                stats["input_tokens"] += usage.input_tokens
+                stats["output_tokens"] += usage.output_tokens
+
+    def _route_stats(self, name):
+        if name not in self._stats:
+            self._stats[name] = {"model": None, "calls": 0, "failed": 0, "seconds": 0.0,
+                                 "input_tokens": 0, "output_tokens": 0, "escalations": {}}
+        return self._stats[name]
+
+    def stats(self):
+        with self._lock:
+            routes = {}
+            for name, s in self._stats.items():
+                calls = s["calls"] or 1
+                routes[name] = {
+                    "model": s["model"],
+                    "calls": s["calls"],
+                    "failed": s["failed"],
+                    "avg_seconds": round(s["seconds"] / calls, 3),
+                    "avg_input_tokens": round(s["input_tokens"] / calls),
+                    "avg_output_tokens": round(s["output_tokens"] / calls),
+                    "escalations": dict(s["escalations"]),
+                }
+        return {
+            "policy": {name: f"{r.model}:{r.max_tokens}" for name, r in self.routes.items()},
+            "long_message_chars": self.long_message_chars,
+            "escalate": self.escalate,
+            "routes": routes,
+        }
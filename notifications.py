@@ -0,0 +1,253 @@
+# ============================================================
+# Peyton & Charmed - Team Notification Dispatcher
+# Sends handoff emails from a background thread so the webhook
+# never waits for SMTP
+# ============================================================
+# - One SMTP connection is kept open and reused between emails
+# - Handoffs that arrive close together are sent as one digest email
+# - Connection problems are retried with backoff
+# - At shutdown, flush() sends whatever is queued or being batched
+#   straight away (the thread is a daemon and would just stop)
+#
+# For local testing, point SMTP_SERVER/SMTP_PORT at a stand-in such as
+# `python -m aiosmtpd -n -l localhost:8025` with SMTP_STARTTLS=false and
+# SMTP_AUTH=false.
+
+import os
+import queue
+import smtplib
+import threading
+import time
+import logging
+from datetime import datetime
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue by flush() to wake the sender from its batch window
+_WAKE = object()
+
+TOPIC_SUBJECTS = {
+    "booking": "New Booking Request",
+    "payment": "Payment Inquiry",
+    "contract": "Contract Question",
+    "visa": "Visa Support Request",
+    "customer_needs_help": "Customer Needs Help",
+    "unknown": "Customer Needs Help"
+}
+
+
+def format_notification(user_message, handoff_reason, when):
+    """Email subject and body for a single handoff."""
+    subject = TOPIC_SUBJECTS.get(handoff_reason, "Customer Needs Help")
+    if len(user_message) > 200:
+        user_message = user_message[:200] + "..."
+    body = f"""
+A customer needs team assistance:
+
+Topic: {handoff_reason.title()}
+Customer Message: "{user_message}"
+
+Please check Zoho CRM for full customer details and follow up accordingly.
+
+Time: {when.strftime('%Y-%m-%d %H:%M:%S')}
+
+---
+Peyton & Charmed Bot Alert System
+"""
+    return subject, body
+
+
+def format_digest(items):
+    """Email subject and body for several handoffs sent together."""
+    if len(items) == 1:
+        return format_notification(*items[0])
+    lines = [f"\n{len(items)} customers need team assistance:\n"]
+    for i, (user_message, handoff_reason, when) in enumerate(items, 1):
+        if len(user_message) > 200:
+            user_message = user_message[:200] + "..."
+        lines.append(
+            f"{i}. [{when.strftime('%H:%M:%S')}] Topic: {handoff_reason.title()}\n"
+            f"   Customer Message: \"{user_message}\"\n"
+        )
+    lines.append(
+        "Please check Zoho CRM for full customer details and follow up accordingly.\n\n"
+        "---\nPeyton & Charmed Bot Alert System\n"
+    )
+    return f"{len(items)} Customers Need Help", "\n".join(lines)
+
+
+class NotificationDispatcher:
+    """Queues handoff notifications and emails them in the background."""
+
+    def __init__(self, smtp_server, smtp_port, sender_email, sender_password, recipients,
+                 starttls=True, auth=True, batch_window=5.0, max_batch=20,
+                 max_retries=3, max_queue=1000):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.recipients = recipients
+        self.starttls = starttls
+        self.auth = auth
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._server = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._flushing = threading.Event()
+        self.sent_emails = 0
+        self.sent_notifications = 0
+        self.failed_notifications = 0
+
+    def is_configured(self):
+        if not self.recipients:
+            return False
+        if self.auth and not (self.sender_email and self.sender_password):
+            return False
+        return bool(self.sender_email)
+
+    def notify(self, user_message, handoff_reason):
+        """Queue a notification. Never blocks the caller."""
+        if not self.recipients:
+            logger.warning("TEAM_EMAIL_ADDRESSES not set, skipping team notification")
+            return
+        if not self.is_configured():
+            logger.warning("Email credentials not configured, skipping notification")
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((user_message, handoff_reason, datetime.now()))
+        except queue.Full:
+            self.failed_notifications += 1
+            logger.error("Notification queue full, dropping team notification")
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout):
+        """Send everything queued now, waiting up to `timeout` seconds (at shutdown).
+
+        The batch window and retry pauses are cut short. Returns the
+        number of notifications still unsent.
+        """
+        if self._pid != os.getpid():
+            return 0  # nothing was queued in this process
+        self._flushing.set()
+        try:
+            self._queue.put_nowait(_WAKE)
+        except queue.Full:
+            pass  # the sender isn't waiting then
+        deadline = time.monotonic() + timeout
+        while True:
+            unfinished = self._queue.unfinished_tasks
+            if unfinished == 0 or time.monotonic() >= deadline:
+                return unfinished
+            time.sleep(0.05)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._server = None
+            self._thread = threading.Thread(target=self._run, name="notifications", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _WAKE:
+                self._queue.task_done()
+                continue
+            items = [item]
+            # Collect anything else that arrives shortly after into one digest
+            # (only what is already queued once flush() has been called)
+            deadline = time.monotonic() + self.batch_window
+            while len(items) < self.max_batch:
+                remaining = 0.0 if self._flushing.is_set() else deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=max(0.0, remaining))
+                except queue.Empty:
+                    break
+                if item is _WAKE:
+                    self._queue.task_done()
+                else:
+                    items.append(item)
+            try:
+                self._send_with_retries(items)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _send_with_retries(self, items):
+        subject, body = format_digest(items)
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self._send(subject, body)
+                metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+                self.sent_emails += 1
+                self.sent_notifications += len(items)
+                logger.info("Team notification email sent to %s recipients (%s handoffs)", len(self.recipients), len(items))
+                return
+            except smtplib.SMTPAuthenticationError as e:
+                metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - started, outcome="auth_error")
+                logger.error("SMTP login failed, not retrying: %s", e)
+                break
+            except Exception as e:
+                metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - started, outcome="error")
+                logger.error("Failed to send team notification email (attempt %s): %s", attempt + 1, e)
+                self._close()
+                if attempt < self.max_retries:
+                    self._flushing.wait(2 ** attempt)
+        self.failed_notifications += len(items)
+
+    def _connection(self):
+        """Reuse the open SMTP connection if it is still alive."""
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except Exception:
+                pass
+            self._close()
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.auth:
+            server.login(self.sender_email, self.sender_password)
+        self._server = server
+        return server
+
+    def _send(self, subject, body):
+        message = MIMEMultipart()
+        message["From"] = self.sender_email
+        message["To"] = ", ".join(self.recipients)
+        message["Subject"] = subject
+        message.attach(MIMEText(body, "plain"))
+        self._connection().sendmail(self.sender_email, self.recipients, message.as_string())
+
+    def _close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def stats(self):
+        return {
+            "pending": self.pending(),
+            "sent_emails": self.sent_emails,
+            "sent_notifications": self.sent_notifications,
+            "failed_notifications": self.failed_notifications,
+        }
@@ -0,0 +1,136 @@
+# ============================================================
+# Peyton & Charmed - Outbox
+# Keeps what couldn't be sent yet (Zoho forwards, LINE messages while
+# LINE's circuit is open) and sends it once the service is back
+# ============================================================
+# - Entries are rows in the shared SQLite file, so they survive a
+#   restart or deploy and any worker can send them.
+# - One background thread per process sends entries, oldest first,
+#   every `retry_seconds`. A worker claims a few entries for
+#   `lease_seconds` before sending them; if it dies mid-send, another
+#   worker picks them up once the lease runs out.
+# - The first entry that fails is put back and ends the round, so a
+#   service that is still down gets one call per round, not one per
+#   entry.
+# - Each kind of entry has its own send function, which returns True
+#   once the entry has been delivered.
+
+import os
+import json
+import threading
+import time
+import uuid
+import logging
+
+from state_store import SqliteDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    def __init__(self, path, senders, retry_seconds=30, lease_seconds=120, batch_size=50):
+        self.db = SqliteDatabase(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " claimed_by TEXT,"
+            " claimed_until REAL NOT NULL DEFAULT 0)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_kind ON outbox (kind, id)")
+        # kind -> send(payload) -> True if delivered
+        self.senders = senders
+        self.retry_seconds = retry_seconds
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.held = 0
+        self.sent = 0
+        self.failed_attempts = 0
+        self._wake = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, kind, payload):
+        """Keep `payload` to be sent later by the sender for `kind`."""
+        self.db.execute(
+            "INSERT INTO outbox (kind, payload, created_at) VALUES (?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        self.held += 1
+        self.start()
+
+    def start(self):
+        """Start the background sender (once per process)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="outbox", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.retry_seconds)
+            self._wake.clear()
+            try:
+                self.send_due()
+            except Exception:
+                logger.exception("Outbox: send round failed")
+
+    def send_due(self):
+        """Send what is waiting, kind by kind, until something fails. Returns the number sent."""
+        sent = 0
+        for kind, send in self.senders.items():
+            entries = self._claim(kind)
+            for position, (entry_id, payload) in enumerate(entries):
+                try:
+                    delivered = send(json.loads(payload))
+                except Exception:
+                    logger.exception("Outbox: sending %s entry %s failed", kind, entry_id)
+                    delivered = False
+                if not delivered:
+                    self.failed_attempts += 1
+                    self._release([e[0] for e in entries[position:]], failed=entry_id)
+                    break
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+                self.sent += 1
+                sent += 1
+        if sent:
+            logger.info("Outbox: sent %s held entries", sent)
+        return sent
+
+    def _claim(self, kind):
+        owner = uuid.uuid4().hex
+        now = time.time()
+        self.db.execute(
+            "UPDATE outbox SET claimed_by = ?, claimed_until = ? WHERE id IN ("
+            " SELECT id FROM outbox WHERE kind = ? AND claimed_until < ? ORDER BY id LIMIT ?)",
+            (owner, now + self.lease_seconds, kind, now, self.batch_size),
+        )
+        return self.db.execute(
+            "SELECT id, payload FROM outbox WHERE claimed_by = ? ORDER BY id", (owner,)
+        ).fetchall()
+
+    def _release(self, entry_ids, failed):
+        self.db.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (failed,))
+        self.db.execute(
+            f"UPDATE outbox SET claimed_by = NULL, claimed_until = 0 WHERE id IN ({','.join('?' * len(entry_ids))})",
+            entry_ids,
+        )
+
+    def pending(self):
+        """{kind: entries waiting} across all workers."""
+        return dict(self.db.execute("SELECT kind, COUNT(*) FROM outbox GROUP BY kind").fetchall())
+
+    def stats(self):
+        return {
+            "pending": self.pending(),
+            "held": self.held,
+            "sent": self.sent,
+            "failed_attempts": self.failed_attempts,
+            "retry_seconds": self.retry_seconds,
+        }
@@ -0,0 +1,144 @@
+# ============================================================
+# Peyton & Charmed - Rate Limits
+# Keeps one busy customer (or a burst of campaign traffic) from
+# using up the Anthropic rate limit for everyone else.
+# ============================================================
+# - UserRateLimiter: a token bucket per customer (messages per minute,
+#   with a small burst allowance)
+# - TokenBudget: a shared budget of Claude tokens per minute
+#
+# The cap on Claude calls running at once is a plain semaphore in
+# app.py / asgi_app.py. All limits are per server process.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount=1):
+        """Take `amount` tokens if available. Returns True on success."""
+        self._refill(time.monotonic())
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def give_back(self, amount):
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class UserRateLimiter:
+    """A token bucket per user; the least recently active are forgotten first."""
+
+    def __init__(self, per_minute, burst, max_users=10000):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.per_minute > 0
+
+    def allow(self, user_id):
+        if not self.enabled:
+            return True
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.per_minute / 60, max(1, self.burst))
+                while len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(user_id)
+            ok = bucket.take()
+            if ok:
+                self.allowed += 1
+            else:
+                self.limited += 1
+            return ok
+
+    def forget(self, user_id):
+        with self._lock:
+            self._buckets.pop(user_id, None)
+
+    def stats(self):
+        return {
+            "per_minute": self.per_minute,
+            "burst": self.burst,
+            "tracked_users": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+
+class TokenBudget:
+    """Claude tokens per minute shared by every customer.
+
+    Each call reserves an estimate up front; once the real usage is
+    known the difference is settled, so the budget tracks actual spend.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        # Up to a minute's worth can be spent in one burst
+        self._bucket = TokenBucket(per_minute / 60, per_minute)
+        self._lock = threading.Lock()
+        self.reserved = 0
+        self.used = 0
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.per_minute > 0
+
+    def reserve(self, tokens):
+        if not self.enabled:
+            return True
+        with self._lock:
+            if not self._bucket.take(tokens):
+                self.limited += 1
+                return False
+            self.reserved += tokens
+            return True
+
+    def settle(self, reserved, actual):
+        """Correct a reservation with the real token count."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.used += actual
+            # Over-estimates go back; under-estimates are charged now
+            # (the bucket may go briefly negative)
+            self._bucket.give_back(reserved - actual)
+
+    def available(self):
+        with self._lock:
+            self._bucket._refill(time.monotonic())
+            return int(self._bucket.tokens)
+
+    def stats(self):
+        return {
+            "per_minute": self.per_minute,
+            "available": self.available() if self.enabled else None,
+            "reserved": self.reserved,
+            "used": self.used,
+            "limited": self.limited,
+        }
@@ -0,0 +1,122 @@
+# ============================================================
+# Peyton & Charmed - Reply Cache
+# MODE B customers ask the same FAQ questions over and over
+# (prices, contracts, visa, deposits). Answer exact repeats from
+# a cache instead of asking Claude again.
+# ============================================================
+# - Questions are normalised first (case, spaces, punctuation, emoji and
+#   polite endings like ค่ะ/ครับ are ignored)
+# - Entries expire after a TTL, and the least recently used are dropped
+#   when the cache is full
+# - The prompt version is part of every key, so editing system_prompt.py
+#   automatically makes old answers unreachable
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Greetings at the start and polite endings at the end don't change the
+# question. (Only at the ends: ค่า/คะ also appear inside words like ค่ามัดจำ.)
+_LEADING = re.compile(r"^(?:สวัสดี(?:ค่ะ|ครับ|คะ)?|พี่(?:คะ|ครับ)?|hi|hello|hey)+")
+_TRAILING = re.compile(r"(?:ค่ะ|ค่า|คะ|ครับ|คับ|นะ|จ้า|จ้ะ|หน่อย|please|pls|ka|kha|krub|krab)+$")
+_NOT_WORD = re.compile(r"[^\w\u0e00-\u0e7f]+")
+
+
+def normalize_question(text):
+    """Reduce a question to a stable cache key."""
+    text = unicodedata.normalize("NFC", text).lower()
+    text = _NOT_WORD.sub("", text)
+    text = _LEADING.sub("", text)
+    return _TRAILING.sub("", text)
+
+
+def prompt_version(*prompts):
+    """Short hash identifying the prompt text in use."""
+    digest = hashlib.sha256()
+    for prompt in prompts:
+        digest.update(prompt.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:12]
+
+
+class ReplyCache:
+    """LRU cache with TTL for replies keyed on (prompt version, mode, question)."""
+
+    def __init__(self, version, ttl_seconds=3600, max_entries=500, min_chars=4, max_chars=200):
+        self.version = version
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self.saved_output_tokens = 0
+
+    @property
+    def enabled(self):
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def _key(self, mode, question):
+        normalized = normalize_question(question)
+        if not self.min_chars <= len(normalized) <= self.max_chars:
+            return None
+        return (self.version, mode, normalized)
+
+    def get(self, mode, question):
+        """Return a cached reply, or None."""
+        key = self._key(mode, question)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry["seconds"]
+            self.saved_output_tokens += entry["output_tokens"]
+            return entry["reply"]
+
+    def put(self, mode, question, reply, seconds=0.0, output_tokens=0):
+        """Remember a reply (with what it cost to generate)."""
+        key = self._key(mode, question)
+        if key is None:
+            return
+        with self._lock:
+            self._entries[key] = {
+                "reply": reply,
+                "expires": time.monotonic() + self.ttl_seconds,
+                "seconds": seconds,
+                "output_tokens": output_tokens,
+            }
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "prompt_version": self.version,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "saved_seconds": round(self.saved_seconds, 2),
+            "saved_output_tokens": self.saved_output_tokens,
+        }
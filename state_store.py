@@ -0,0 +1,482 @@
+# ============================================================
+# Peyton & Charmed - State Storage
+# Form tracking and conversation history
+# ============================================================
+# Two form stores are available (FORM_STORE environment variable):
+#   - "sqlite" (default): one row per customer in an SQLite database in
+#     WAL mode. Each update is a single-row write, crash-safe, and every
+#     gunicorn worker sees the same data.
+#   - "json": the original form_tracking.json file, rewritten in full on
+#     every change. Kept for compatibility only.
+#
+# The first time the SQLite store opens, it imports the old JSON file.
+
+import os
+import json
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFormStore:
+    """Form tracking kept in memory and rewritten to a JSON file on change."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        data = self._load()
+        self.completed = set(data.get("completed", []))
+        self.link_sent = set(data.get("link_sent", []))
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error("Error loading form data: %s", e)
+        return {"completed": [], "link_sent": []}
+
+    def _save(self):
+        try:
+            data = {"completed": list(self.completed), "link_sent": list(self.link_sent)}
+            with open(self.path, "w") as f:
+                json.dump(data, f)
+        except Exception as e:
+            logger.error("Error saving form data: %s", e)
+
+    def mark_completed(self, user_id):
+        with self._lock:
+            self.completed.add(user_id)
+            self._save()
+
+    def is_completed(self, user_id):
+        return user_id in self.completed
+
+    def mark_link_sent(self, user_id):
+        with self._lock:
+            self.link_sent.add(user_id)
+            self._save()
+
+    def is_link_sent(self, user_id):
+        return user_id in self.link_sent
+
+    def status(self, user_id):
+        """(completed, link_sent) for one user."""
+        return user_id in self.completed, user_id in self.link_sent
+
+    def waiting_for_form(self, after="", limit=500, updated_before=None):
+        """Users who got the link but haven't completed the form, in ID order.
+
+        `updated_before` is ignored: this store keeps no timestamps.
+        """
+        waiting = sorted(u for u in self.link_sent - self.completed if u > after)
+        return waiting[:limit]
+
+    def counts(self):
+        return {"completed": len(self.completed), "link_sent": len(self.link_sent)}
+
+
+class SqliteDatabase:
+    """A WAL-mode SQLite file shared by all threads and worker processes.
+
+    Each thread gets its own connection (SQLite connections can't be
+    shared between threads), and connections are reopened after a fork.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params)
+
+
+class SqliteFormStore:
+    """Form tracking with one SQLite row per customer."""
+
+    def __init__(self, path, legacy_json_path=None):
+        self.db = SqliteDatabase(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS form_state ("
+            " user_id TEXT PRIMARY KEY,"
+            " completed INTEGER NOT NULL DEFAULT 0,"
+            " link_sent INTEGER NOT NULL DEFAULT 0,"
+            " updated_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_json_path:
+            self._migrate_json(legacy_json_path)
+
+    def _migrate_json(self, json_path):
+        """Import the old form_tracking.json once."""
+        done = self.db.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done or not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error("Error reading %s for migration: %s", json_path, e)
+            return
+        conn = self.db.connect()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for user_id in data.get("link_sent", []):
+                conn.execute(
+                    "INSERT INTO form_state (user_id, link_sent, updated_at) VALUES (?, 1, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET link_sent = 1",
+                    (user_id, now),
+                )
+            for user_id in data.get("completed", []):
+                conn.execute(
+                    "INSERT INTO form_state (user_id, completed, updated_at) VALUES (?, 1, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET completed = 1",
+                    (user_id, now),
+                )
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(now),))
+        logger.info(
+            f"Migrated form data from {json_path}: {len(data.get('completed', []))} completed, "
+            f"{len(data.get('link_sent', []))} link sent"
+        )
+
+    def _set(self, user_id, column):
+        self.db.execute(
+            f"INSERT INTO form_state (user_id, {column}, updated_at) VALUES (?, 1, ?)"
+            f" ON CONFLICT(user_id) DO UPDATE SET {column} = 1, updated_at = excluded.updated_at",
+            (user_id, time.time()),
+        )
+
+    def _get(self, user_id, column):
+        row = self.db.execute(f"SELECT {column} FROM form_state WHERE user_id = ?", (user_id,)).fetchone()
+        return bool(row and row[0])
+
+    def mark_completed(self, user_id):
+        self._set(user_id, "completed")
+
+    def is_completed(self, user_id):
+        return self._get(user_id, "completed")
+
+    def mark_link_sent(self, user_id):
+        self._set(user_id, "link_sent")
+
+    def is_link_sent(self, user_id):
+        return self._get(user_id, "link_sent")
+
+    def status(self, user_id):
+        """(completed, link_sent) for one user, in one query."""
+        row = self.db.execute(
+            "SELECT completed, link_sent FROM form_state WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return (bool(row[0]), bool(row[1])) if row else (False, False)
+
+    def waiting_for_form(self, after="", limit=500, updated_before=None):
+        """Users who got the link but haven't completed the form, in ID order
+        (pages continue from `after`), optionally only those last updated
+        before `updated_before` (a time.time() value)."""
+        rows = self.db.execute(
+            "SELECT user_id FROM form_state WHERE link_sent = 1 AND completed = 0"
+            " AND user_id > ? AND updated_at <= ? ORDER BY user_id LIMIT ?",
+            (after, updated_before if updated_before is not None else float("inf"), limit),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self):
+        row = self.db.execute(
+            "SELECT COALESCE(SUM(completed), 0), COALESCE(SUM(link_sent), 0) FROM form_state"
+        ).fetchone()
+        return {"completed": row[0], "link_sent": row[1]}
+
+
+def create_form_store(kind, db_path, json_path):
+    """Create the form store selected by FORM_STORE."""
+    if kind == "json":
+        return JsonFormStore(json_path)
+    return SqliteFormStore(db_path, legacy_json_path=json_path)
+
+
+# ============================================================
+# CONVERSATION HISTORY
+# ============================================================
+# Two history stores are available (STATE_BACKEND environment variable):
+#   - "memory" (default): per-process, bounded LRU. Fine with a single worker.
+#   - "sqlite": rows in the shared SQLite file, so every gunicorn worker
+#     (and every instance sharing the disk) sees the same conversation.
+
+
+class MemoryHistoryStore:
+    """Recent messages per user, kept in this process only.
+
+    Users are kept in least-recently-active order, so expiring old
+    conversations only looks at the users that actually expired, and
+    the oldest users are dropped first when `max_users` is reached.
+    Each user's messages are a ring buffer of `max_messages`.
+    """
+
+    def __init__(self, max_messages=10, max_users=10000):
+        self.max_messages = max_messages
+        self.max_users = max_users
+        # user_id -> [deque of (role, content), last_active epoch seconds]
+        self._histories = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def append(self, user_id, role, content):
+        with self._lock:
+            entry = self._histories.get(user_id)
+            if entry is None:
+                entry = self._histories[user_id] = [deque(maxlen=self.max_messages), 0.0]
+            else:
+                self._histories.move_to_end(user_id)
+            entry[0].append((role, content))
+            entry[1] = time.time()
+            while len(self._histories) > self.max_users:
+                self._histories.popitem(last=False)
+                self.evicted += 1
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._histories.get(user_id)
+            if entry is None:
+                return []
+            return [{"role": role, "content": content} for role, content in entry[0]]
+
+    def clear(self, user_id):
+        with self._lock:
+            self._histories.pop(user_id, None)
+
+    def clean_expired(self, max_age_seconds):
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            while self._histories:
+                user_id, entry = next(iter(self._histories.items()))
+                if entry[1] >= cutoff:
+                    break
+                del self._histories[user_id]
+
+    def count(self):
+        return len(self._histories)
+
+
+class SqliteHistoryStore:
+    """Recent messages per user, shared through an SQLite file."""
+
+    def __init__(self, path, max_messages=10):
+        self.max_messages = max_messages
+        self.db = SqliteDatabase(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id TEXT NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " ts REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS history_user ON history (user_id, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS history_ts ON history (ts)")
+
+    def append(self, user_id, role, content):
+        conn = self.db.connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO history (user_id, role, content, ts) VALUES (?, ?, ?, ?)",
+                (user_id, role, content, time.time()),
+            )
+            # Keep only the newest max_messages rows for this user
+            conn.execute(
+                "DELETE FROM history WHERE user_id = ? AND id <= ("
+                " SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (user_id, user_id, self.max_messages),
+            )
+
+    def get(self, user_id):
+        rows = self.db.execute(
+            "SELECT role, content FROM ("
+            " SELECT id, role, content FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?)"
+            " ORDER BY id",
+            (user_id, self.max_messages),
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def clear(self, user_id):
+        self.db.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+
+    def clean_expired(self, max_age_seconds):
+        # Both sides of this use the ts index, so only old rows are visited
+        cutoff = time.time() - max_age_seconds
+        self.db.execute(
+            "DELETE FROM history WHERE ts < ? AND user_id NOT IN ("
+            " SELECT user_id FROM history WHERE ts >= ?)",
+            (cutoff, cutoff),
+        )
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(DISTINCT user_id) FROM history").fetchone()[0]
+
+
+def create_history_store(kind, db_path, max_messages, max_users=10000):
+    """Create the conversation history store selected by STATE_BACKEND."""
+    if kind == "sqlite":
+        return SqliteHistoryStore(db_path, max_messages=max_messages)
+    return MemoryHistoryStore(max_messages=max_messages, max_users=max_users)
+
+
+# ============================================================
+# SEEN WEBHOOK EVENTS (redelivery dedup)
+# ============================================================
+# LINE redelivers a webhook if we answer too slowly, with the same
+# webhookEventId. Remembering recent IDs lets a redelivered event be
+# skipped before it costs another Claude call or team email.
+#   - "sqlite" (default): shared by every gunicorn worker
+#   - "memory": per process only
+
+
+class MemorySeenEvents:
+    """Recently seen event IDs in this process, oldest first."""
+
+    def __init__(self, ttl_seconds=3600, max_entries=100000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # event_id -> expiry (monotonic seconds)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, event_id):
+        """Remember an event. Returns False if it was already seen."""
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest, expires = next(iter(self._seen.items()))
+                if expires >= now and len(self._seen) < self.max_entries:
+                    break
+                del self._seen[oldest]
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now + self.ttl_seconds
+            return True
+
+    def count(self):
+        return len(self._seen)
+
+
+class SqliteSeenEvents:
+    """Recently seen event IDs in the shared SQLite file."""
+
+    # Expired and surplus rows are removed at most this often
+    CLEAN_INTERVAL_SECONDS = 60
+
+    def __init__(self, path, ttl_seconds=3600, max_entries=100000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.db = SqliteDatabase(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS seen_events ("
+            " event_id TEXT PRIMARY KEY,"
+            " seen_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS seen_events_ts ON seen_events (seen_at)")
+        self._last_clean = 0.0
+
+    def add(self, event_id):
+        """Remember an event. Returns False if it was already seen."""
+        now = time.time()
+        # Inserts a new ID, or reclaims one whose entry has expired;
+        # one statement, so two workers can't both claim the same event
+        cursor = self.db.execute(
+            "INSERT INTO seen_events (event_id, seen_at) VALUES (?, ?)"
+            " ON CONFLICT (event_id) DO UPDATE SET seen_at = excluded.seen_at"
+            " WHERE seen_events.seen_at < ?",
+            (event_id, now, now - self.ttl_seconds),
+        )
+        if now - self._last_clean >= self.CLEAN_INTERVAL_SECONDS:
+            self._last_clean = now
+            self._clean(now)
+        return cursor.rowcount == 1
+
+    def _clean(self, now):
+        self.db.execute("DELETE FROM seen_events WHERE seen_at < ?", (now - self.ttl_seconds,))
+        self.db.execute(
+            "DELETE FROM seen_events WHERE seen_at < ("
+            " SELECT seen_at FROM seen_events ORDER BY seen_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_entries - 1,),
+        )
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM seen_events").fetchone()[0]
+
+
+def create_seen_events(kind, db_path, ttl_seconds, max_entries):
+    """Create the seen-events index selected by DEDUP_BACKEND."""
+    if kind == "memory":
+        return MemorySeenEvents(ttl_seconds=ttl_seconds, max_entries=max_entries)
+    return SqliteSeenEvents(db_path, ttl_seconds=ttl_seconds, max_entries=max_entries)
+
+
+# ============================================================
+# SHARED SETTINGS
+# ============================================================
+# Small key/value flags that every worker must agree on (e.g. the
+# forwarding-only switch), stored in the shared SQLite file.
+
+
+class SqliteKeyValue:
+    def __init__(self, path):
+        self.db = SqliteDatabase(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def get_many(self, prefix):
+        rows = self.db.execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ?", (prefix, prefix + "￿")
+        ).fetchall()
+        return dict(rows)
+
+    def set(self, key, value):
+        self.db.execute(
+            "INSERT INTO kv (key, value, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (key, value, time.time()),
+        )
+
+    def add(self, key, value):
+        """Set `key` only if it doesn't exist yet. Returns True if it did."""
+        cursor = self.db.execute(
+            "INSERT OR IGNORE INTO kv (key, value, updated_at) VALUES (?, ?, ?)", (key, value, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def compare_and_set(self, key, expected, value):
+        """Set `key` only if it still holds `expected`. Returns True if it did."""
+        cursor = self.db.execute(
+            "UPDATE kv SET value = ?, updated_at = ? WHERE key = ? AND value = ?",
+            (value, time.time(), key, expected),
+        )
+        return cursor.rowcount == 1
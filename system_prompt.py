@@ -200,3 +200,39 @@ SYSTEM_PROMPT_MODE_B = """
 - ห้ามตอบเรื่องที่ไม่เกี่ยวกับที่พักนักศึกษา
 - ห้ามพูดว่า [HANDOFF] ออกมาตรงๆ ในข้อความ ให้แนบท้ายเท่านั้น
 """.strip()
+
+# ============================================================
+# Per-customer form link (MODE A)
+# ============================================================
+# The prompts above are sent with Anthropic prompt caching, so they must
+# be the same for every customer. The customer's own form link is sent in
+# a separate small block right after MODE A, starting with this text.
+FORM_LINK_INSTRUCTION = "ลิงก์ฟอร์มของลูกค้าคนนี้ (ใช้แทน {form_link} ในตัวอย่างด้านบน เขียนลิงก์เต็มเสมอ):"
+
+# Heading for the short summary of older messages (when HISTORY_SUMMARY is on)
+HISTORY_SUMMARY_INTRO = "สรุปข้อความก่อนหน้าในบทสนทนานี้ (ย่อไว้):"
+
+# ============================================================
+# "I finished the form" phrases
+# ============================================================
+# If a customer (not yet marked complete) says one of these, we mark the
+# form as completed, thank them and notify the team - without asking Claude.
+# Lowercase only. Phrases are ignored when negated ("ยังไม่กรอกแล้ว",
+# "not done") or asked as a question ("เรียบร้อยไหม", "done?").
+FORM_DONE_PHRASES = [
+    "กรอกแล้ว", "กรอกเรียบร้อย", "กรอกเสร็จ",
+    "กรอกฟอร์มแล้ว", "กรอกฟอร์มเรียบร้อย", "กรอกฟอร์มเสร็จ",
+    "ส่งฟอร์มแล้ว", "ฟอร์มเรียบร้อย", "ฟอร์มเสร็จ",
+    "filled out", "filled in", "already filled", "i filled",
+    "form done", "form completed", "form submitted",
+    "completed the form", "submitted the form", "finished the form",
+]
+
+# Short, generic words that only count when they are (almost) the whole
+# message, e.g. "done!" or "เรียบร้อยค่ะ" - not "จองห้องเรียบร้อยแล้ว อยากถามเรื่องวีซ่า"
+FORM_DONE_SHORT_REPLIES = [
+    "เรียบร้อย", "เสร็จแล้ว", "ส่งแล้ว", "ส่งไปแล้ว", "ทำแล้ว",
+    "ทำเสร็จแล้ว", "ทำเรียบร้อย",
+    "done", "completed", "finished", "submitted",
+    "already done", "already completed", "i completed",
+]
@@ -0,0 +1,147 @@
+# ============================================================
+# Peyton & Charmed - Conversation Traces
+# Records what each Claude reply was asked and what it cost, so a
+# prompt or model change can be replayed offline (bench/replay.py)
+# before it goes live
+# ============================================================
+# - Off unless TRACE_DIR is set. Traces hold customer messages, so
+#   keep the directory private and delete old files.
+# - record() only puts the trace on a queue; a background thread
+#   writes batches as gzip-compressed JSON lines. If the queue is
+#   full the trace is dropped (and counted), never the reply delayed.
+# - Files are append-only: each batch is added as its own gzip
+#   member, so a crash loses at most the last unwritten batch.
+#   Each process writes its own file (traces-<time>-<pid>.jsonl.gz)
+#   and starts a new one past `max_file_bytes`; only the newest
+#   `max_files` are kept.
+
+import os
+import glob
+import gzip
+import json
+import queue
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+FILE_PATTERN = "traces-*.jsonl.gz"
+
+
+class TraceRecorder:
+    def __init__(self, directory, sample_rate=1.0, max_file_bytes=20_000_000, max_files=20,
+                 flush_seconds=2.0, queue_size=10000):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._path = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def sampled(self):
+        """Decide once per reply whether to trace it."""
+        return self.enabled and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def record(self, kind, **fields):
+        if not self.enabled:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(dict(kind=kind, ts=round(time.time(), 3), **fields))
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        # One writer per process (gunicorn forks after import)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._path = None
+            threading.Thread(target=self._run, name="traces", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.error("Could not write %s traces: %s", len(batch), e)
+
+    def _write(self, batch):
+        if self._path is None or os.path.getsize(self._path) > self.max_file_bytes:
+            self._path = os.path.join(
+                self.directory, f"traces-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl.gz"
+            )
+            self._prune()
+        data = "".join(json.dumps(t, ensure_ascii=False, default=str) + "\n" for t in batch)
+        with gzip.open(self._path, "ab") as f:
+            f.write(data.encode("utf-8"))
+
+    def _prune(self):
+        files = sorted(glob.glob(os.path.join(self.directory, FILE_PATTERN)), key=os.path.getmtime)
+        for path in files[:max(0, len(files) - self.max_files + 1)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+            "file": self._path,
+        }
+
+
+def read_traces(paths, kind=None):
+    """Yield traces from files and/or directories of trace files, oldest file first.
+
+    A file still being written (or cut short by a crash) yields every
+    complete line before the damaged part.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, FILE_PATTERN)), key=os.path.getmtime))
+        else:
+            files.append(path)
+    for path in files:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    trace = json.loads(line)
+                    if kind is None or trace.get("kind") == kind:
+                        yield trace
+            except (EOFError, gzip.BadGzipFile) as e:
+                logger.warning("%s: stopped at a damaged or unfinished part (%s)", path, e)
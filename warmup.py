@@ -0,0 +1,103 @@
+# ============================================================
+# Peyton & Charmed - Cold Start
+# Lets a freshly started worker take webhooks right away: slow
+# setup runs in the background and /health says when it's done.
+# ============================================================
+# - Lazy: an object that is built the first time it's used, or by
+#   the startup steps, whichever comes first
+# - Warmup: the startup steps (loading saved state, importing the
+#   Anthropic SDK, opening connections to LINE, Zoho and Anthropic)
+#   run in order on a background thread, with their timings
+#
+# Nothing here is needed for correctness. A webhook that arrives
+# before the steps finish builds whatever it needs itself; it just
+# pays the setup cost that the steps would have paid.
+
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# asgi_app.py sets this to False before importing app.py: it has its
+# own async clients, so app.py's blocking ones needn't be pre-warmed
+prewarm_blocking_clients = True
+
+
+class Lazy:
+    """Builds `factory()` on first use; attributes are passed through."""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    started = time.monotonic()
+                    self._value = self._factory()
+                    self._loaded = True
+                    logger.info("%s ready in %.2fs", self.name, time.monotonic() - started)
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+class Warmup:
+    """Startup steps run once, in order; a failed step is logged and skipped."""
+
+    def __init__(self, timeout=10):
+        # Ready anyway after `timeout` seconds, so a stuck step (e.g. an
+        # upstream that doesn't answer) never keeps a worker out of service
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.finished_after = None
+        self._steps = []
+        self._results = {}
+        self._finished = threading.Event()
+
+    def add(self, name, step):
+        self._steps.append((name, step))
+
+    def start(self, background=True):
+        if background:
+            threading.Thread(target=self._run, name="warmup", daemon=True).start()
+        else:
+            self._run()
+
+    def _run(self):
+        for name, step in self._steps:
+            started = time.monotonic()
+            try:
+                step()
+                self._results[name] = {"ok": True, "seconds": round(time.monotonic() - started, 3)}
+            except Exception as e:
+                logger.warning("Startup step %s failed: %s", name, e)
+                self._results[name] = {"ok": False, "seconds": round(time.monotonic() - started, 3), "error": str(e)}
+        self.finished_after = time.monotonic() - self.started_at
+        self._finished.set()
+        logger.info("Startup finished in %.2fs", self.finished_after)
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    @property
+    def ready(self):
+        return self._finished.is_set() or time.monotonic() - self.started_at >= self.timeout
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "finished": self._finished.is_set(),
+            "finished_after_seconds": round(self.finished_after, 3) if self.finished_after is not None else None,
+            "steps": dict(self._results),
+        }